@@ -0,0 +1,183 @@
+import logging
+import multiprocessing
+import os
+import select
+import time
+
+from collections import deque
+
+from openvenues.extract.parsers import *
+from openvenues.extract.soup import matched_triggers
+from openvenues.extract.util import decode_html
+
+logger = logging.getLogger('extract.batch')
+
+DEFAULT_CHUNKSIZE = 16
+
+# Documents read ahead of the oldest unfinished one, per worker and chunk,
+# before extract_many stops reading input
+READ_AHEAD_CHUNKS = 4
+
+
+def batch_worker_loop(conn, features, memory_limit, kw):
+    init_worker(memory_limit)
+
+    while True:
+        try:
+            chunk = conn.recv()
+        except EOFError:
+            break
+        results = []
+        for seq, content, triggers in chunk:
+            try:
+                content, charset = decode_html(content)
+                status, ret, timings = worker_extract(content, features, dict(kw, triggers=triggers))
+            except MemoryError:
+                os._exit(1)
+            results.append((seq, status, ret))
+        conn.send(results)
+
+
+class BatchWorker(object):
+    '''
+    One worker process of extract_many and the chunk it's working on
+    '''
+    def __init__(self, features, memory_limit, kw):
+        self.process, self.conn = spawn_worker(batch_worker_loop, features, memory_limit, kw)
+        self.documents = 0
+        self.chunk = None
+        self.deadline = None
+
+    def send(self, chunk, timeout):
+        self.chunk = chunk
+        self.documents += len(chunk)
+        self.deadline = time.time() + timeout * len(chunk) if timeout is not None else None
+        self.conn.send([(seq, content, triggers) for seq, url, content, triggers in chunk])
+
+    def stop(self):
+        kill_worker(self.process, self.conn)
+        self.process = None
+        self.conn = None
+
+
+def extract_many(documents, workers=None, chunksize=DEFAULT_CHUNKSIZE, ordered=True,
+                 features=HTML_PARSER, memory_limit=DEFAULT_MEMORY_LIMIT, timeout=DEFAULT_TIMEOUT,
+                 max_documents=DEFAULT_MAX_DOCUMENTS, **kw):
+    '''
+    Run extract_items over an iterable of (url, html) in a pool of worker
+    processes and yield (url, result) for every document, in input order
+    or, with ordered=False, as they complete. result is None when there's
+    nothing to extract or the document failed.
+
+    Documents with none of the extractor triggers are answered in this
+    process without a parse. The rest go to the workers chunksize at a
+    time, are decoded/br2nl'd like in the job and parsed with features.
+    Workers are forked once after all the imports and respawned after a
+    crash, after a timeout (timeout seconds per document in the chunk) or
+    every max_documents documents. A chunk that crashes or times out is
+    retried one document at a time, so only the culprit comes back None.
+
+    Other keyword arguments go to extract_items.
+    '''
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    max_read_ahead = workers * chunksize * READ_AHEAD_CHUNKS
+
+    documents = iter(documents)
+    exhausted = False
+    retries = deque()
+    done = {}
+    # Documents read so far, and yielded so far
+    seq = 0
+    yielded = 0
+
+    idle = [BatchWorker(features, memory_limit, kw) for i in xrange(workers)]
+    busy = {}
+
+    def fail(worker, reason):
+        worker.stop()
+        chunk = worker.chunk
+        if len(chunk) > 1:
+            retries.extend([d] for d in chunk)
+        else:
+            s, url, content, triggers = chunk[0]
+            logger.warn('Worker {} on {}, skipping'.format(reason, url))
+            done[s] = (url, None)
+        idle.append(BatchWorker(features, memory_limit, kw))
+
+    try:
+        while True:
+            while idle:
+                if retries:
+                    chunk = retries.popleft()
+                elif exhausted or seq - yielded >= max_read_ahead:
+                    break
+                else:
+                    chunk = []
+                    while len(chunk) < chunksize and seq - yielded < max_read_ahead:
+                        try:
+                            url, content = next(documents)
+                        except StopIteration:
+                            exhausted = True
+                            break
+                        triggers = matched_triggers(content)
+                        if triggers:
+                            chunk.append((seq, url, content, triggers))
+                        else:
+                            done[seq] = (url, None)
+                        seq += 1
+                    if not chunk:
+                        break
+
+                worker = idle.pop()
+                if max_documents and worker.documents >= max_documents:
+                    worker.stop()
+                    worker = BatchWorker(features, memory_limit, kw)
+                worker.send(chunk, timeout)
+                busy[worker.conn] = worker
+
+            if ordered:
+                while yielded in done:
+                    yield done.pop(yielded)
+                    yielded += 1
+            else:
+                for s in sorted(done):
+                    yield done.pop(s)
+                    yielded += 1
+
+            if not busy:
+                if exhausted and not retries and not done:
+                    break
+                continue
+
+            deadlines = [w.deadline for w in busy.itervalues() if w.deadline is not None]
+            wait = max(0, min(deadlines) - time.time()) if deadlines else None
+            ready, _, _ = select.select(busy.keys(), [], [], wait)
+
+            for conn in ready:
+                worker = busy.pop(conn)
+                try:
+                    results = conn.recv()
+                except (EOFError, IOError, OSError):
+                    fail(worker, FAILURE_CRASH)
+                    continue
+                urls = dict((s, url) for s, url, content, triggers in worker.chunk)
+                for s, status, ret in results:
+                    if status == WORKER_BUDGET:
+                        logger.warn('Budget exceeded ({}) on {}'.format(ret, urls[s]))
+                        ret = None
+                    elif status != WORKER_OK:
+                        logger.error('Error in {} worker on {}: {}'.format(features, urls[s], ret))
+                        ret = None
+                    done[s] = (urls[s], ret)
+                worker.chunk = None
+                idle.append(worker)
+
+            now = time.time()
+            for conn, worker in busy.items():
+                if worker.deadline is not None and worker.deadline <= now:
+                    del busy[conn]
+                    fail(worker, FAILURE_TIMEOUT)
+    finally:
+        for worker in idle + busy.values():
+            worker.stop()
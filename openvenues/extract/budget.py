@@ -0,0 +1,52 @@
+import signal
+
+from contextlib import contextmanager
+
+BUDGET_BYTES = 'bytes'
+BUDGET_TAGS = 'tags'
+BUDGET_DEPTH = 'depth'
+BUDGET_TIME = 'time'
+
+
+class BudgetExceeded(BaseException):
+    '''
+    Raised when a document goes over one of its per-document budgets,
+    reason is one of the BUDGET_* constants. Not an Exception, like
+    KeyboardInterrupt, so the time limit's one alarm can't be swallowed by
+    an except Exception: in the extractors.
+    '''
+    def __init__(self, reason):
+        BaseException.__init__(self, reason)
+        self.reason = reason
+
+
+def check_index_budget(index, max_tags=None, max_depth=None):
+    if max_tags and index.tag_count > max_tags:
+        raise BudgetExceeded(BUDGET_TAGS)
+    if max_depth and index.max_depth > max_depth:
+        raise BudgetExceeded(BUDGET_DEPTH)
+
+
+def raise_time_budget(signum, frame):
+    raise BudgetExceeded(BUDGET_TIME)
+
+
+@contextmanager
+def time_limit(seconds):
+    '''
+    Raise BudgetExceeded in the block after seconds of wall-clock time.
+    Uses SIGALRM so it only works in the main thread, None means no limit.
+    '''
+    if seconds is None:
+        yield
+        return
+    if seconds <= 0:
+        raise BudgetExceeded(BUDGET_TIME)
+
+    previous = signal.signal(signal.SIGALRM, raise_time_budget)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
@@ -0,0 +1,278 @@
+import logging
+import re
+import traceback
+
+from collections import Counter
+from HTMLParser import HTMLParser, HTMLParseError
+
+from bs4.builder import HTMLTreeBuilder
+from bs4.dammit import EntitySubstitution, UnicodeDammit
+
+from openvenues.extract.index import DocumentIndex
+from openvenues.extract.soup import *
+from openvenues.extract.util import *
+
+logger = logging.getLogger('extract.head')
+
+VOID_ELEMENTS = HTMLTreeBuilder.empty_element_tags
+
+# Mirrors the multi-valued attributes BeautifulSoup splits into lists
+LIST_ATTRIBUTES = {
+    'a': set(['rel', 'rev']),
+    'link': set(['rel', 'rev']),
+}
+
+# BeautifulSoup doesn't count these strings towards .text
+NON_TEXT_ELEMENTS = set(['script', 'style', 'template'])
+
+
+class StreamTag(object):
+    '''
+    Stand-in for a bs4 Tag with just enough of its interface (name, attrs,
+    text, string, get, []) for the meta/link/script based extractors in
+    extract.soup
+    '''
+    __slots__ = ('name', 'attrs', 'text')
+
+    def __init__(self, name, attrs, text=u''):
+        self.name = name
+        self.attrs = attrs
+        self.text = text
+
+    @property
+    def string(self):
+        return self.text
+
+    def get(self, key, default=None):
+        return self.attrs.get(key, default)
+
+    def __getitem__(self, key):
+        return self.attrs[key]
+
+    def __repr__(self):
+        return u'<{} {}>'.format(self.name, self.attrs)
+
+
+class HeadParser(HTMLParser):
+    '''
+    Event-driven collector for <meta>, <link>, <title>, a[href],
+    [rel="tag"] and JSON-LD <script> elements. Builds a DocumentIndex of StreamTags in one
+    linear pass without constructing a tree.
+
+    Only the element names are kept on a stack so that text capture for
+    <title> and rel="tag" elements ends where BeautifulSoup would end it.
+    '''
+
+    def __init__(self, original_encoding=None):
+        HTMLParser.__init__(self)
+        self.index = DocumentIndex()
+        self.original_encoding = original_encoding
+        self.open_tags = []
+        self.open_counts = Counter()
+        # (stack depth, StreamTag, text parts)
+        self.captures = []
+        self.non_text_depth = 0
+        # (StreamTag, raw parts) for the JSON-LD <script> being read
+        self.script_capture = None
+
+    def make_attrs(self, name, attrs):
+        attr_dict = {}
+        list_attrs = LIST_ATTRIBUTES.get(name, ())
+        for key, value in attrs:
+            if value is None:
+                value = u''
+            if key == 'class' or key in list_attrs:
+                value = value.split()
+            attr_dict[key] = value
+        return attr_dict
+
+    def handle_starttag(self, name, attrs, empty=False):
+        rel = None
+        for k, v in attrs:
+            if k == 'rel':
+                rel = v
+
+        stream_tag = None
+        # rel is whitespace-separated, like make_attrs/BeautifulSoup split it
+        capture = name == 'title' or (rel is not None and 'tag' in rel.split())
+        jsonld = name == 'script' and any(k == 'type' and v and 'ld+json' in v.lower() for k, v in attrs)
+        if capture or jsonld or name in ('meta', 'link') or (name == 'a' and any(k == 'href' for k, v in attrs)):
+            attr_dict = self.make_attrs(name, attrs)
+            stream_tag = StreamTag(name, attr_dict)
+            self.index.add(stream_tag)
+
+        if empty or name in VOID_ELEMENTS:
+            return
+
+        self.open_tags.append(name)
+        self.open_counts[name] += 1
+        if name in NON_TEXT_ELEMENTS:
+            self.non_text_depth += 1
+        if capture:
+            self.captures.append((len(self.open_tags), stream_tag, []))
+        if jsonld:
+            self.script_capture = (stream_tag, [])
+
+    def handle_startendtag(self, name, attrs):
+        self.handle_starttag(name, attrs, empty=True)
+
+    def pop_tag(self):
+        name = self.open_tags.pop()
+        self.open_counts[name] -= 1
+        if name in NON_TEXT_ELEMENTS:
+            self.non_text_depth -= 1
+        if name == 'script' and self.script_capture is not None:
+            self.finish_script_capture()
+        depth = len(self.open_tags)
+        while self.captures and self.captures[-1][0] > depth:
+            self.finish_capture()
+
+    def finish_capture(self):
+        depth, stream_tag, parts = self.captures.pop()
+        stream_tag.text = u''.join(parts)
+
+    def finish_script_capture(self):
+        stream_tag, parts = self.script_capture
+        stream_tag.text = u''.join(parts)
+        self.script_capture = None
+
+    def handle_endtag(self, name):
+        if not self.open_counts[name]:
+            return
+        while self.open_tags:
+            popped = self.open_tags[-1]
+            self.pop_tag()
+            if popped == name:
+                break
+
+    def handle_data(self, data):
+        if self.script_capture is not None:
+            self.script_capture[1].append(data)
+        if self.captures and not self.non_text_depth:
+            for depth, stream_tag, parts in self.captures:
+                parts.append(data)
+
+    def handle_charref(self, name):
+        if name.startswith('x') or name.startswith('X'):
+            real_name = int(name[1:], 16)
+        else:
+            real_name = int(name)
+
+        data = None
+        if real_name < 256:
+            for encoding in (self.original_encoding, 'windows-1252'):
+                if not encoding:
+                    continue
+                try:
+                    data = bytearray([real_name]).decode(encoding)
+                except UnicodeDecodeError:
+                    pass
+        if not data:
+            try:
+                data = unichr(real_name)
+            except (ValueError, OverflowError):
+                pass
+        self.handle_data(data or u'\N{REPLACEMENT CHARACTER}')
+
+    def handle_entityref(self, name):
+        character = EntitySubstitution.HTML_ENTITY_TO_CHARACTER.get(name)
+        if character is None:
+            character = u'&{}'.format(name)
+        self.handle_data(character)
+
+    def close(self):
+        HTMLParser.close(self)
+        while self.captures:
+            self.finish_capture()
+        if self.script_capture is not None:
+            self.finish_script_capture()
+
+
+head_end_regex = re.compile('(</head\s*>)|<body[\s>]', re.I)
+
+
+def head_section(html):
+    '''
+    Raw HTML up to the end of <head> (or the start of <body>), or an empty
+    string if neither is there
+    '''
+    m = head_end_regex.search(html)
+    if not m:
+        return html[:0]
+    return html[:m.end() if m.group(1) else m.start()]
+
+
+def parse_head(html):
+    '''
+    Stream html through HeadParser and return the resulting DocumentIndex,
+    or None if the parser gives up on the markup
+    '''
+    original_encoding = None
+    if not isinstance(html, unicode):
+        dammit = UnicodeDammit(html, is_html=True)
+        html = dammit.unicode_markup
+        original_encoding = dammit.original_encoding
+        if html is None:
+            return None
+
+    parser = HeadParser(original_encoding=original_encoding)
+    try:
+        parser.feed(html)
+        parser.close()
+    except HTMLParseError:
+        logger.warn('Error in streaming head parse: {}'.format(traceback.format_exc()))
+        return None
+    return parser.index
+
+
+def extract_head_items(index, want=None):
+    '''
+    Same result as extract_items for a page whose only structured data
+    lives in meta tags or JSON-LD: OpenGraph, OG business/place, geotags
+    and JSON-LD places.
+    '''
+    items = []
+
+    if want is None or SCHEMA_DOT_ORG_TYPE in want:
+        items.extend(extract_jsonld_script_items(None, index=index))
+
+    if want is None or GEOTAG_TYPE in want:
+        geotags = extract_geotags(None, index=index)
+        if geotags:
+            items.append(geotags)
+
+    opengraph_tags = None
+    if want is None or OG_TAG_TYPE in want:
+        opengraph_tags = extract_opengraph_tags(None, index=index)
+        if opengraph_tags:
+            i = opengraph_item(opengraph_tags)
+            if i:
+                items.append(i)
+
+    opengraph_business_tags = None
+    if want is None or OG_BUSINESS_TAG_TYPE in want:
+        opengraph_business_tags = extract_opengraph_business_tags(None, index=index)
+    if opengraph_business_tags:
+        i = opengraph_business(opengraph_business_tags)
+        if i:
+            items.append(i)
+
+    if not items:
+        return None
+
+    ret = {'items': items}
+
+    social_handles = extract_social_handles(None, index=index)
+    if social_handles:
+        ret['social'] = social_handles
+
+    if opengraph_tags is None:
+        opengraph_tags = extract_opengraph_tags(None, index=index)
+    if opengraph_tags:
+        ret['og'] = opengraph_tags
+
+    basic_metadata = extract_basic_metadata(None, index=index)
+    if basic_metadata:
+        ret.update(basic_metadata)
+
+    return ret
@@ -0,0 +1,104 @@
+from collections import defaultdict
+
+from bs4.element import Tag
+
+# Attributes whose presence is bucketed during the index walk. Anything the
+# extractors select on by attribute needs to be listed here.
+INDEXED_ATTRS = frozenset([
+    'property',
+    'name',
+    'href',
+    'src',
+    'rel',
+    'itemscope',
+    'itemtype',
+    'itemprop',
+    'typeof',
+    'vocab',
+    'data-lat',
+    'data-pushpin',
+])
+
+
+def attr_string(value):
+    '''
+    Multi-valued attributes (class, rel, etc.) come back from BeautifulSoup
+    as lists, CSS attribute selectors compare against the space-joined value
+    '''
+    if isinstance(value, list):
+        return u' '.join(value)
+    return value
+
+
+class DocumentIndex(object):
+    '''
+    Buckets every tag in a parsed document by name, class token and the
+    presence of a few interesting attributes, in a single walk of the tree.
+
+    Each bucket preserves document order, so lookups return the same tags
+    in the same order as the equivalent soup.select/soup.find_all call.
+    '''
+
+    def __init__(self, soup=None):
+        self.by_name = defaultdict(list)
+        self.by_class = defaultdict(list)
+        self.by_attr = defaultdict(list)
+
+        self.tag_count = 0
+        self.max_depth = 0
+
+        # First xmlns:* attribute pointing at data-vocabulary.org (RDFa)
+        self.data_vocabulary = None
+
+        # Filled in on first use by extract.soup.classify_links
+        self.link_buckets = None
+
+        if soup is not None:
+            # Open ancestors of the current tag, for the nesting depth
+            stack = []
+            for tag in soup.descendants:
+                if isinstance(tag, Tag):
+                    parent = tag.parent
+                    while stack and stack[-1] is not parent:
+                        stack.pop()
+                    stack.append(tag)
+                    if len(stack) > self.max_depth:
+                        self.max_depth = len(stack)
+                    self.add(tag)
+
+    def add(self, tag):
+        self.tag_count += 1
+        self.by_name[tag.name].append(tag)
+
+        for k, v in tag.attrs.iteritems():
+            if k == 'class':
+                for c in v:
+                    self.by_class[c].append(tag)
+            elif k in INDEXED_ATTRS:
+                self.by_attr[k].append(tag)
+            elif self.data_vocabulary is None and k.startswith('xmlns:') and 'data-vocabulary' in v:
+                self.data_vocabulary = k
+
+    def tags_named(self, name):
+        return self.by_name.get(name, [])
+
+    def tags_with_class(self, class_name):
+        return self.by_class.get(class_name, [])
+
+    def tags_with_attr(self, attr, name=None):
+        tags = self.by_attr.get(attr, [])
+        if name is None:
+            return tags
+        return [t for t in tags if t.name == name]
+
+    def tags_with_attr_value(self, attr, value, name=None):
+        return [t for t in self.tags_with_attr(attr, name=name)
+                if attr_string(t.attrs[attr]) == value]
+
+    def tags_with_attr_containing(self, attr, substring, name=None):
+        return [t for t in self.tags_with_attr(attr, name=name)
+                if substring in attr_string(t.attrs[attr])]
+
+    def tags_with_attr_matching(self, attr, regex, name=None):
+        return [t for t in self.tags_with_attr(attr, name=name)
+                if regex.search(attr_string(t.attrs[attr]))]
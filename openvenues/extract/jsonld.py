@@ -0,0 +1,162 @@
+import logging
+import re
+import ujson as json
+
+from openvenues.extract.util import *
+
+logger = logging.getLogger('extract.jsonld')
+
+# Name of the extractor in the soup registry
+JSONLD = 'jsonld'
+
+jsonld_script_regex = re.compile('<script[^>]*?type\s*=\s*["\']?application/ld\+json["\']?[^>]*>(.*?)</script\s*>',
+                                 re.I | re.S)
+
+jsonld_wrapper_regex = re.compile('^\s*(?:<!--|<!\[CDATA\[)|(?:-->|\]\]>)\s*$')
+
+# Nodes and lists nested deeper than this aren't descended into, the whole
+# block is skipped instead of recursing until the stack runs out
+JSONLD_MAX_DEPTH = 32
+
+
+class JSONLDTooDeep(ValueError):
+    pass
+
+
+class JSONLDStats(object):
+    '''
+    Blocks skipped for being nested too deep, reported and reset by the job
+    '''
+    def __init__(self):
+        self.skipped = 0
+
+    def drain(self):
+        skipped, self.skipped = self.skipped, 0
+        return skipped
+
+jsonld_stats = JSONLDStats()
+
+
+def jsonld_blocks(html):
+    '''
+    Contents of the <script type="application/ld+json"> blocks in raw HTML,
+    found with a regex instead of a parse
+    '''
+    return [m.group(1) for m in jsonld_script_regex.finditer(html)]
+
+
+def without_jsonld(html):
+    '''
+    html with its JSON-LD blocks cut out, so that words like "address" in
+    the JSON don't count as markup
+    '''
+    if 'ld+json' not in html:
+        return html
+    return jsonld_script_regex.sub('', html)
+
+
+def jsonld_type(value):
+    '''
+    Short schema.org type name from @type, which can be a list or a URL.
+    With several types the first place type wins.
+    '''
+    if isinstance(value, list):
+        types = [jsonld_type(v) for v in value if not isinstance(v, list)]
+        types = [t for t in types if t]
+        for t in types:
+            if t.lower() in PLACE_SCHEMA_TYPES:
+                return t
+        return types[0] if types else None
+    if not isinstance(value, basestring) or not value:
+        return None
+    return value.rstrip('/').split('/')[-1].split(':')[-1]
+
+
+def jsonld_value(value):
+    if isinstance(value, bool):
+        return u'true' if value else u'false'
+    if isinstance(value, (int, long, float)):
+        return unicode(repr(value) if isinstance(value, float) else value)
+    if isinstance(value, basestring):
+        return value
+    return None
+
+
+def jsonld_item(obj, items, prop=None, depth=0):
+    '''
+    Converts a JSON-LD node to the item/property dicts extract_schema_dot_org
+    builds from microdata. Nodes with a place type are appended to items,
+    wherever they're nested, like itemscopes are.
+    '''
+    if depth > JSONLD_MAX_DEPTH:
+        raise JSONLDTooDeep
+    item = prop if prop is not None else {}
+    item_type = jsonld_type(obj.get('@type'))
+    item['item_type'] = SCHEMA_DOT_ORG_TYPE
+    if item_type:
+        item['type'] = item_type
+    properties = item['properties'] = []
+
+    for key, value in obj.iteritems():
+        if not isinstance(key, basestring) or key.startswith('@'):
+            continue
+        name = key.split(':')[-1].replace('-', '_')
+        for v in (value if isinstance(value, list) else [value]):
+            if isinstance(v, dict):
+                properties.append(jsonld_item(v, items, prop={'name': name}, depth=depth + 1))
+            else:
+                v = jsonld_value(v)
+                if v is not None:
+                    properties.append({'name': name, 'value': v})
+
+    if item_type and item_type.lower() in PLACE_SCHEMA_TYPES:
+        items.append(item)
+    return item
+
+
+def jsonld_nodes(data, depth=0):
+    if depth > JSONLD_MAX_DEPTH:
+        raise JSONLDTooDeep
+    if isinstance(data, list):
+        for d in data:
+            for node in jsonld_nodes(d, depth=depth + 1):
+                yield node
+    elif isinstance(data, dict):
+        graph = data.get('@graph')
+        if isinstance(graph, list):
+            for node in jsonld_nodes(graph, depth=depth + 1):
+                yield node
+        else:
+            yield data
+
+
+def jsonld_items_from_blocks(blocks):
+    items = []
+    for block in blocks:
+        block = jsonld_wrapper_regex.sub('', block).strip()
+        if not block:
+            continue
+        try:
+            data = json.loads(block)
+        except ValueError:
+            logger.debug('Invalid JSON-LD block')
+            continue
+        block_items = []
+        try:
+            for node in jsonld_nodes(data):
+                jsonld_item(node, block_items)
+        except JSONLDTooDeep:
+            logger.debug('JSON-LD block nested deeper than {}, skipping'.format(JSONLD_MAX_DEPTH))
+            jsonld_stats.skipped += 1
+            continue
+        items.extend(block_items)
+
+    return [item for item in items if have_street_or_latlon(item)]
+
+
+def extract_jsonld_items(html):
+    '''
+    schema.org place items from the JSON-LD blocks in raw HTML, in the same
+    shape as extract_schema_dot_org's, without building a tree
+    '''
+    return jsonld_items_from_blocks(jsonld_blocks(html))
@@ -0,0 +1,262 @@
+import logging
+import multiprocessing
+import os
+import resource
+import signal
+import traceback
+
+from bs4 import BeautifulSoup
+
+from openvenues.extract.budget import *
+from openvenues.extract.soup import extract_items
+
+logger = logging.getLogger('extract.parsers')
+
+HTML_PARSER = 'html.parser'
+LXML_PARSER = 'lxml'
+HTML5_PARSER = 'html5-parser'
+
+DEFAULT_MEMORY_LIMIT = 1024 * 1024 * 1024
+DEFAULT_TIMEOUT = 30
+DEFAULT_MAX_DOCUMENTS = 1000
+
+WORKER_OK = 'ok'
+WORKER_ERROR = 'error'
+WORKER_BUDGET = 'budget'
+
+FAILURE_TIMEOUT = 'timeout'
+FAILURE_CRASH = 'crash'
+FAILURE_ERROR = 'error'
+
+
+class BudgetedSoup(BeautifulSoup):
+    '''
+    BeautifulSoup which raises BudgetExceeded as soon as the tree being
+    built has more than max_tags tags or is nested deeper than max_depth,
+    so an oversized document doesn't pay for the whole parse first
+    '''
+    def __init__(self, markup, features, max_tags=None, max_depth=None):
+        self.budget_max_tags = max_tags
+        self.budget_max_depth = max_depth
+        self.budget_tags = 0
+        BeautifulSoup.__init__(self, markup, features)
+
+    def reset(self):
+        # Called again if bs4 retries the markup with another encoding
+        BeautifulSoup.reset(self)
+        self.budget_tags = 0
+
+    def handle_starttag(self, *args, **kw):
+        tag = BeautifulSoup.handle_starttag(self, *args, **kw)
+        if tag is not None:
+            self.budget_tags += 1
+            if self.budget_max_tags and self.budget_tags > self.budget_max_tags:
+                raise BudgetExceeded(BUDGET_TAGS)
+            # The stack starts with the soup itself
+            if self.budget_max_depth and len(self.tagStack) - 1 > self.budget_max_depth:
+                raise BudgetExceeded(BUDGET_DEPTH)
+        return tag
+
+
+def parse_soup(content, features=HTML_PARSER, max_tags=None, max_depth=None):
+    '''
+    Parsed tree for content. With max_tags or max_depth, BudgetExceeded is
+    raised during the parse (html5-parser only gets the check after it,
+    in extract_items).
+    '''
+    if features == HTML5_PARSER:
+        import html5_parser
+        return html5_parser.parse(content, treebuilder='soup')
+    if max_tags or max_depth:
+        return BudgetedSoup(content, features, max_tags=max_tags, max_depth=max_depth)
+    return BeautifulSoup(content, features)
+
+
+class ExtractedDocument(object):
+    '''
+    Result of a parse + extract that already happened elsewhere (e.g. in
+    a worker process), passed through to process_html in place of a soup
+    '''
+    __slots__ = ('ret',)
+
+    def __init__(self, ret):
+        self.ret = ret
+
+
+class SoupParser(object):
+    '''
+    In-process BeautifulSoup parse, the default and the fallback for
+    every other backend
+    '''
+    def __init__(self, features=HTML_PARSER):
+        self.features = features
+        self.last_failure = None
+
+    def parse(self, content, **kw):
+        return parse_soup(content, self.features, max_tags=kw.get('max_tags'), max_depth=kw.get('max_depth'))
+
+    def extract(self, doc, **kw):
+        return extract_items(doc, **kw)
+
+    def close(self):
+        pass
+
+
+def init_worker(memory_limit):
+    # Don't let a runaway libxml2 take the rest of the box with it
+    if memory_limit:
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def worker_extract(content, features, kw):
+    '''
+    Parse + extract_items for one document in a worker, returns
+    (status, result or error, timings). MemoryError is left to the caller.
+    '''
+    # A list can't be filled in across the pipe, send the timings back
+    timings = [] if kw.pop('timings', None) is not None else None
+    try:
+        soup = parse_soup(content, features, max_tags=kw.get('max_tags'), max_depth=kw.get('max_depth'))
+        ret = extract_items(soup, timings=timings, **kw)
+        return WORKER_OK, ret, timings
+    except BudgetExceeded as e:
+        return WORKER_BUDGET, e.reason, None
+    except MemoryError:
+        raise
+    except Exception:
+        return WORKER_ERROR, traceback.format_exc(), None
+
+
+def worker_loop(conn, features, memory_limit):
+    init_worker(memory_limit)
+
+    while True:
+        try:
+            content, kw = conn.recv()
+        except EOFError:
+            break
+        try:
+            conn.send(worker_extract(content, features, kw))
+        except MemoryError:
+            # Likely not recoverable, let the parent respawn us
+            os._exit(1)
+
+
+def spawn_worker(target, *args):
+    '''
+    Fork a daemon worker process running target(conn, *args), returns
+    (process, conn) for the parent's end of the pipe
+    '''
+    parent_conn, child_conn = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=target, args=(child_conn, ) + args)
+    process.daemon = True
+    process.start()
+    child_conn.close()
+    return process, parent_conn
+
+
+def kill_worker(process, conn):
+    if conn is not None:
+        conn.close()
+    if process is not None:
+        if process.is_alive():
+            os.kill(process.pid, signal.SIGKILL)
+        process.join()
+
+
+class IsolatedParser(object):
+    '''
+    Runs parse + extract_items in a forked worker process with an address
+    space limit (RLIMIT_AS) and a per-document wall-clock timeout.
+
+    The worker is forked after all the imports so it starts warm, and is
+    respawned after a crash, a timeout or every max_documents documents.
+    Documents which fail in the worker for any reason are retried on the
+    fallback parser (in-process BeautifulSoup with html.parser).
+    '''
+    def __init__(self, features=LXML_PARSER,
+                 memory_limit=DEFAULT_MEMORY_LIMIT,
+                 timeout=DEFAULT_TIMEOUT,
+                 max_documents=DEFAULT_MAX_DOCUMENTS,
+                 fallback=None):
+        self.features = features
+        self.memory_limit = memory_limit
+        self.timeout = timeout
+        self.max_documents = max_documents
+        self.fallback = fallback or SoupParser()
+
+        self.process = None
+        self.conn = None
+        self.documents = 0
+        self.last_failure = None
+
+    def start(self):
+        self.process, self.conn = spawn_worker(worker_loop, self.features, self.memory_limit)
+        self.documents = 0
+
+    def stop(self):
+        kill_worker(self.process, self.conn)
+        self.process = None
+        self.conn = None
+
+    close = stop
+
+    def run(self, content, **kw):
+        if self.process is None or not self.process.is_alive() or \
+           (self.max_documents and self.documents >= self.max_documents):
+            self.stop()
+            self.start()
+
+        self.documents += 1
+
+        try:
+            self.conn.send((content, kw))
+            if not self.conn.poll(self.timeout):
+                self.stop()
+                return FAILURE_TIMEOUT, None
+            status, ret, timings = self.conn.recv()
+        except (EOFError, IOError, OSError):
+            self.stop()
+            return FAILURE_CRASH, None
+        except BaseException:
+            # Interrupted, e.g. by a time limit, while the worker is still
+            # busy with this document
+            self.stop()
+            raise
+
+        if status == WORKER_BUDGET:
+            raise BudgetExceeded(ret)
+        if status != WORKER_OK:
+            logger.error('Error in {} worker: {}'.format(self.features, ret))
+            return FAILURE_ERROR, None
+        if timings:
+            kw['timings'].extend(timings)
+        return None, ret
+
+    def parse(self, content, **kw):
+        '''
+        Keyword arguments are passed through to extract_items in the worker,
+        a timings list is filled in with the worker's extractor timings.
+        BudgetExceeded from the worker is raised here, without a fallback.
+        '''
+        failure, ret = self.run(content, **kw)
+        self.last_failure = failure
+        if failure is None:
+            return ExtractedDocument(ret)
+        return self.fallback.parse(content, **kw)
+
+    def extract(self, doc, **kw):
+        if isinstance(doc, ExtractedDocument):
+            return doc.ret
+        return self.fallback.extract(doc, **kw)
+
+
+def parser_backend(name=HTML_PARSER, **kw):
+    '''
+    Build a parser backend by name. Anything other than html.parser runs
+    in an isolated worker process.
+    '''
+    if name == HTML_PARSER:
+        return SoupParser()
+    return IsolatedParser(features=name, **kw)
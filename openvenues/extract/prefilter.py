@@ -0,0 +1,228 @@
+import re
+
+from collections import defaultdict
+
+from openvenues.utils.encoding import *
+
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+# How far back to look for the enclosing '<' of a hit
+DEFAULT_TAG_WINDOW = 4096
+
+# Bytes kept on either side of a hit by hit_windows
+DEFAULT_HIT_WINDOW = 4096
+
+# Content is lowercased (and UTF-8 encoded) this much at a time for the
+# automaton
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+
+tag_delimiter_regex = re.compile('["\'>]')
+
+
+def in_start_tag(content, start, window=DEFAULT_TAG_WINDOW):
+    '''
+    True if content[start] sits inside a start tag, i.e. in the tag name,
+    an attribute name or an attribute value, rather than in text, a
+    comment, an inline script or a stylesheet. A '>' inside a quoted
+    attribute value doesn't end the tag.
+    '''
+    lt = content.rfind('<', max(0, start - window), start + 1)
+    if lt < 0 or lt + 1 >= len(content) or not content[lt + 1].isalpha():
+        return False
+
+    quote = None
+    i = lt + 1
+    while True:
+        m = tag_delimiter_regex.search(content, i, start)
+        if m is None:
+            return True
+        c = m.group()
+        i = m.end()
+        if quote is not None:
+            if c == quote:
+                quote = None
+        elif c == '>':
+            return False
+        else:
+            # Quotes only start a value right after the =
+            j = m.start() - 1
+            while j > lt and content[j].isspace():
+                j -= 1
+            if content[j] == '=':
+                quote = c
+
+
+class LiteralMatcher(object):
+    '''
+    Case-insensitive multi-literal matcher over raw (undecoded) bytes.
+
+    needles is a sequence of (pattern_id, literal, confirm) tuples. Several
+    literals can map to the same pattern_id. confirm is an optional compiled
+    regex for patterns which aren't plain literals, it's only run on
+    documents where the literal was found.
+
+    Uses an Aho-Corasick automaton when pyahocorasick is installed, falls
+    back to a single lookahead alternation regex otherwise. The automaton
+    reads content chunk_size bytes (or characters for unicode) at a time,
+    lowercasing one chunk at a time instead of copying the whole record.
+    '''
+
+    def __init__(self, needles, use_automaton=True, chunk_size=DEFAULT_CHUNK_SIZE):
+        self.ids_by_literal = defaultdict(list)
+        self.confirm = {}
+        self.chunk_size = chunk_size
+
+        for pattern_id, literal, confirm in needles:
+            literal = safe_encode(literal).lower()
+            if pattern_id not in self.ids_by_literal[literal]:
+                self.ids_by_literal[literal].append(pattern_id)
+            if confirm is not None:
+                self.confirm[pattern_id] = confirm
+
+        literals = sorted(self.ids_by_literal, key=len, reverse=True)
+        # Each chunk starts with this many bytes of the previous one, so
+        # literals spanning a chunk boundary are still found
+        self.overlap = len(literals[0]) - 1 if literals else 0
+
+        # The regex only reports the longest literal at each position, so
+        # also credit any literals which are a prefix of it
+        self.prefix_ids = {}
+        for literal in literals:
+            ids = []
+            for other in literals:
+                if literal.startswith(other):
+                    ids.extend(i for i in self.ids_by_literal[other] if i not in ids)
+            self.prefix_ids[literal] = tuple(ids)
+
+        self.automaton = None
+        self.regex = None
+        if use_automaton and ahocorasick is not None:
+            self.automaton = ahocorasick.Automaton()
+            for literal, ids in self.ids_by_literal.iteritems():
+                self.automaton.add_word(literal, (len(literal), tuple(ids)))
+            self.automaton.make_automaton()
+        else:
+            self.regex = re.compile('(?=({}))'.format('|'.join(re.escape(l) for l in literals)), re.I)
+
+    def iter_hits(self, content):
+        '''
+        Yields (pattern_id, start) for every literal occurrence. Content
+        should be bytes, unicode is matched as UTF-8 when using the automaton
+        and positions then refer to the encoded string.
+        '''
+        if self.automaton is not None:
+            for hit in self.iter_automaton_hits(content):
+                yield hit
+        else:
+            for m in self.regex.finditer(content):
+                for pattern_id in self.prefix_ids[m.group(1).lower()]:
+                    yield pattern_id, m.start()
+
+    def iter_automaton_hits(self, content):
+        is_text = isinstance(content, text_type)
+        tail = ''
+        # Position of the current chunk in the (encoded) content
+        position = 0
+        for i in xrange(0, len(content), self.chunk_size):
+            chunk = content[i:i + self.chunk_size]
+            if is_text:
+                chunk = chunk.encode('utf-8')
+            chunk = tail + chunk.lower()
+            offset = position - len(tail)
+            for end, (length, ids) in self.automaton.iter(chunk):
+                # Ended within the previous chunk, already reported
+                if offset + end < position:
+                    continue
+                for pattern_id in ids:
+                    yield pattern_id, offset + end - length + 1
+            position = offset + len(chunk)
+            tail = chunk[max(0, len(chunk) - self.overlap):] if self.overlap else ''
+
+    def confirmed(self, pattern_id, content, cache):
+        result = cache.get(pattern_id)
+        if result is None:
+            confirm = self.confirm.get(pattern_id)
+            result = cache[pattern_id] = confirm is None or confirm.search(content) is not None
+        return result
+
+    def iter_matches(self, content):
+        '''
+        Yields each matching pattern_id once, in order of first occurrence
+        '''
+        seen = set()
+        cache = {}
+        for pattern_id, start in self.iter_hits(content):
+            if pattern_id in seen:
+                continue
+            seen.add(pattern_id)
+            if self.confirmed(pattern_id, content, cache):
+                yield pattern_id
+
+    def search(self, content):
+        '''
+        First pattern_id found in content or None, stops at the first hit
+        '''
+        for pattern_id in self.iter_matches(content):
+            return pattern_id
+        return None
+
+    def matches(self, content):
+        '''
+        Set of all pattern_ids found in content
+        '''
+        return set(self.iter_matches(content))
+
+    def search_structural(self, content, window=DEFAULT_TAG_WINDOW):
+        '''
+        Two-stage search in one pass over the hits. Returns a tuple of the
+        first pattern_id found anywhere (stage 1) and the first pattern_id
+        found inside a start tag (stage 2), stopping once stage 2 is
+        satisfied. Either can be None.
+        '''
+        if self.automaton is not None and isinstance(content, text_type):
+            content = content.encode('utf-8')
+
+        first = None
+        cache = {}
+        for pattern_id, start in self.iter_hits(content):
+            if not self.confirmed(pattern_id, content, cache):
+                continue
+            if first is None:
+                first = pattern_id
+            if in_start_tag(content, start, window=window):
+                return first, pattern_id
+        return first, None
+
+    def hit_windows(self, content, window=DEFAULT_HIT_WINDOW):
+        '''
+        Merged (start, end) byte ranges of content within window bytes of a
+        confirmed hit, widened to start at a '<' and end after a '>' so the
+        ranges don't cut tags in half. Unicode is matched as UTF-8, and the
+        ranges then refer to the encoded string.
+        '''
+        if isinstance(content, text_type):
+            content = content.encode('utf-8')
+
+        windows = []
+        cache = {}
+        for pattern_id, start in self.iter_hits(content):
+            if windows and start <= windows[-1][1]:
+                continue
+            if not self.confirmed(pattern_id, content, cache):
+                continue
+
+            begin = content.rfind('<', 0, max(0, start - window) + 1)
+            if begin < 0:
+                begin = 0
+            end = content.find('>', min(len(content), start + window))
+            end = end + 1 if end >= 0 else len(content)
+
+            if windows and begin <= windows[-1][1]:
+                windows[-1] = (windows[-1][0], max(end, windows[-1][1]))
+            else:
+                windows.append((begin, end))
+        return windows
@@ -1,10 +1,16 @@
 import logging
+import time
 import traceback
 import ujson as json
 
 from collections import *
 from itertools import chain
 from bs4 import BeautifulSoup, SoupStrainer
+from bs4.element import CData, NavigableString, Tag
+from openvenues.extract.budget import check_index_budget
+from openvenues.extract.index import DocumentIndex, attr_string
+from openvenues.extract.jsonld import JSONLD, jsonld_items_from_blocks
+from openvenues.extract.prefilter import LiteralMatcher
 from openvenues.extract.util import *
 
 
@@ -33,8 +39,13 @@ def extract_links(soup):
         yield link
 
 
-def extract_basic_metadata(soup):
-    title_tags = soup.select('meta[property="og:title"]') + soup.select('meta[name="title"]') + soup.find_all('title')
+def extract_basic_metadata(soup, index=None):
+    if index is None:
+        index = DocumentIndex(soup)
+
+    title_tags = index.tags_with_attr_value('property', 'og:title', name='meta') + \
+        index.tags_with_attr_value('name', 'title', name='meta') + \
+        index.tags_named('title')
     title = None
     for t in title_tags:
         value, value_attr = tag_value_and_attr(t)
@@ -47,7 +58,8 @@ def extract_basic_metadata(soup):
     if title:
         ret['title'] = title
 
-    description_tags = soup.select('meta[property="og:description"]') or soup.select('meta[name="description"]')
+    description_tags = index.tags_with_attr_value('property', 'og:description', name='meta') or \
+        index.tags_with_attr_value('name', 'description', name='meta')
     if description_tags:
         for d in description_tags:
             value, value_attr = tag_value_and_attr(d)
@@ -56,19 +68,27 @@ def extract_basic_metadata(soup):
                 ret['description'] = description
                 break
 
-    canonical = soup.select('link[rel="canonical"]')
+    canonical = index.tags_with_attr_value('rel', 'canonical', name='link')
     if canonical and canonical[0].get('href'):
         ret['canonical'] = canonical[0]['href']
 
-    alternates = soup.select('link[rel="alternate"]')
+    alternates = index.tags_with_attr_value('rel', 'alternate', name='link')
     if alternates:
         ret['alternates'] = [{'link': tag['href'],
                               'lang': tag.get('hreflang')
                               } for tag in alternates if tag.get('href')]
 
-    meta_tags = set(soup.select('meta[property]')) | set(soup.select('meta[name]'))
+    meta_tags = [t for t in index.tags_named('meta') if 'property' in t.attrs or 'name' in t.attrs]
     meta_dict = defaultdict(list)
+    # Identical duplicate tags count once, like they did when these were a
+    # set of bs4 Tags. Keyed on name and attributes (what Tag equality
+    # compares for an empty <meta>) so StreamTags dedupe the same way.
+    seen = set()
     for t in meta_tags:
+        key = (t.name, tuple(sorted((k, attr_string(v)) for k, v in t.attrs.iteritems())))
+        if key in seen:
+            continue
+        seen.add(key)
         name = t.get('property', t.get('name', '')).strip().lower()
         value, value_attr = tag_value_and_attr(t)
         if value and value.strip() and not name.startswith('og:') and not name.startswith('place:') and not name.startswith('business:'):
@@ -77,7 +97,7 @@ def extract_basic_metadata(soup):
     if meta_dict:
         ret['other_meta'] = dict(meta_dict)
 
-    rel_tag = soup.select('[rel="tag"]')
+    rel_tag = index.tags_with_attr_value('rel', 'tag')
     if rel_tag:
         all_tags = []
         for t in rel_tag:
@@ -101,151 +121,244 @@ def extract_basic_metadata(soup):
     return ret
 
 
-def extract_schema_dot_org(soup, use_rdfa=False):
-    items = []
+def schema_dot_org_tag(tag, parent_item, items, use_rdfa=False, prefix=None, cache=None):
+    '''
+    Handle one tag of the microdata (or with use_rdfa, RDFa) walk. Attaches
+    the tag's property to parent_item, appends new place items to items and
+    returns the item the tag's children belong to.
 
+    cache holds the tag's value and text so they're only computed once when
+    both walks visit the same tag.
+    '''
     scope_attr = 'itemtype'
     prop_attr = 'itemprop'
 
     schema_type = SCHEMA_DOT_ORG_TYPE if not use_rdfa else RDFA_TYPE
 
-    xmlns = None
+    if cache is None:
+        cache = {}
 
-    if use_rdfa:
-        data_vocabulary = None
-        # Verify that we have xmlns defined
-        for tag in soup.find_all(True):
-            data_vocabulary = [k for k, v in tag.attrs.iteritems()
-                               if k.startswith('xmlns:') and 'data-vocabulary' in v]
-            if data_vocabulary:
-                data_vocabulary = data_vocabulary[0]
-                break
-        if not data_vocabulary:
-            return items
+    current_item = parent_item
+
+    item = None
+    prop = None
+
+    item_scope = tag.get(scope_attr)
+
+    if not item_scope and use_rdfa:
+        item_scope = tag.get('typeof', tag.get('vocab'))
+        if not item_scope or not item_scope.startswith(prefix):
+            item_scope = None
+
+    item_prop = tag.get(prop_attr)
+    item_type = item_scope
+
+    if not item_prop and use_rdfa:
+        item_prop = tag.get('property')
+        if not item_prop or not item_prop.startswith(prefix):
+            item_prop = tag.get('rel', [])
+            item_prop = [p for p in item_prop if p.startswith(prefix)]
+            if not item_prop:
+                item_prop = None
+            else:
+                item_prop = item_prop[0]
+
+    if item_prop:
+        prop_name = item_prop
+        if use_rdfa:
+            prop_name = prop_name.split(':', 1)[-1]
+
+        prop_name = prop_name.replace('-', '_')
+
+        prop = {'name': prop_name}
+        value_attr = None
+        if not item_scope:
+            if 'value' not in cache:
+                cache['value'] = tag_value_and_attr(tag)
+            value, value_attr = cache['value']
+            if use_rdfa and not value and tag.get('content'):
+                value, value_attr = tag['content'], 'content'
+
+            prop['value'] = value
+        attributes = {k: v for k, v in tag.attrs.iteritems() if k not in (scope_attr, prop_attr)}
+        if value_attr:
+            if 'text' not in cache:
+                cache['text'] = tag.text.strip()
+            prop['text'] = cache['text']
+            prop['value_attr'] = value_attr
+
+        if attributes:
+            prop['attributes'] = attributes
+        if current_item is not None:
+            current_item['properties'] = current_item['properties'] or []
+            current_item['properties'].append(prop)
+
+    if item_scope:
+        if prop is not None:
+            item = prop
         else:
-            xmlns = data_vocabulary.split(':', 1)[-1]
+            item = {}
+        is_place_item = False
+        if item_type:
+            if not use_rdfa:
+                item_type = item_type.split('/')[-1]
+            elif item_type.startswith(prefix):
+                item_type = item_type.split(':', 1)[-1]
+            is_place_item = item_type.lower() in PLACE_SCHEMA_TYPES
+
+        item.update({
+            'item_type': schema_type,
+            'type': item_type,
+        })
+        item['properties'] = []
+
+        if is_place_item:
+            items.append(item)
+
+        current_item = item
+
+    return current_item
+
+
+def schema_dot_org_scope_type(tag):
+    item_scope = tag.get('itemtype')
+    if not item_scope:
+        return None
+    return item_scope.split('/')[-1].lower()
 
-    queue = deque([(None, tag) for tag in soup.find_all(True, recursive=False)])
 
-    have_street = False
-    have_latlon = False
+def skip_schema_dot_org_subtree(tag):
+    '''
+    True for itemscopes of an uninteresting type and values of properties
+    the output ignores (events, offers)
+    '''
+    item_prop = tag.get('itemprop')
+    if item_prop and item_prop.lower() in SCHEMA_DOT_ORG_IGNORE_FIELDS:
+        return True
+    return schema_dot_org_scope_type(tag) in UNINTERESTING_PLACE_TYPES
 
-    while queue:
-        parent_item, tag = queue.popleft()
-        if not tag.name:
+
+def schema_dot_org_anchors(index):
+    '''
+    Outermost itemscopes with an interesting place type, in document order,
+    leaving out any under an ignored property or inside another anchor
+    '''
+    anchors = []
+    anchor_ids = set()
+
+    for tag in index.tags_with_attr('itemtype'):
+        if schema_dot_org_scope_type(tag) not in PLACE_SCHEMA_TYPES or skip_schema_dot_org_subtree(tag):
             continue
+        for parent in tag.parents:
+            if id(parent) in anchor_ids:
+                break
+            item_prop = parent.get('itemprop')
+            if item_prop and item_prop.lower() in SCHEMA_DOT_ORG_IGNORE_FIELDS:
+                break
+        else:
+            anchors.append(tag)
+            anchor_ids.add(id(tag))
 
-        current_item = parent_item
+    return anchors
 
-        item = None
-        prop = None
 
-        has_vocab = False
-        item_scope = tag.get(scope_attr)
+def extract_anchored_microdata_items(soup, index=None):
+    '''
+    Microdata items from place itemscope subtrees only (see
+    schema_dot_org_anchors), so the walk is proportional to the size of
+    the places rather than the page. Uninteresting place types and ignored
+    properties are pruned along the way.
+    '''
+    if index is None:
+        index = DocumentIndex(soup)
 
-        if not item_scope and use_rdfa:
-            item_scope = tag.get('typeof', tag.get('vocab'))
-            if not item_scope or not item_scope.startswith('{}:'.format(xmlns)):
-                item_scope = None
+    items = []
 
-        item_prop = tag.get(prop_attr)
-        item_type = item_scope
+    for anchor in schema_dot_org_anchors(index):
+        queue = deque([(None, anchor)])
 
-        if not item_prop and use_rdfa:
-            item_prop = tag.get('property')
-            if not item_prop or not item_prop.startswith('{}:'.format(xmlns)):
-                item_prop = tag.get('rel', [])
-                item_prop = [p for p in item_prop if p.startswith('{}:'.format(xmlns))]
-                if not item_prop:
-                    item_prop = None
-                else:
-                    item_prop = item_prop[0]
+        while queue:
+            parent_item, tag = queue.popleft()
+            if tag is not anchor and skip_schema_dot_org_subtree(tag):
+                continue
 
-        if item_prop:
-            prop_name = item_prop
-            if use_rdfa:
-                prop_name = prop_name.split(':', 1)[-1]
+            current_item = schema_dot_org_tag(tag, parent_item, items)
 
-            prop_name = prop_name.replace('-', '_')
+            queue.extend([(current_item, child) for child in tag.find_all(True, recursive=False)])
 
-            prop = {'name': prop_name}
-            value_attr = None
-            if not item_scope:
-                value, value_attr = tag_value_and_attr(tag)
-                if use_rdfa and not value and tag.get('content'):
-                    value, value_attr = tag['content'], 'content'
+    return [item for item in items if have_street_or_latlon(item)]
 
-                prop['value'] = value
-            attributes = {k: v for k, v in tag.attrs.iteritems() if k not in (scope_attr, prop_attr)}
-            if value_attr:
-                prop['text'] = tag.text.strip()
-                prop['value_attr'] = value_attr 
 
-            if attributes:
-                prop['attributes'] = attributes
-            if current_item is not None:
-                current_item['properties'] = current_item['properties'] or []
-                current_item['properties'].append(prop)
-
-        if item_scope:
-            if prop is not None:
-                item = prop
-            else:
-                item = {}
-            is_place_item = False
-            if item_type:
-                if not use_rdfa:
-                    item_type = item_type.split('/')[-1]
-                elif use_rdfa and xmlns and item_type.startswith('{}:'.format(xmlns)):
-                    item_type = item_type.split(':', 1)[-1]
-                is_place_item = item_type.lower() in PLACE_SCHEMA_TYPES
-
-            item.update({
-                'item_type': schema_type,
-                'type': item_type,
-            })
-            item['properties'] = []
-
-            if is_place_item:
-                items.append(item)
+def extract_schema_dot_org_items(soup, microdata=True, rdfa=True, index=None, anchored=False):
+    '''
+    Builds microdata (itemtype/itemprop) and RDFa (typeof/property in the
+    data-vocabulary namespace) items in a single breadth-first walk.
 
-            current_item = item
+    The RDFa pass also picks up itemtype/itemprop, so each tag is looked at
+    once per enabled pass, each pass keeping its own current item.
 
-        queue.extend([(current_item, child) for child in tag.find_all(True, recursive=False)])
+    With anchored, microdata comes from extract_anchored_microdata_items
+    instead of the full walk.
 
-    ret = []
+    Returns a tuple of (schema.org items, RDFa items)
+    '''
+    prefix = None
 
-    for item in items:
-        have_street = False
-        have_latlon = False
-        item_type = item.get('item_type')
-        if item_type == 'schema.org':
-            for prop in item.get('properties', []):
-                name = prop.get('name', '').lower()
-                if name == 'address':
-                    props = set([p.get('name', '').lower() for p in prop.get('properties', [])])
-                    if props & street_props:
-                        have_street = True
-                    if len(latlon_props & props) >= 2:
-                        have_latlon = True
-
-                if name == 'geo':
-                    props = set([p.get('name') for p in prop.get('properties', [])])
-                    if len(latlon_props & props) >= 2:
-                        have_latlon = True
-                if name in latlon_props:
-                    have_latlon = True
-                if name in street_props:
-                    have_street = True
-        elif item_type == 'rdfa':
-            props = set([p.get('name', '').lower() for p in item.get('properties', [])])
-
-            have_street = props & street_props
-            have_latlon = len(props & latlon_props) >= 2
-        if have_street or have_latlon:
-            ret.append(item)
+    if (rdfa or anchored) and index is None:
+        index = DocumentIndex(soup)
 
-    return ret
+    if rdfa:
+        # Verify that we have xmlns defined
+        data_vocabulary = index.data_vocabulary
+        if data_vocabulary:
+            prefix = '{}:'.format(data_vocabulary.split(':', 1)[-1])
+
+    # Without an itemtype anywhere microdata can't produce an item
+    if microdata and index is not None and not index.tags_with_attr('itemtype'):
+        microdata = False
+
+    anchored_items = None
+    if microdata and anchored:
+        anchored_items = extract_anchored_microdata_items(soup, index=index)
+        microdata = False
+
+    passes = []
+    if microdata:
+        passes.append(False)
+    if prefix:
+        passes.append(True)
+
+    items = {False: [], True: []}
+
+    if passes:
+        queue = deque([((None,) * len(passes), tag) for tag in soup.find_all(True, recursive=False)])
+
+        while queue:
+            parent_items, tag = queue.popleft()
+            if not tag.name:
+                continue
+
+            cache = {}
+            current_items = tuple([schema_dot_org_tag(tag, parent_item, items[use_rdfa],
+                                                      use_rdfa=use_rdfa, prefix=prefix, cache=cache)
+                                   for parent_item, use_rdfa in zip(parent_items, passes)])
+
+            queue.extend([(current_items, child) for child in tag.find_all(True, recursive=False)])
+
+    if anchored_items is not None:
+        microdata_items = anchored_items
+    else:
+        microdata_items = [item for item in items[False] if have_street_or_latlon(item)]
+
+    return (microdata_items,
+            [item for item in items[True] if have_street_or_latlon(item)])
+
+
+def extract_schema_dot_org(soup, use_rdfa=False, index=None, anchored=False):
+    microdata_items, rdfa_items = extract_schema_dot_org_items(soup, microdata=not use_rdfa,
+                                                               rdfa=use_rdfa, index=index,
+                                                               anchored=anchored)
+    return rdfa_items if use_rdfa else microdata_items
 
 FACEBOOK = 'facebook'
 TWITTER = 'twitter'
@@ -273,11 +386,16 @@ social_href_patterns = {
 }
 
 
-def extract_social_handles(soup):
+def extract_social_handles(soup, index=None):
+    if index is None:
+        index = DocumentIndex(soup)
+
+    links = classify_links(index)
+
     max_matches = 0
     ids = defaultdict(list)
     for pattern, site in social_href_patterns.iteritems():
-        matches = soup.select(u'a[href*="{}"]'.format(pattern))
+        matches = links[pattern]
         if len(matches) > max_matches:
             max_matches = len(matches)
         for m in matches:
@@ -288,24 +406,101 @@ def extract_social_handles(soup):
 
 value_attr_regex = re.compile("value-.*")
 
-def extract_vcards(soup):
+class VcardIndex(object):
+    '''
+    One walk over a vcard's subtree, in place of a vcard.select call per
+    hCard property. Keeps the first descendant for each class token, the
+    <a> tags (for .url a) and, for each tag in the subtree, its first .value
+    and value-* descendant, all in document order like select/find_all.
+    '''
+    def __init__(self, vcard):
+        self.by_class = {}
+        self.links = []
+        self.first_value = {}
+        self.first_value_attr = {}
+
+        for tag in vcard.descendants:
+            if not isinstance(tag, Tag):
+                continue
+            if tag.name == 'a':
+                self.links.append(tag)
+            classes = tag.get('class')
+            if not classes:
+                continue
+            if isinstance(classes, basestring):
+                classes = classes.split()
+            for c in classes:
+                if c not in self.by_class:
+                    self.by_class[c] = tag
+            if 'value' in classes:
+                self.add_to_ancestors(self.first_value, tag, vcard)
+            if any(value_attr_regex.search(c) for c in classes):
+                self.add_to_ancestors(self.first_value_attr, tag, vcard)
+
+    def add_to_ancestors(self, first, tag, vcard):
+        parent = tag.parent
+        while parent is not None and parent is not vcard:
+            # Its ancestors already have an earlier descendant
+            if id(parent) in first:
+                break
+            first[id(parent)] = tag
+            parent = parent.parent
+
+    def first_with_class(self, class_name):
+        return self.by_class.get(class_name)
+
+    def first_link_with_class(self, class_name):
+        '''
+        a.class_name
+        '''
+        for tag in self.links:
+            classes = tag.get('class') or []
+            if isinstance(classes, basestring):
+                classes = classes.split()
+            if class_name in classes:
+                return tag
+        return None
+
+    def first_link_inside_class(self, class_name):
+        '''
+        .class_name a, the ancestor can be outside the vcard as with select
+        '''
+        for tag in self.links:
+            for parent in tag.parents:
+                classes = parent.get('class') or []
+                if isinstance(classes, basestring):
+                    classes = classes.split()
+                if class_name in classes:
+                    return tag
+        return None
+
+    def value_descendant(self, tag):
+        return self.first_value.get(id(tag))
+
+    def value_attr_descendant(self, tag):
+        return self.first_value_attr.get(id(tag))
+
+
+def extract_vcards(soup, index=None):
+    if index is None:
+        index = DocumentIndex(soup)
+
     items = []
 
-    def gen_prop(name, selector):
+    def gen_prop(name, result):
         prop = None
-        if selector:
-            result = selector[0]
+        if result is not None:
             prop = {'name': name}
-            val_select = result.select('.value')
-            if val_select:
-                value, value_attr = tag_value_and_attr(val_select[0])
+            val_tag = vcard_index.value_descendant(result)
+            if val_tag is not None:
+                value, value_attr = tag_value_and_attr(val_tag)
             else:
-                val_select = result.find_all(class_=value_attr_regex)
-                if not val_select:
+                val_tag = vcard_index.value_attr_descendant(result)
+                if val_tag is None:
                     value, value_attr = tag_value_and_attr(result)
                 else:
-                    value_attr = val_select[0].attrs['class'][0].split('-', 1)[-1]
-                    value = val_select[0].attrs.get(value_attr)
+                    value_attr = val_tag.attrs['class'][0].split('-', 1)[-1]
+                    value = val_tag.attrs.get(value_attr)
                     if not value:
                         value, value_attr = tag_value_and_attr(result)
 
@@ -324,39 +519,40 @@ def extract_vcards(soup):
                 prop = None
         return prop
 
-    vcards = soup.select('.vcard')
+    vcards = index.tags_with_class('vcard')
     if not vcards:
-        vcards = soup.select('.adr')
+        vcards = index.tags_with_class('adr')
 
     for vcard in vcards:
+        vcard_index = VcardIndex(vcard)
         item = {}
         properties = []
         have_address = False
 
-        street = gen_prop('street_address', vcard.select('.street-address'))
+        street = gen_prop('street_address', vcard_index.first_with_class('street-address'))
         if street:
             properties.append(street)
             have_address = True
-        locality = gen_prop('locality', vcard.select('.locality'))
+        locality = gen_prop('locality', vcard_index.first_with_class('locality'))
         if locality:
             properties.append(locality)
-        region = gen_prop('region', vcard.select('.region'))
+        region = gen_prop('region', vcard_index.first_with_class('region'))
         if region:
             properties.append(region)
-        postal_code = gen_prop('postal_code', vcard.select('.postal-code'))
+        postal_code = gen_prop('postal_code', vcard_index.first_with_class('postal-code'))
         if postal_code:
             properties.append(postal_code)
-        country = gen_prop('country', vcard.select('.country-name'))
+        country = gen_prop('country', vcard_index.first_with_class('country-name'))
         if country:
             properties.append(country)
 
         have_latlon = False
 
-        latitude = gen_prop('latitude', vcard.select('.latitude'))
-        longitude = gen_prop('longitude', vcard.select('.longitude'))
+        latitude = gen_prop('latitude', vcard_index.first_with_class('latitude'))
+        longitude = gen_prop('longitude', vcard_index.first_with_class('longitude'))
         if not latitude and longitude:
-            latitude = gen_prop('latitude', vcard.select('.p-latitude'))
-            longtitude = gen_prop('longitude', vcard.select('.p-longitude'))
+            latitude = gen_prop('latitude', vcard_index.first_with_class('p-latitude'))
+            longtitude = gen_prop('longitude', vcard_index.first_with_class('p-longitude'))
 
         if latitude and longitude:
             properties.append(latitude)
@@ -364,24 +560,24 @@ def extract_vcards(soup):
             have_latlon = True
 
         if have_address or have_latlon:
-            org_name = gen_prop('org_name', vcard.select('.org'))
+            org_name = gen_prop('org_name', vcard_index.first_with_class('org'))
             if org_name:
                 properties.append(org_name)
-            name = gen_prop('name', vcard.select('.fn'))
+            name = gen_prop('name', vcard_index.first_with_class('fn'))
             if name:
                 properties.append(name)
-            photo = gen_prop('photo', vcard.select('.photo'))
+            photo = gen_prop('photo', vcard_index.first_with_class('photo'))
             if photo:
                 properties.append(photo)
-            vcard_url = gen_prop('url', vcard.select('.url a'))
+            vcard_url = gen_prop('url', vcard_index.first_link_inside_class('url'))
             if not vcard_url:
-                vcard_url = gen_prop('url', vcard.select('a.url'))
+                vcard_url = gen_prop('url', vcard_index.first_link_with_class('url'))
             if vcard_url:
                 properties.append(vcard_url)
-            telephone = gen_prop('telephone', vcard.select('.tel'))
+            telephone = gen_prop('telephone', vcard_index.first_with_class('tel'))
             if telephone:
                 properties.append(telephone)
-            category = gen_prop('category', vcard.select('.category'))
+            category = gen_prop('category', vcard_index.first_with_class('category'))
             if category:
                 properties.append(category)
         else:
@@ -394,22 +590,44 @@ def extract_vcards(soup):
     return items
 
 
-def extract_address_elements(soup):
+def text_with_newlines(tag):
+    '''
+    tag.text, with <br> tags as newlines the way br2nl treats them in the
+    raw HTML
+    '''
+    parts = []
+    for descendant in tag.descendants:
+        if isinstance(descendant, Tag):
+            if descendant.name == 'br':
+                parts.append(u'\n')
+        elif type(descendant) in (NavigableString, CData):
+            parts.append(descendant)
+    return u''.join(parts)
+
+
+def extract_address_elements(soup, index=None, original_html=True):
+    if index is None:
+        index = DocumentIndex(soup)
+
     items = []
 
-    for addr in soup.select('address'):
-        html = unicode(addr)
-        items.append({'item_type': ADDRESS_ELEMENT_TYPE, 'address': BeautifulSoup(html).text.strip(),
-            'original_html': html})
+    for addr in index.tags_named('address'):
+        item = {'item_type': ADDRESS_ELEMENT_TYPE, 'address': text_with_newlines(addr).strip()}
+        if original_html:
+            item['original_html'] = unicode(addr)
+        items.append(item)
     return items
 
 
-def extract_geotags(soup):
-    placename = soup.select('meta[name="geo.placename"]')
-    position = soup.select('meta[name="geo.position"]')
-    region = soup.select('meta[name="geo.region"]')
-    icbm = soup.select('meta[name="ICBM"]')
-    title = soup.select('meta[name="DC.title"]')
+def extract_geotags(soup, index=None):
+    if index is None:
+        index = DocumentIndex(soup)
+
+    placename = index.tags_with_attr_value('name', 'geo.placename', name='meta')
+    position = index.tags_with_attr_value('name', 'geo.position', name='meta')
+    region = index.tags_with_attr_value('name', 'geo.region', name='meta')
+    icbm = index.tags_with_attr_value('name', 'ICBM', name='meta')
+    title = index.tags_with_attr_value('name', 'DC.title', name='meta')
 
     item = {}
 
@@ -450,9 +668,12 @@ def extract_geotags(soup):
     return item or None
 
 
-def extract_opengraph_tags(soup):
+def extract_opengraph_tags(soup, index=None):
+    if index is None:
+        index = DocumentIndex(soup)
+
     og_attrs = {}
-    for el in soup.select('meta[property]'):
+    for el in index.tags_with_attr('property', name='meta'):
         name = el['property'].strip().lower()
         value = el.get('content', '').strip()
         if name.startswith('og:') and value and name not in og_attrs:
@@ -461,9 +682,12 @@ def extract_opengraph_tags(soup):
     return og_attrs or None
 
 
-def extract_opengraph_business_tags(soup):
+def extract_opengraph_business_tags(soup, index=None):
+    if index is None:
+        index = DocumentIndex(soup)
+
     og_attrs = {}
-    for el in soup.select('meta[property]'):
+    for el in index.tags_with_attr('property', name='meta'):
         name = el['property'].strip().lower()
         value = el.get('content', '').strip()
         if (name.startswith('business:') or name.startswith('place:')) and value and name not in og_attrs:
@@ -552,7 +776,34 @@ def opengraph_business(og_tags):
 google_maps_lat_lon_path_regex = re.compile('/maps.*?@[\d]+', re.I)
 
 
+# Per-process cache of the items parsed out of map and directions URLs, sites
+# tend to repeat the same embed on every page
+url_item_cache = LRUCache()
+
+# Cached value for URLs which don't produce an item
+NO_ITEM = object()
+
+
+def cached_url_item(kind, url, parse):
+    '''
+    parse(url) through url_item_cache. Returns a copy, the cached item is
+    shared between documents.
+    '''
+    key = (kind, url)
+    item = url_item_cache.get(key)
+    if item is None:
+        item = parse(url)
+        url_item_cache.put(key, item if item is not None else NO_ITEM)
+    if item is None or item is NO_ITEM:
+        return None
+    return dict(item)
+
+
 def item_from_google_maps_url(url):
+    return cached_url_item(GOOGLE_MAP_EMBED_TYPE, url, parse_google_maps_url)
+
+
+def parse_google_maps_url(url):
     query_param = 'q'
 
     ll_param_names = ('ll', 'sll', 'center')
@@ -631,13 +882,88 @@ google_maps_href_regex = re.compile('google\.[^/]+\/maps', re.I)
 google_maps_embed_regex = re.compile('google\.[^/]+\/maps/embed/.*/place', re.I)
 
 
-def extract_google_map_embeds(soup):
+hopstop_route_regex = re.compile('hopstop\.[^/]+/route')
+hopstop_map_regex = re.compile('hopstop\.[^/]+/map')
+
+# Link buckets filled in by classify_links
+GOOGLE_MAPS_IFRAME = 'google_maps_iframe'
+GOOGLE_MAPS_EMBED_IFRAME = 'google_maps_embed_iframe'
+GOOGLE_MAPS_LINK = 'google_maps_link'
+GOOGLE_MAPS_HREF_LINK = 'google_maps_href_link'
+GOOGLE_MAPS_IMG = 'google_maps_img'
+GOOGLE_MAPS_SHORTENED_LINK = 'google_maps_shortened_link'
+HOPSTOP_ROUTE_LINK = 'hopstop_route_link'
+HOPSTOP_MAP_LINK = 'hopstop_map_link'
+
+# Case-insensitive superset of every bucket's test, most URLs on a page
+# fail it and skip the individual checks
+interesting_link_regex = re.compile('|'.join([re.escape(p) for p in social_href_patterns] +
+                                             ['google', 'goo\.gl', 'hopstop']), re.I)
+
+
+def classify_links(index):
+    '''
+    Sorts every a[href], iframe[src] and img[src] into the buckets the link
+    based extractors read (social sites by pattern, google maps, goo.gl
+    maps and hopstop), in one pass over the links. Buckets keep document
+    order and the same tests as the per-extractor selects they replace.
+    Cached on the index.
+    '''
+    if index.link_buckets is not None:
+        return index.link_buckets
+
+    buckets = defaultdict(list)
+
+    for tag in index.tags_with_attr('href'):
+        if tag.name != 'a':
+            continue
+        href = attr_string(tag.attrs['href'])
+        if not interesting_link_regex.search(href):
+            continue
+        for pattern in social_href_patterns:
+            if pattern in href:
+                buckets[pattern].append(tag)
+        if 'maps.google' in href:
+            buckets[GOOGLE_MAPS_LINK].append(tag)
+        if google_maps_href_regex.search(href):
+            buckets[GOOGLE_MAPS_HREF_LINK].append(tag)
+        if 'goo.gl/maps' in href:
+            buckets[GOOGLE_MAPS_SHORTENED_LINK].append(tag)
+        if hopstop_route_regex.search(href):
+            buckets[HOPSTOP_ROUTE_LINK].append(tag)
+        if hopstop_map_regex.search(href):
+            buckets[HOPSTOP_MAP_LINK].append(tag)
+
+    for tag in index.tags_with_attr('src'):
+        if tag.name not in ('iframe', 'img'):
+            continue
+        src = attr_string(tag.attrs['src'])
+        if not interesting_link_regex.search(src):
+            continue
+        if tag.name == 'iframe':
+            if 'maps.google' in src:
+                buckets[GOOGLE_MAPS_IFRAME].append(tag)
+            if google_maps_embed_regex.search(src):
+                buckets[GOOGLE_MAPS_EMBED_IFRAME].append(tag)
+        elif 'maps.google' in src:
+            buckets[GOOGLE_MAPS_IMG].append(tag)
+
+    index.link_buckets = buckets
+    return buckets
+
+
+def extract_google_map_embeds(soup, index=None):
+    if index is None:
+        index = DocumentIndex(soup)
+
+    links = classify_links(index)
+
     items = []
 
-    iframe = soup.select('iframe[src*="maps.google"]')
+    iframe = links[GOOGLE_MAPS_IFRAME]
 
     if not iframe:
-        iframe = soup.find_all('iframe', src=google_maps_embed_regex)
+        iframe = links[GOOGLE_MAPS_EMBED_IFRAME]
 
     seen = set()
 
@@ -650,9 +976,9 @@ def extract_google_map_embeds(soup):
                     items.append(item)
                 seen.add(u)
 
-    a_tag = soup.select('a[href*="maps.google"]')
+    a_tag = links[GOOGLE_MAPS_LINK]
     if not a_tag:
-        a_tag = soup.find_all('a', href=google_maps_href_regex)
+        a_tag = links[GOOGLE_MAPS_HREF_LINK]
     if a_tag:
         for a in a_tag:
             u = a.get('href')
@@ -662,7 +988,7 @@ def extract_google_map_embeds(soup):
                     items.append(item)
                 seen.add(u)
 
-    static_maps = soup.select('img[src*="maps.google"]')
+    static_maps = links[GOOGLE_MAPS_IMG]
     if static_maps:
         for img in static_maps:
             u = img.get('src')
@@ -672,7 +998,7 @@ def extract_google_map_embeds(soup):
                     items.append(item)
                 seen.add(u)
 
-    shortener_a_tag = soup.select('a[href*="goo.gl/maps"]')
+    shortener_a_tag = links[GOOGLE_MAPS_SHORTENED_LINK]
     if shortener_a_tag:
         for a in a_tag:
             u = a.get('href')
@@ -690,8 +1016,11 @@ def extract_google_map_embeds(soup):
     return items
 
 
-def extract_data_lat_lon_attributes(soup):
-    lat = soup.find_all(attrs={'data-lat': True})
+def extract_data_lat_lon_attributes(soup, index=None):
+    if index is None:
+        index = DocumentIndex(soup)
+
+    lat = index.tags_with_attr('data-lat')
     items = []
     for tag in lat:
         latitude = tag['data-lat'].strip()
@@ -708,44 +1037,62 @@ def extract_data_lat_lon_attributes(soup):
     return items
 
 
-hopstop_route_regex = re.compile('hopstop\.[^/]+/route')
-hopstop_map_regex = re.compile('hopstop\.[^/]+/map')
+def extract_hopstop_direction_embeds(soup, index=None):
+    if index is None:
+        index = DocumentIndex(soup)
 
-def extract_hopstop_direction_embeds(soup):
-    hopstop_embeds = soup.find_all('a', href=hopstop_route_regex)
+    hopstop_embeds = classify_links(index)[HOPSTOP_ROUTE_LINK]
     items = []
     for tag in hopstop_embeds:
-        split = urlparse.urlsplit(tag.attrs['href'])
-        query_string = split.query
-        if query_string:
-            params = urlparse.parse_qs(query_string)
-            if params and 'address2' in params and 'zip2' in params:
-                item = {'item_type': HOPSTOP_ROUTE_TYPE,
-                        'address': params['address2'][0],
-                        'postal_code': params['zip2'][0]
-                        }
-                items.append(item)
+        item = cached_url_item(HOPSTOP_ROUTE_TYPE, tag.attrs['href'], parse_hopstop_route_url)
+        if item:
+            items.append(item)
     return items
 
 
-def extract_hopstop_map_embeds(soup):
-    hopstop_embeds = soup.find_all('a', href=hopstop_map_regex)
+def parse_hopstop_route_url(url):
+    split = urlparse.urlsplit(url)
+    query_string = split.query
+    if query_string:
+        params = urlparse.parse_qs(query_string)
+        if params and 'address2' in params and 'zip2' in params:
+            return {'item_type': HOPSTOP_ROUTE_TYPE,
+                    'address': params['address2'][0],
+                    'postal_code': params['zip2'][0]
+                    }
+    return None
+
+
+def extract_hopstop_map_embeds(soup, index=None):
+    if index is None:
+        index = DocumentIndex(soup)
+
+    hopstop_embeds = classify_links(index)[HOPSTOP_MAP_LINK]
     items = []
     for tag in hopstop_embeds:
-        split = urlparse.urlsplit(tag.attrs['href'])
-        query_string = split.query
-        if query_string:
-            params = urlparse.parse_qs(query_string)
-            if params and 'address' in params:
-                item = {'item_type': HOPSTOP_MAP_TYPE,
-                        'address': params['address'][0]}
-                items.append(item)
+        item = cached_url_item(HOPSTOP_MAP_TYPE, tag.attrs['href'], parse_hopstop_map_url)
+        if item:
+            items.append(item)
     return items
 
 
+def parse_hopstop_map_url(url):
+    split = urlparse.urlsplit(url)
+    query_string = split.query
+    if query_string:
+        params = urlparse.parse_qs(query_string)
+        if params and 'address' in params:
+            return {'item_type': HOPSTOP_MAP_TYPE,
+                    'address': params['address'][0]}
+    return None
+
+
 # Some big sites like yellowpages.com use this
-def extract_mappoint_embeds(soup):
-    pushpins = soup.find_all(attrs={'data-pushpin': True})
+def extract_mappoint_embeds(soup, index=None):
+    if index is None:
+        index = DocumentIndex(soup)
+
+    pushpins = index.tags_with_attr('data-pushpin')
     items = []
     if len(pushpins) == 1:
         try:
@@ -761,62 +1108,196 @@ def extract_mappoint_embeds(soup):
             return []
 
 
-def extract_items(soup):
-    items = []
+def extract_rdfa(soup, index=None):
+    return extract_schema_dot_org(soup, use_rdfa=True, index=index)
+
+
+def extract_microdata_and_rdfa(soup, index=None):
+    microdata_items, rdfa_items = extract_schema_dot_org_items(soup, index=index)
+    return microdata_items + rdfa_items
+
+
+def extract_anchored_microdata_and_rdfa(soup, index=None):
+    microdata_items, rdfa_items = extract_schema_dot_org_items(soup, index=index, anchored=True)
+    return microdata_items + rdfa_items
+
+
+def extract_geotag_items(soup, index=None):
+    geotags = extract_geotags(soup, index=index)
+    return [geotags] if geotags else []
+
+
+def extract_jsonld_script_items(soup, index=None):
+    '''
+    JSON-LD places from the <script> tags of a parsed document, see
+    extract_jsonld_items for the version that works on raw HTML
+    '''
+    if index is None:
+        index = DocumentIndex(soup)
+    blocks = [tag.string for tag in index.tags_named('script')
+              if 'ld+json' in attr_string(tag.get('type', '')).lower() and tag.string]
+    return jsonld_items_from_blocks(blocks)
 
-    schema_dot_org_items = extract_schema_dot_org(soup)
-    rdfa_items = extract_schema_dot_org(soup, use_rdfa=True)
-    vcards = extract_vcards(soup)
-    address_elements = extract_address_elements(soup)
-    opengraph_tags = extract_opengraph_tags(soup)
-    opengraph_business_tags = extract_opengraph_business_tags(soup)
-    google_maps_embeds = extract_google_map_embeds(soup)
-    geotags = extract_geotags(soup)
-
-    mappoint_pushpins = extract_mappoint_embeds(soup)
-    hopstop_route_embeds = extract_hopstop_direction_embeds(soup)
-    hopstop_map_embeds = extract_hopstop_map_embeds(soup)
-
-    data_latlon_attrs = extract_data_lat_lon_attributes(soup)
-
-    if geotags:
-        geotags = [geotags]
-
-    basic_metadata = extract_basic_metadata(soup)
-
-    items = list(chain(*(c for c in (schema_dot_org_items,
-                                     rdfa_items,
-                                     vcards,
-                                     address_elements,
-                                     geotags,
-                                     google_maps_embeds,
-                                     mappoint_pushpins,
-                                     hopstop_route_embeds,
-                                     hopstop_map_embeds,
-                                     data_latlon_attrs) if c)))
+
+def extract_opengraph_items(soup, index=None):
+    opengraph_tags = extract_opengraph_tags(soup, index=index)
     if opengraph_tags:
         i = opengraph_item(opengraph_tags)
         if i:
-            items.append(i)
+            return [i]
+    return []
+
 
+def extract_opengraph_business_items(soup, index=None):
+    opengraph_business_tags = extract_opengraph_business_tags(soup, index=index)
     if opengraph_business_tags:
         i = opengraph_business(opengraph_business_tags)
         if i:
-            items.append(i)
+            return [i]
+    return []
+
+
+# Extractors run by extract_items, in output order. Each one declares the
+# literal strings (matched case-insensitively against the raw HTML) at least
+# one of which has to be present for it to produce anything at all.
+extractors = []
+
+# Used in place of the registered function by extract_items(anchored=True)
+anchored_extractors = {}
+
+# Keyword arguments of extract_items each extractor accepts
+extractor_options = {}
+
+# Item types each extractor can produce, for extract_items(want=...)
+extractor_item_types = {}
+
+
+def register_extractor(name, func, triggers, anchored=None, options=(), item_types=None):
+    extractors.append((name, func, tuple(t.lower() for t in triggers)))
+    if anchored is not None:
+        anchored_extractors[name] = anchored
+    if options:
+        extractor_options[name] = tuple(options)
+    extractor_item_types[name] = tuple(item_types or [name])
+
+
+register_extractor(SCHEMA_DOT_ORG_TYPE, extract_microdata_and_rdfa, ['itemtype', 'data-vocabulary'],
+                   anchored=extract_anchored_microdata_and_rdfa,
+                   item_types=[SCHEMA_DOT_ORG_TYPE, RDFA_TYPE])
+register_extractor(JSONLD, extract_jsonld_script_items, ['ld+json'],
+                   item_types=[SCHEMA_DOT_ORG_TYPE])
+register_extractor(VCARD_TYPE, extract_vcards, ['vcard', 'adr'])
+register_extractor(ADDRESS_ELEMENT_TYPE, extract_address_elements, ['<address'],
+                   options=['original_html'])
+register_extractor(GEOTAG_TYPE, extract_geotag_items, ['geo.', 'icbm', 'dc.title'])
+register_extractor(GOOGLE_MAP_EMBED_TYPE, extract_google_map_embeds, ['maps.google', '/maps'],
+                   item_types=[GOOGLE_MAP_EMBED_TYPE, GOOGLE_MAP_SHORTENED])
+register_extractor(MAPPOINT_EMBED_TYPE, extract_mappoint_embeds, ['data-pushpin'])
+register_extractor(HOPSTOP_ROUTE_TYPE, extract_hopstop_direction_embeds, ['hopstop'])
+register_extractor(HOPSTOP_MAP_TYPE, extract_hopstop_map_embeds, ['hopstop'])
+register_extractor(DATA_LATLON_TYPE, extract_data_lat_lon_attributes, ['data-lat'])
+register_extractor(OG_TAG_TYPE, extract_opengraph_items, ['og:'])
+register_extractor(OG_BUSINESS_TAG_TYPE, extract_opengraph_business_items, ['business:', 'place:'])
+
+
+def matched_triggers(content):
+    '''
+    Set of extractor triggers present in the raw HTML, for extract_items
+    '''
+    return trigger_matcher.matches(content)
+
+trigger_matcher = LiteralMatcher((t, t, None) for t in set(chain(*(t for name, func, t in extractors))))
+
+
+def timed(timings, name, func, *args, **kw):
+    '''
+    Call func, appending (name, seconds, num_results) to timings
+    '''
+    start = time.time()
+    ret = func(*args, **kw)
+    num_results = len(ret) if isinstance(ret, (list, dict)) else 0
+    timings.append((name, time.time() - start, num_results))
+    return ret
 
-    social_handles = extract_social_handles(soup)
 
-    ret = {}
-    if items:
-        ret['items'] = items
+def extract_items(soup, triggers=None, timings=None, anchored=False, want=None,
+                  max_tags=None, max_depth=None, **options):
+    '''
+    Run the registered extractors over a parsed document.
+
+    If triggers (see matched_triggers) is given, extractors none of whose
+    triggers were found in the raw HTML are skipped, they can't find
+    anything on the page anyway.
+
+    If timings is a list, (name, seconds, num_results) is appended to it
+    for the index build and every extractor that ran.
+
+    With anchored, extractors registered with an anchored variant only
+    look at the subtrees of the places on the page, see
+    extract_anchored_microdata_items.
+
+    If want is a set of item types, only the extractors which can produce
+    one of them are run and only those item types are returned.
 
-        if social_handles:
-            ret['social'] = social_handles
+    Any other keyword arguments go to the extractors which registered them
+    as options, e.g. original_html=False for address elements.
 
-        if opengraph_tags:
-            ret['og'] = opengraph_tags
+    Social handles, OpenGraph tags and the basic metadata are only
+    extracted once there's at least one item.
 
-        if basic_metadata:
-            ret.update(basic_metadata)
+    Raises BudgetExceeded if the document has more than max_tags tags or
+    is nested deeper than max_depth.
+    '''
+    items = []
+
+    # Walk the tree once, every extractor reads from the index
+    if timings is None:
+        index = DocumentIndex(soup)
+    else:
+        index = timed(timings, 'index', DocumentIndex, soup)
+
+    check_index_budget(index, max_tags=max_tags, max_depth=max_depth)
+
+    for name, func, extractor_triggers in extractors:
+        if want is not None and not any(t in want for t in extractor_item_types[name]):
+            continue
+        if triggers is not None and not any(t in triggers for t in extractor_triggers):
+            continue
+        if anchored:
+            func = anchored_extractors.get(name, func)
+        kw = {}
+        if options and name in extractor_options:
+            kw = {k: v for k, v in options.iteritems() if k in extractor_options[name]}
+        if timings is None:
+            extracted = func(soup, index=index, **kw)
+        else:
+            extracted = timed(timings, name, func, soup, index=index, **kw)
+        if extracted:
+            if want is not None and len(extractor_item_types[name]) > 1:
+                extracted = [item for item in extracted if item.get('item_type') in want]
+            items.extend(extracted)
+
+    if not items:
+        return None
 
-        return ret
+    ret = {'items': items}
+
+    if timings is None:
+        social_handles = extract_social_handles(soup, index=index)
+        opengraph_tags = extract_opengraph_tags(soup, index=index)
+        basic_metadata = extract_basic_metadata(soup, index=index)
+    else:
+        social_handles = timed(timings, 'social', extract_social_handles, soup, index=index)
+        opengraph_tags = timed(timings, 'og', extract_opengraph_tags, soup, index=index)
+        basic_metadata = timed(timings, 'metadata', extract_basic_metadata, soup, index=index)
+
+    if social_handles:
+        ret['social'] = social_handles
+
+    if opengraph_tags:
+        ret['og'] = opengraph_tags
+
+    if basic_metadata:
+        ret.update(basic_metadata)
+
+    return ret
@@ -1,7 +1,12 @@
 # -*- coding: utf-8 -*-
+import codecs
 import re
 import urlparse
 
+from collections import OrderedDict
+
+from openvenues.utils.encoding import declared_charset, normalize_charset
+
 VCARD_TYPE = 'vcard'
 SCHEMA_DOT_ORG_TYPE = 'schema.org'
 RDFA_TYPE = 'rdfa'
@@ -39,6 +44,77 @@ br_regex = re.compile('<[\s]*br[\s]*/?[\s]*>', re.I)
 def br2nl(text):
     return br_regex.sub('\n', text)
 
+
+def decode_html(content, headers=None, valid_charsets=None):
+    '''
+    Pre-pass over a raw document: <br> tags become newlines and the bytes
+    are decoded once with the charset from the headers or <meta charset>,
+    or UTF-8 if nothing is declared, so the parser doesn't have to detect
+    the encoding again.
+
+    valid_charsets is a set of normalize_charset names. Returns (html,
+    decision) where decision says which charset was used and why. If the
+    charset isn't known, isn't in valid_charsets or doesn't decode, html is
+    the rewritten bytes and encoding detection is left to the parser.
+    '''
+    content = br2nl(content)
+    if isinstance(content, unicode):
+        return content, 'unicode'
+
+    declared, source = declared_charset(content, headers)
+    if declared is None:
+        charset, source = 'utf-8', 'default'
+    else:
+        charset = normalize_charset(declared)
+        if charset is None:
+            return content, 'unknown charset'
+
+    if valid_charsets is not None and charset not in valid_charsets:
+        return content, 'unsupported {}'.format(charset)
+
+    try:
+        if charset == 'utf-8' and content.startswith(codecs.BOM_UTF8):
+            html = content[len(codecs.BOM_UTF8):].decode(charset)
+        else:
+            html = content.decode(charset)
+    except UnicodeDecodeError:
+        return content, 'undecodable {} {}'.format(source, charset)
+    return html, '{} {}'.format(source, charset)
+
+
+DEFAULT_CACHE_SIZE = 10000
+
+
+class LRUCache(object):
+    '''
+    Bounded mapping which evicts the least recently used entry, counting
+    hits and misses
+    '''
+    def __init__(self, maxsize=DEFAULT_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        try:
+            value = self.entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        self.entries[key] = value
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self.entries.pop(key, None)
+        self.entries[key] = value
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
 latlon_splitter = re.compile('[\s]*;[\s]*')
 latlon_comma_splitter = re.compile('[\s]*,[\s]*')
 
@@ -63,6 +139,12 @@ UNINTERESTING_PLACE_TYPES = set(s.lower() for s in [
     'Continent',
 ])
 
+# Properties of a place which are never used in the output
+SCHEMA_DOT_ORG_IGNORE_FIELDS = set([
+    'events',
+    'makesoffer',
+])
+
 PLACE_SCHEMA_TYPES = dict([(s.lower(), s) for s in [
     'Organization',
     'Corporation',
@@ -739,3 +821,32 @@ OG_PLACE_TYPES = set([
     'urgent-care-24-hour',
 ])
 
+
+def have_street_or_latlon(item):
+    have_street = False
+    have_latlon = False
+    item_type = item.get('item_type')
+    if item_type == 'schema.org':
+        for prop in item.get('properties', []):
+            name = prop.get('name', '').lower()
+            if name == 'address':
+                props = set([p.get('name', '').lower() for p in prop.get('properties', [])])
+                if props & street_props:
+                    have_street = True
+                if len(latlon_props & props) >= 2:
+                    have_latlon = True
+
+            if name == 'geo':
+                props = set([p.get('name') for p in prop.get('properties', [])])
+                if len(latlon_props & props) >= 2:
+                    have_latlon = True
+            if name in latlon_props:
+                have_latlon = True
+            if name in street_props:
+                have_street = True
+    elif item_type == 'rdfa':
+        props = set([p.get('name', '').lower() for p in item.get('properties', [])])
+
+        have_street = props & street_props
+        have_latlon = len(props & latlon_props) >= 2
+    return have_street or have_latlon
@@ -6,9 +6,13 @@ from openvenues.utils.encoding import *
 from openvenues.extract.blacklist import *
 from openvenues.extract.util import *
 
-SCHEMA_DOT_ORG_IGNORE_FIELDS = set([
-    'events',
-    'makesoffer',
+# Item types the GeoJSON output is built from, see scripts/gen_geojson_venues.py
+GEOJSON_ITEM_TYPES = frozenset([
+    SCHEMA_DOT_ORG_TYPE,
+    RDFA_TYPE,
+    OG_TAG_TYPE,
+    OG_BUSINESS_TAG_TYPE,
+    VCARD_TYPE,
 ])
 
 field_map = {
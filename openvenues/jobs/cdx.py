@@ -0,0 +1,250 @@
+import gzip
+import httplib
+import logging
+import os
+import re
+import socket
+import threading
+import urlparse
+import ujson as json
+import zlib
+
+from collections import namedtuple
+
+from openvenues.jobs.warc import *
+
+logger = logging.getLogger('cdx')
+
+# One WARC record from a CDX index, enough to fetch it with a range read
+CDXRecord = namedtuple('CDXRecord', 'url, filename, offset, length, mime, status')
+
+# Field letters of a classic CDX file's " CDX ..." header line
+CDX_URL = 'a'
+CDX_MIME = 'm'
+CDX_STATUS = 's'
+CDX_LENGTH = 'S'
+CDX_OFFSET = 'V'
+CDX_FILENAME = 'g'
+
+DEFAULT_CDX_FIELDS = 'N b a m s k r M S V g'.split()
+
+# Common Crawl's public bucket
+DEFAULT_WARC_BASE = 's3://commoncrawl'
+
+
+def parse_cdx_line(line, fields=DEFAULT_CDX_FIELDS):
+    '''
+    CDXRecord for a line of a CDXJ file (urlkey timestamp {json}) like
+    Common Crawl's, or of a classic space-separated CDX file with the given
+    header fields. None for lines that don't describe a fetchable record.
+    '''
+    line = line.strip()
+    if not line or line.startswith(' CDX') or line.startswith('CDX'):
+        return None
+    i = line.find(' {')
+    if i >= 0:
+        try:
+            values = json.loads(line[i + 1:])
+        except ValueError:
+            return None
+        url = values.get('url')
+        filename = values.get('filename')
+        offset = values.get('offset')
+        length = values.get('length')
+        mime = values.get('mime')
+        status = values.get('status')
+    else:
+        values = dict(zip(fields, line.split(' ')))
+        url = values.get(CDX_URL)
+        filename = values.get(CDX_FILENAME)
+        offset = values.get(CDX_OFFSET)
+        length = values.get(CDX_LENGTH)
+        mime = values.get(CDX_MIME)
+        status = values.get(CDX_STATUS)
+    if not url or not filename or offset in (None, '-') or length in (None, '-'):
+        return None
+    return CDXRecord(url, filename, int(offset), int(length), mime, status)
+
+
+def iter_cdx(path):
+    '''
+    CDXRecords in a CDX/CDXJ file, gzipped or not
+    '''
+    f = gzip.GzipFile(path, 'rb') if path.endswith('.gz') else open(path)
+    try:
+        fields = DEFAULT_CDX_FIELDS
+        for line in f:
+            if line.startswith(' CDX') or line.startswith('CDX'):
+                fields = line.split()[1:]
+                continue
+            record = parse_cdx_line(line, fields=fields)
+            if record is not None:
+                yield record
+    finally:
+        f.close()
+
+
+class CDXFilter(object):
+    '''
+    Matches records whose host is one of domains (or a subdomain of one)
+    or whose URL matches one of the regex patterns. Only HTML captures
+    with a 200 status are matched when the CDX says what they are.
+    '''
+    def __init__(self, domains=(), patterns=()):
+        self.domains = set(d.lower().lstrip('.') for d in domains)
+        self.pattern = re.compile('|'.join('(?:{})'.format(p) for p in patterns), re.I) if patterns else None
+
+    def domain_match(self, url):
+        host = urlparse.urlsplit(url).hostname or ''
+        while host:
+            if host in self.domains:
+                return True
+            host = host.partition('.')[-1]
+        return False
+
+    def __call__(self, record):
+        if record.status and record.status != '200':
+            return False
+        if record.mime and 'html' not in record.mime.lower():
+            return False
+        if self.domains and self.domain_match(record.url):
+            return True
+        return self.pattern is not None and self.pattern.search(record.url) is not None
+
+
+class LocalRangeReader(object):
+    '''
+    Byte ranges of WARC files under a local directory, keeps the files it
+    has opened
+    '''
+    def __init__(self, base):
+        self.base = base
+        self.files = {}
+
+    def read(self, filename, offset, length):
+        f = self.files.get(filename)
+        if f is None:
+            f = self.files[filename] = open(os.path.join(self.base, filename), 'rb')
+        f.seek(offset)
+        return f.read(length)
+
+    def close(self):
+        for f in self.files.itervalues():
+            f.close()
+        self.files = {}
+
+
+class HTTPConnectionPool(object):
+    '''
+    One persistent (keep-alive) connection per host and thread, so a run
+    of range reads doesn't pay for a new connection every time
+    '''
+    def __init__(self, timeout=60):
+        self.timeout = timeout
+        self.connections = {}
+        self.lock = threading.Lock()
+
+    def get(self, scheme, netloc):
+        key = (threading.current_thread().ident, scheme, netloc)
+        with self.lock:
+            conn = self.connections.get(key)
+            if conn is None:
+                cls = httplib.HTTPSConnection if scheme == 'https' else httplib.HTTPConnection
+                conn = self.connections[key] = cls(netloc, timeout=self.timeout)
+        return conn
+
+    def discard(self, scheme, netloc):
+        with self.lock:
+            conn = self.connections.pop((threading.current_thread().ident, scheme, netloc), None)
+        if conn is not None:
+            conn.close()
+
+    def close(self):
+        with self.lock:
+            connections, self.connections = self.connections, {}
+        for conn in connections.itervalues():
+            conn.close()
+
+
+class HTTPRangeReader(object):
+    '''
+    Byte ranges of WARC files behind an HTTP or S3-compatible endpoint,
+    e.g. base=http://localhost:9000/commoncrawl, over pooled connections.
+    Not shared across processes, each one makes its own.
+    '''
+    def __init__(self, base, pool=None, retries=1):
+        self.base = base.rstrip('/')
+        self.pool = pool if pool is not None else HTTPConnectionPool()
+        self.retries = retries
+
+    def read(self, filename, offset, length):
+        url = urlparse.urlsplit('{}/{}'.format(self.base, filename.lstrip('/')))
+        headers = {'Range': 'bytes={}-{}'.format(offset, offset + length - 1)}
+        for attempt in xrange(self.retries + 1):
+            conn = self.pool.get(url.scheme, url.netloc)
+            try:
+                conn.request('GET', url.path, headers=headers)
+                response = conn.getresponse()
+                if response.status == httplib.PARTIAL_CONTENT:
+                    return response.read()
+            except (httplib.HTTPException, socket.error):
+                # Most likely a keep-alive connection the server closed
+                self.pool.discard(url.scheme, url.netloc)
+                if attempt == self.retries:
+                    raise
+                continue
+            # Don't read the body, a 200 would be the whole WARC file
+            self.pool.discard(url.scheme, url.netloc)
+            if response.status == httplib.OK:
+                raise IOError('Range requests not supported by {}'.format(url.netloc))
+            raise IOError('HTTP {} for {}'.format(response.status, url.geturl()))
+
+    def close(self):
+        self.pool.close()
+
+
+def range_reader(base, s3_endpoint=None):
+    '''
+    LocalRangeReader for a directory, HTTPRangeReader for http(s):// or
+    s3:// (looked up on s3_endpoint) bases
+    '''
+    if is_url(base):
+        return HTTPRangeReader(input_url(base, s3_endpoint))
+    return LocalRangeReader(base)
+
+
+def iter_cdx_html_responses(records, reader, errors=None):
+    '''
+    (url, HTTP headers, body) for the HTML responses among CDX records,
+    each one fetched with a single range read of its gzip member.
+
+    A record that can't be read (missing file, HTTP error) or decompressed
+    (wrong offset or length in the CDX) is logged and skipped, and counted
+    in errors under 'read' or 'decompress' if it's given (a
+    defaultdict(int)).
+    '''
+    for record in records:
+        stage = 'read'
+        try:
+            data = reader.read(record.filename, record.offset, record.length)
+            stage = 'decompress'
+            data = zlib.decompress(data, GZIP_WBITS)
+        except (IOError, httplib.HTTPException, zlib.error) as e:
+            logger.error('Error in {} of {} from {} at {}: {}'.format(stage, record.url, record.filename,
+                                                                    record.offset, e))
+            if errors is not None:
+                errors[stage] += 1
+            continue
+        response = html_response(data)
+        if response is not None:
+            yield response
+
+
+def matching_cdx_records(paths, cdx_filter):
+    '''
+    Records in the CDX files cdx_filter matches, sorted by WARC file and
+    offset so they're read front to back
+    '''
+    records = [record for path in paths for record in iter_cdx(path) if cdx_filter(record)]
+    records.sort(key=lambda record: (record.filename, record.offset))
+    return records
@@ -0,0 +1,342 @@
+import argparse
+import logging
+import multiprocessing
+import os
+import Queue
+import sys
+import time
+import traceback
+import ujson as json
+
+from collections import defaultdict
+
+from openvenues.jobs.cdx import *
+from openvenues.jobs.microdata import *
+from openvenues.jobs.prefetch import *
+from openvenues.jobs.stats import *
+from openvenues.jobs.warc import *
+
+logger = logging.getLogger('local_job')
+
+STAGE_READ = 'read'
+STAGE_FILTER = 'filter'
+STAGE_PARSE = 'parse'
+STAGE_EXTRACT = 'extract'
+STAGE_WRITE = 'write'
+# Records that raised in filter, parse or extract, with the time lost on them
+STAGE_ERRORS = 'errors'
+
+RESULT_POLL_INTERVAL = 5
+
+INPUT_WARC = 'warc'
+INPUT_CDX = 'cdx'
+
+# CDX records fetched per task
+DEFAULT_CDX_TASK_RECORDS = 1000
+
+
+class LocalMicrodataJob(MicrodataJob):
+    '''
+    MicrodataJob with its counters kept in memory instead of reported to
+    Hadoop, so they can be sent back from a local worker process
+    '''
+    def __init__(self, *args, **kw):
+        super(LocalMicrodataJob, self).__init__(*args, **kw)
+        self.local_counters = defaultdict(int)
+
+    def add_counter(self, group, counter, amount):
+        self.local_counters[(group, counter)] += amount
+
+    @property
+    def counter_buffer(self):
+        if self._counter_buffer is None:
+            self._counter_buffer = CounterBuffer(self.add_counter,
+                                                 flush_records=self.options.counter_flush_records,
+                                                 flush_interval=self.options.counter_flush_interval)
+        return self._counter_buffer
+
+
+def run_records(job, records, out, stats):
+    '''
+    Same filter -> parse_content -> process_html path the Hadoop mapper
+    runs, for an iterable of (url, headers, content), writing url\tjson
+    lines to out and timing each stage into stats.
+
+    A record that raises is logged with its URL, counted in the errors
+    stage and skipped, the rest of the file still runs.
+    '''
+    records = iter(records)
+    while True:
+        start = time.time()
+        try:
+            url, headers, content = next(records)
+        except StopIteration:
+            break
+        num_bytes = len(content)
+        now = time.time()
+        stats.add(STAGE_READ, num_bytes, now - start)
+
+        record_start = start = now
+        try:
+            match = job.filter(url, headers, content)
+            now = time.time()
+            stats.add(STAGE_FILTER, num_bytes, now - start)
+            if not match:
+                continue
+
+            start = now
+            soup = job.parse_content(content)
+            now = time.time()
+            stats.add(STAGE_PARSE, num_bytes, now - start)
+
+            start = now
+            results = list(job.process_html(url, headers, content, soup))
+            now = time.time()
+            stats.add(STAGE_EXTRACT, num_bytes, now - start)
+        except Exception:
+            logger.error('Error on {}: {}'.format(url, traceback.format_exc()))
+            stats.add(STAGE_ERRORS, num_bytes, time.time() - record_start)
+            continue
+
+        start = now
+        written = 0
+        for key, value in results:
+            line = '{}\t{}\n'.format(json.dumps(key), json.dumps(value))
+            out.write(line)
+            written += len(line)
+        stats.add(STAGE_WRITE, written, time.time() - start, records=len(results))
+
+
+def report_prefetch_stats(job, stats):
+    job.increment_counter('prefetch', 'records', stats.records)
+    job.increment_counter('prefetch', 'queue depth sum', stats.depth_total)
+    job.increment_counter('prefetch', 'empty queue gets', stats.empty_gets)
+    job.increment_counter('prefetch', 'consumer stall ms', int(stats.consumer_stall_seconds * 1000))
+    job.increment_counter('prefetch', 'producer stall ms', int(stats.producer_stall_seconds * 1000))
+
+
+def run_reader(read, output_path, job_args=(), prefetch=0):
+    '''
+    Run the job over the records read() returns, returns (StageStats,
+    counters).
+
+    With prefetch, up to that many records are read and decompressed
+    ahead in a background thread. The read stage then only measures how
+    long extraction waited for input.
+    '''
+    job = LocalMicrodataJob(args=list(job_args))
+    stats = StageStats()
+    prefetcher = None
+    if prefetch:
+        prefetcher = records = Prefetcher([read], depth=prefetch)
+    else:
+        records = read()
+    with open(output_path, 'w') as out:
+        run_records(job, records, out, stats)
+    if prefetcher is not None:
+        report_prefetch_stats(job, prefetcher.stats)
+    job.mapper_final()
+    return stats, dict(job.local_counters)
+
+
+def run_warc_file(path, output_path, job_args=(), index=None, prefetch=0, s3_endpoint=None):
+    '''
+    Run the job over one WARC file, or the records of it in index, see
+    run_reader
+    '''
+    def read():
+        return iter_html_responses(path, index=index, s3_endpoint=s3_endpoint)
+    return run_reader(read, output_path, job_args=job_args, prefetch=prefetch)
+
+
+def run_cdx_records(cdx_records, warc_base, output_path, job_args=(), prefetch=0, s3_endpoint=None):
+    '''
+    Run the job over the WARC records listed in CDX records, fetched with
+    range reads from the files under warc_base (a directory or an
+    http(s):// or s3:// prefix), see run_reader
+    '''
+    errors = defaultdict(int)
+    def read():
+        reader = range_reader(warc_base, s3_endpoint=s3_endpoint)
+        try:
+            for response in iter_cdx_html_responses(cdx_records, reader, errors=errors):
+                yield response
+        finally:
+            reader.close()
+    stats, counters = run_reader(read, output_path, job_args=job_args, prefetch=prefetch)
+    for error, count in errors.iteritems():
+        counters[('cdx', 'fetch errors: {}'.format(error))] = count
+    return stats, counters
+
+
+def worker_main(tasks, results, job_args, options):
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        i, kind, path, records, output_path = task
+        try:
+            if kind == INPUT_CDX:
+                stats, counters = run_cdx_records(records, path, output_path, job_args, **options)
+            else:
+                stats, counters = run_warc_file(path, output_path, job_args, index=records, **options)
+            results.put((i, stats, counters, None))
+        except Exception:
+            results.put((i, None, None, traceback.format_exc()))
+
+
+def run_local(paths, output_dir, workers=None, job_args=(), split=1, prefetch=0, s3_endpoint=None,
+              cdx_records=None, warc_base=DEFAULT_WARC_BASE, cdx_task_records=DEFAULT_CDX_TASK_RECORDS):
+    '''
+    Run the job over WARC files on all cores, one file at a time per
+    worker process, writing a part-NNNNN file per input to output_dir.
+    Files can be local or URLs, see open_input, and prefetch is passed on
+    to run_warc_file.
+
+    With split > 1, each .warc.gz is cut into that many ranges of records
+    using its offset index (built and saved next to it if needed), so a
+    few big files can keep every core busy.
+
+    cdx_records (e.g. from matching_cdx_records) are fetched from the WARC
+    files under warc_base with one range read each, cdx_task_records per
+    task, instead of reading whole files.
+
+    Returns (StageStats, counters, failed paths) summed over all files.
+    '''
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+
+    inputs = []
+    for path in paths:
+        if split > 1 and path.endswith('.gz') and not is_url(path):
+            inputs.extend((INPUT_WARC, path, index) for index in split_warc_index(warc_index(path), split))
+        else:
+            inputs.append((INPUT_WARC, path, None))
+    if cdx_records:
+        for i in xrange(0, len(cdx_records), cdx_task_records):
+            inputs.append((INPUT_CDX, warc_base, cdx_records[i:i + cdx_task_records]))
+
+    tasks = multiprocessing.Queue()
+    results = multiprocessing.Queue()
+    for i, (kind, path, records) in enumerate(inputs):
+        tasks.put((i, kind, path, records, os.path.join(output_dir, 'part-{:05d}'.format(i))))
+
+    # Not a Pool, whose daemonic workers couldn't start isolated parsers
+    processes = []
+    for i in xrange(min(workers, len(inputs))):
+        tasks.put(None)
+        options = {'prefetch': prefetch, 's3_endpoint': s3_endpoint}
+        p = multiprocessing.Process(target=worker_main, args=(tasks, results, list(job_args), options))
+        p.start()
+        processes.append(p)
+
+    stats = StageStats()
+    counters = defaultdict(int)
+    failed = []
+    remaining = set(xrange(len(inputs)))
+    while remaining:
+        try:
+            i, file_stats, file_counters, error = results.get(timeout=RESULT_POLL_INTERVAL)
+        except Queue.Empty:
+            if not any(p.is_alive() for p in processes):
+                # Killed outright (e.g. by the OOM killer) before reporting
+                lost = [inputs[i][1] for i in sorted(remaining)]
+                logger.error('Workers exited without finishing {}'.format(lost))
+                failed.extend(lost)
+                break
+            continue
+        remaining.discard(i)
+        path = inputs[i][1]
+        if error is not None:
+            logger.error('Error on {}: {}'.format(path, error))
+            failed.append(path)
+            continue
+        logger.info('Finished {}'.format(path))
+        stats.update(file_stats)
+        for key, value in file_counters.iteritems():
+            counters[key] += value
+
+    for p in processes:
+        p.join()
+    return stats, dict(counters), failed
+
+
+def print_stats(stats, counters, wall_seconds, f=sys.stdout):
+    f.write('{:<10} {:>10} {:>10} {:>10} {:>12} {:>10}\n'.format('stage', 'records', 'MB', 'seconds',
+                                                                 'records/s', 'MB/s'))
+    for stage in stats.stages:
+        records_per_second, bytes_per_second = stats.rates(stage)
+        f.write('{:<10} {:>10} {:>10.1f} {:>10.2f} {:>12.1f} {:>10.2f}\n'.format(
+            stage, stats.records[stage], stats.bytes[stage] / 1048576.0, stats.seconds[stage],
+            records_per_second or 0.0, (bytes_per_second or 0.0) / 1048576.0))
+
+    # Stage rates are per core, this is what the whole box did
+    records = stats.records[STAGE_READ]
+    num_bytes = stats.bytes[STAGE_READ]
+    if wall_seconds:
+        f.write('{:<10} {:>10} {:>10.1f} {:>10.2f} {:>12.1f} {:>10.2f}\n'.format(
+            'wall', records, num_bytes / 1048576.0, wall_seconds,
+            records / wall_seconds, num_bytes / wall_seconds / 1048576.0))
+
+    prefetched = counters.get(('prefetch', 'records'))
+    if prefetched:
+        f.write('prefetch mean queue depth {:.1f}\n'.format(
+            float(counters.get(('prefetch', 'queue depth sum'), 0)) / prefetched))
+
+    f.write('\n')
+    for (group, counter), value in sorted(counters.iteritems()):
+        f.write('{}\t{}\t{}\n'.format(group, counter, value))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run MicrodataJob over local WARC files on all cores. '
+                                                 'Arguments after -- are passed to the job.')
+    parser.add_argument('paths', nargs='*', help='WARC or WARC.gz files, local or http(s):// or s3:// URLs')
+    parser.add_argument('-o', '--output-dir', default='.')
+    parser.add_argument('-w', '--workers', type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('-s', '--split', type=int, default=1,
+                        help='Split each .warc.gz into this many tasks using its offset index')
+    parser.add_argument('-p', '--prefetch', type=int, default=0,
+                        help='Records to read and decompress ahead in a background thread')
+    parser.add_argument('--s3-endpoint', help='S3-compatible endpoint for s3:// paths, e.g. http://localhost:9000')
+    parser.add_argument('--cdx', action='append', default=[],
+                        help='CDX/CDXJ index file, its matching records are fetched with range reads')
+    parser.add_argument('--domain', action='append', default=[],
+                        help='Fetch CDX records on this domain or its subdomains')
+    parser.add_argument('--url-pattern', action='append', default=[],
+                        help='Fetch CDX records whose URL matches this regex')
+    parser.add_argument('--warc-base', default=DEFAULT_WARC_BASE,
+                        help='Directory or http(s):// or s3:// prefix the CDX filenames are under')
+    parser.add_argument('--cdx-task-records', type=int, default=DEFAULT_CDX_TASK_RECORDS)
+
+    argv = sys.argv[1:] if argv is None else argv
+    job_args = []
+    if '--' in argv:
+        i = argv.index('--')
+        argv, job_args = argv[:i], argv[i + 1:]
+    args = parser.parse_args(argv)
+    if not args.paths and not args.cdx:
+        parser.error('No WARC files or CDX files given')
+    if args.cdx and not args.domain and not args.url_pattern:
+        parser.error('--cdx needs a --domain or --url-pattern')
+
+    if not os.path.exists(args.output_dir):
+        os.makedirs(args.output_dir)
+
+    start = time.time()
+    cdx_records = None
+    if args.cdx:
+        cdx_records = matching_cdx_records(args.cdx, CDXFilter(args.domain, args.url_pattern))
+        logger.info('{} matching CDX records'.format(len(cdx_records)))
+    stats, counters, failed = run_local(args.paths, args.output_dir, workers=args.workers, job_args=job_args,
+                                        split=args.split, prefetch=args.prefetch, s3_endpoint=args.s3_endpoint,
+                                        cdx_records=cdx_records, warc_base=args.warc_base,
+                                        cdx_task_records=args.cdx_task_records)
+    print_stats(stats, counters, time.time() - start)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    main()
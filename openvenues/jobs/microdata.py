@@ -1,6 +1,16 @@
+import random
+import time
+
 from common_crawl.base import *
+from openvenues.extract.budget import *
+from openvenues.extract.head import *
+from openvenues.extract.jsonld import *
+from openvenues.extract.parsers import *
+from openvenues.extract.prefilter import *
 from openvenues.extract.soup import *
 from openvenues.extract.util import *
+from openvenues.format.geojson import GEOJSON_ITEM_TYPES
+from openvenues.jobs.stats import *
 
 logger = logging.getLogger('microdata_job')
 
@@ -24,14 +34,248 @@ patterns = [
     'data-lon',
     'data-lng',
     'data-long',
+    'application/ld\+json',
 ]
 
 contains_microdata_regex = re.compile('|'.join(patterns), re.I | re.UNICODE)
 
+# Patterns satisfied by <meta> tags alone, see extract_head_items
+head_patterns = set([
+    'og:latitude',
+    'og:postal_code',
+    'og:street_address',
+    'business:contact_data:street_address',
+    'business:contact_data:postal_code',
+    'place:location:latitude',
+    'geo\.position',
+    'icbm',
+])
+
+# JSON-LD is read from the raw <script> blocks, see extract_head_items
+jsonld_patterns = set([
+    'application/ld\+json',
+])
+
+# Anything that could make one of the tree-based extractors fire. If none
+# of these are present (outside of JSON-LD) the page can skip the
+# BeautifulSoup parse.
+tree_patterns = [p for p in patterns if p not in head_patterns and p not in jsonld_patterns] + [
+    'data-vocabulary',
+    'adr',
+    'hopstop',
+    'data-pushpin',
+]
+
+requires_tree_regex = re.compile('|'.join(tree_patterns), re.I | re.UNICODE)
+
+# Literal needle for each regex in patterns which isn't already a plain
+# literal. The google maps regex isn't reducible to a literal so it's
+# confirmed with the original regex when the literal is present.
+pattern_literals = {
+    'maps\.google': ('maps.google', None),
+    'google\.[^/]+\/maps': ('/maps', re.compile('google\.[^/]+\/maps', re.I)),
+    '(?:goo\.gl)/maps': ('goo.gl/maps', None),
+    'geo\.position': ('geo.position', None),
+    'application/ld\+json': ('application/ld+json', None),
+}
+
+
+def pattern_needles(patterns):
+    for p in patterns:
+        literal, confirm = pattern_literals.get(p, (p, None))
+        yield p, literal, confirm
+
+# Same decisions as contains_microdata_regex/requires_tree_regex, but on the
+# raw bytes, reporting which entry in patterns matched
+microdata_prefilter = LiteralMatcher(pattern_needles(patterns))
+requires_tree_prefilter = LiteralMatcher(pattern_needles(tree_patterns))
+
 
 class MicrodataJob(CommonCrawlJob):
     valid_charsets = set(['utf-8', 'iso-8859-1', 'latin-1', 'ascii'])
 
+    # Set by filter for records which only matched head/meta patterns
+    head_only = False
+    # Set by filter, extractor triggers present in the current record
+    triggers = None
+    # Set by filter for records over --window-threshold-bytes
+    windowed = False
+    # Set by filter, record failed the structural prefilter but was let
+    # through to measure stage 2 false negatives
+    prefilter_audit = False
+    # Set by filter with --prefilter-stats, every pattern the record matched
+    record_patterns = None
+    record_start = None
+    # Set by parse_content with --extractor-stats
+    record_timings = None
+    # Set by filter/parse_content for the per-document budgets
+    record_url = None
+    record_headers = None
+    record_deadline = None
+
+    _parser = None
+    _want = None
+    _charsets = None
+    _pattern_stats = None
+    _extractor_stats = None
+    _last_stats_flush = None
+    _counter_buffer = None
+    _quarantine = None
+
+    def configure_options(self):
+        super(MicrodataJob, self).configure_options()
+        self.add_passthrough_option('--parser', default=HTML_PARSER,
+                                    choices=[HTML_PARSER, LXML_PARSER, HTML5_PARSER],
+                                    help='HTML parser, anything but html.parser runs in an isolated worker process')
+        self.add_passthrough_option('--parser-memory-limit', type='int', default=DEFAULT_MEMORY_LIMIT / (1024 * 1024),
+                                    help='Address space limit in MB for isolated parser workers')
+        self.add_passthrough_option('--parser-timeout', type='int', default=DEFAULT_TIMEOUT,
+                                    help='Seconds an isolated parser worker gets per document')
+        self.add_passthrough_option('--prefilter-audit-rate', type='float', default=0.0,
+                                    help='Fraction of records rejected by the structural prefilter to parse anyway')
+        self.add_passthrough_option('--anchored-microdata', action='store_true', default=False,
+                                    help='Only walk the subtrees of place itemscopes for schema.org microdata')
+        self.add_passthrough_option('--no-address-html', action='store_false', dest='address_html', default=True,
+                                    help="Leave out <address> elements' original_html")
+        self.add_passthrough_option('--item-types', default=None,
+                                    help='Comma-separated item types to extract (default all), "geojson" for the ones the GeoJSON build uses')
+        self.add_passthrough_option('--max-document-bytes', type='int', default=0,
+                                    help='Quarantine documents larger than this instead of parsing them, 0 for no limit')
+        self.add_passthrough_option('--max-tags', type='int', default=0,
+                                    help='Quarantine documents with more tags than this, 0 for no limit. '
+                                         'Checked while the tree is built, except with html5-parser')
+        self.add_passthrough_option('--max-depth', type='int', default=0,
+                                    help='Quarantine documents nested deeper than this, 0 for no limit. '
+                                         'Checked while the tree is built, except with html5-parser')
+        self.add_passthrough_option('--document-time-limit', type='float', default=0,
+                                    help='Seconds of parse + extract per document before quarantining it, 0 for no limit')
+        self.add_passthrough_option('--window-threshold-bytes', type='int', default=0,
+                                    help='Above this size only parse <head> and the bytes around prefilter hits, 0 to always parse everything')
+        self.add_passthrough_option('--window-bytes', type='int', default=DEFAULT_HIT_WINDOW,
+                                    help='Bytes kept on either side of a prefilter hit in oversized documents')
+        self.add_passthrough_option('--prefilter-stats', action='store_true', default=False,
+                                    help='Record matches, yield and parse+extract time per prefilter pattern')
+        self.add_passthrough_option('--extractor-stats', action='store_true', default=False,
+                                    help='Time every extractor, reported as counters and a histogram side output')
+        self.add_passthrough_option('--stats-flush-interval', type='int', default=60,
+                                    help='Seconds between flushes of the extractor stats')
+        self.add_passthrough_option('--counter-flush-records', type='int', default=1000,
+                                    help='Report buffered counters every N records')
+        self.add_passthrough_option('--counter-flush-interval', type='int', default=60,
+                                    help='Report buffered counters at least every N seconds')
+        self.add_passthrough_option('--side-output-dir', default='.',
+                                    help='Directory for per-task side output files (e.g. prefilter stats)')
+
+    @property
+    def parser(self):
+        if self._parser is None:
+            self._parser = parser_backend(self.options.parser,
+                                          memory_limit=self.options.parser_memory_limit * 1024 * 1024,
+                                          timeout=self.options.parser_timeout)
+        return self._parser
+
+    @property
+    def want(self):
+        if self._want is None and self.options.item_types:
+            want = set()
+            for item_type in self.options.item_types.split(','):
+                item_type = item_type.strip()
+                if item_type == 'geojson':
+                    want |= GEOJSON_ITEM_TYPES
+                elif item_type:
+                    want.add(item_type)
+            self._want = want
+        return self._want
+
+    @property
+    def charsets(self):
+        if self._charsets is None:
+            self._charsets = set(normalize_charset(c) for c in self.valid_charsets)
+        return self._charsets
+
+    def quarantine(self, reason, num_bytes):
+        '''
+        Skip the current document, logging its URL to the quarantine side
+        output so it can be reprocessed separately
+        '''
+        self.increment_counter('commoncrawl', 'budget exceeded: {}'.format(reason), 1)
+        if self._quarantine is None:
+            self._quarantine = SideOutputLog(self.options.side_output_dir, 'quarantine')
+        self._quarantine.write({'url': self.record_url, 'reason': reason, 'bytes': num_bytes})
+
+    def windowed_content(self, content):
+        '''
+        The <head> section plus the byte windows around prefilter hits in
+        the rest of the document
+        '''
+        if isinstance(content, unicode):
+            content = content.encode('utf-8')
+        head = head_section(content)
+        parts = [head]
+        for start, end in microdata_prefilter.hit_windows(content, window=self.options.window_bytes):
+            start = max(start, len(head))
+            if end > start:
+                parts.append(content[start:end])
+        return ''.join(parts)
+
+    def report_tier(self, ret):
+        if self.head_only:
+            tier = 'head-only'
+        elif self.windowed:
+            tier = 'windowed'
+        else:
+            tier = 'full'
+        self.increment_counter('commoncrawl', 'tier {} records'.format(tier), 1)
+        items = ret.get('items') if ret else None
+        if items:
+            self.increment_counter('commoncrawl', 'tier {} yielded'.format(tier), 1)
+            self.increment_counter('commoncrawl', 'tier {} items'.format(tier), len(items))
+
+    def time_remaining(self):
+        if self.record_deadline is None:
+            return None
+        return self.record_deadline - time.time()
+
+    @property
+    def counter_buffer(self):
+        if self._counter_buffer is None:
+            # Flushed at exit too, for steps that don't run mapper_final
+            self._counter_buffer = CounterBuffer(super(MicrodataJob, self).increment_counter,
+                                                 flush_records=self.options.counter_flush_records,
+                                                 flush_interval=self.options.counter_flush_interval,
+                                                 flush_at_exit=True)
+        return self._counter_buffer
+
+    def increment_counter(self, group, counter, amount=1):
+        # Every counter update is a line on stderr with Hadoop streaming,
+        # merge them and report in batches instead
+        self.counter_buffer.increment(group, counter, amount)
+
+    @property
+    def pattern_stats(self):
+        if self._pattern_stats is None:
+            self._pattern_stats = PatternStats()
+        return self._pattern_stats
+
+    @property
+    def extractor_stats(self):
+        if self._extractor_stats is None:
+            self._extractor_stats = ExtractorStats()
+            self._last_stats_flush = time.time()
+        return self._extractor_stats
+
+    def flush_extractor_stats(self):
+        for counter, amount in self._extractor_stats.drain():
+            self.increment_counter('extractor timing', counter, amount)
+        write_side_output(self.options.side_output_dir, 'extractor_stats',
+                          self._extractor_stats.to_dict())
+        self._last_stats_flush = time.time()
+
+    def report_timings(self, timings):
+        self.extractor_stats.add(timings)
+        if time.time() - self._last_stats_flush >= self.options.stats_flush_interval:
+            self.flush_extractor_stats()
+
     def report_vcard_item(self, item):
         have_latlon = False
         for prop in item.get('properties'):
@@ -87,15 +331,133 @@ class MicrodataJob(CommonCrawlJob):
             self.increment_counter('commoncrawl', 'url type {}'.format(k),
                                    len(vals))
 
+    def report_pattern_stats(self, patterns, yielded, seconds):
+        self.pattern_stats.record_parse(patterns, yielded, seconds)
+        millis = int(seconds * 1000)
+        for p in patterns:
+            self.increment_counter('prefilter patterns', '{} parsed'.format(p), 1)
+            self.increment_counter('prefilter patterns', '{} parse ms'.format(p), millis)
+            if yielded:
+                self.increment_counter('prefilter patterns', '{} yielded'.format(p), 1)
+
     def parse_content(self, content):
-        content = br2nl(content)
-        return BeautifulSoup(content, 'html.parser')
+        self.record_deadline = None
+        if self.options.document_time_limit:
+            self.record_deadline = time.time() + self.options.document_time_limit
+        try:
+            with time_limit(self.time_remaining()):
+                return self.parse_document(content)
+        except BudgetExceeded as e:
+            self.quarantine(e.reason, len(content))
+            return None
+
+    def parse_document(self, content):
+        if self.record_patterns:
+            self.record_start = time.time()
+        self.record_timings = [] if self.options.extractor_stats else None
+        if self.windowed:
+            num_bytes = len(content)
+            content = self.windowed_content(content)
+            self.increment_counter('commoncrawl', 'tier windowed bytes skipped', num_bytes - len(content))
+        content, charset = decode_html(content, headers=self.record_headers, valid_charsets=self.charsets)
+        self.increment_counter('charset', charset, 1)
+        if self.head_only:
+            index = parse_head(content)
+            if index is not None:
+                return index
+            self.head_only = False
+        doc = self.parser.parse(content, triggers=self.triggers, timings=self.record_timings,
+                                anchored=self.options.anchored_microdata, want=self.want,
+                                max_tags=self.options.max_tags, max_depth=self.options.max_depth,
+                                original_html=self.options.address_html)
+        if self.parser.last_failure:
+            self.increment_counter('commoncrawl', 'parser fallback: {}'.format(self.parser.last_failure), 1)
+        return doc
 
     def filter(self, url, headers, content):
-        return contains_microdata_regex.search(content)
+        self.counter_buffer.tick()
+
+        # Stage 1: any pattern anywhere, stage 2: a pattern inside a tag
+        stage1_match, match = microdata_prefilter.search_structural(content)
+        if stage1_match is None:
+            return None
+
+        self.increment_counter('commoncrawl', 'prefilter stage 1 matched', 1)
+        self.prefilter_audit = False
+        self.record_patterns = None
+        if self.options.prefilter_stats:
+            # Full scan, search_structural stops at the first hit
+            self.record_patterns = microdata_prefilter.matches(content)
+            self.pattern_stats.record_match(self.record_patterns)
+            for p in self.record_patterns:
+                self.increment_counter('prefilter patterns', '{} matched'.format(p), 1)
+        if match is not None:
+            self.increment_counter('commoncrawl', 'prefilter stage 2 matched', 1)
+        else:
+            self.increment_counter('commoncrawl', 'prefilter stage 2 rejected', 1)
+            if not self.options.prefilter_audit_rate or random.random() >= self.options.prefilter_audit_rate:
+                # Counted as a stage 1 false positive, only audits can tell otherwise
+                self.increment_counter('commoncrawl', 'prefilter stage 1 false positives', 1)
+                return None
+            self.increment_counter('commoncrawl', 'prefilter stage 2 audited', 1)
+            self.prefilter_audit = True
+            match = stage1_match
+
+        self.record_url = url
+        self.record_headers = headers
+        if self.options.max_document_bytes and len(content) > self.options.max_document_bytes:
+            self.quarantine(BUDGET_BYTES, len(content))
+            return None
+
+        # Only og:/geo.position/icbm style hits or JSON-LD, no need to build a tree
+        self.head_only = requires_tree_prefilter.search(without_jsonld(content)) is None
+        self.windowed = not self.head_only and \
+            bool(self.options.window_threshold_bytes) and len(content) > self.options.window_threshold_bytes
+        self.triggers = matched_triggers(content)
+        return match
+
+    def extract(self, soup):
+        if isinstance(soup, DocumentIndex):
+            self.increment_counter('commoncrawl', 'head-only records', 1)
+            if self.record_timings is None:
+                return extract_head_items(soup, want=self.want)
+            return timed(self.record_timings, 'head', extract_head_items, soup, want=self.want)
+        return self.parser.extract(soup, triggers=self.triggers, timings=self.record_timings,
+                                   anchored=self.options.anchored_microdata, want=self.want,
+                                   max_tags=self.options.max_tags, max_depth=self.options.max_depth,
+                                   original_html=self.options.address_html)
 
     def process_html(self, url, headers, content, soup):
-        ret = extract_items(soup)
+        # Quarantined in parse_content
+        if soup is None:
+            return
+
+        try:
+            with time_limit(self.time_remaining()):
+                ret = self.extract(soup)
+        except BudgetExceeded as e:
+            self.quarantine(e.reason, len(content))
+            return
+
+        self.report_tier(ret)
+
+        if self.record_timings:
+            self.report_timings(self.record_timings)
+
+        if self.prefilter_audit:
+            if ret:
+                self.increment_counter('commoncrawl', 'prefilter stage 2 false negatives', 1)
+            else:
+                self.increment_counter('commoncrawl', 'prefilter stage 1 false positives', 1)
+        elif not ret:
+            self.increment_counter('commoncrawl', 'prefilter stage 1 false positives', 1)
+            self.increment_counter('commoncrawl', 'prefilter stage 2 false positives', 1)
+
+        if self.record_patterns and self.record_start is not None:
+            self.report_pattern_stats(self.record_patterns, bool(ret and ret.get('items')),
+                                      time.time() - self.record_start)
+            self.record_start = None
+
         if not ret:
             return
         items = ret.get('items')
@@ -109,6 +471,35 @@ class MicrodataJob(CommonCrawlJob):
         yield url, ret
         self.increment_counter('commoncrawl', 'filtered records', 1)
 
+    def mapper_final(self):
+        # Only covers in-process extraction, isolated parser workers keep their own
+        if url_item_cache.hits or url_item_cache.misses:
+            self.increment_counter('url item cache', 'hits', url_item_cache.hits)
+            self.increment_counter('url item cache', 'misses', url_item_cache.misses)
+        skipped = jsonld_stats.drain()
+        if skipped:
+            self.increment_counter('commoncrawl', 'jsonld blocks skipped (too deep)', skipped)
+        if self._extractor_stats is not None:
+            self.flush_extractor_stats()
+        if self._pattern_stats is not None:
+            path = write_side_output(self.options.side_output_dir, 'prefilter_stats',
+                                     self._pattern_stats.to_dict())
+            logger.info('Wrote prefilter stats to {}'.format(path))
+        if self._quarantine is not None:
+            self._quarantine.close()
+
+        parent_final = getattr(super(MicrodataJob, self), 'mapper_final', None)
+        if parent_final is not None:
+            try:
+                parent_final()
+            except NotImplementedError:
+                # MRJob's placeholder, nothing in CommonCrawlJob to run
+                pass
+
+        # Last, so counters the parent increments go out too
+        if self._counter_buffer is not None:
+            self._counter_buffer.flush()
+
 
 if __name__ == '__main__':
     MicrodataJob.run()
@@ -0,0 +1,139 @@
+import logging
+import Queue
+import sys
+import threading
+import time
+
+logger = logging.getLogger('prefetch')
+
+DEFAULT_PREFETCH_DEPTH = 64
+
+# How often blocked threads check whether the consumer has gone away
+POLL_INTERVAL = 0.1
+
+RECORD = 0
+SOURCE_DONE = 1
+SOURCE_ERROR = 2
+
+
+class PrefetchStats(object):
+    '''
+    Queue depth seen by the consumer on every get, time the consumer spent
+    waiting on an empty queue and time producers spent blocked on a full
+    one (backpressure). Producer time is summed over threads.
+    '''
+    def __init__(self):
+        self.records = 0
+        self.depth_total = 0
+        self.max_depth = 0
+        self.empty_gets = 0
+        self.consumer_stall_seconds = 0.0
+        self.producer_stall_seconds = 0.0
+        self.lock = threading.Lock()
+
+    def record_get(self, depth, stall_seconds):
+        self.records += 1
+        self.depth_total += depth
+        self.max_depth = max(self.max_depth, depth)
+        if not depth:
+            self.empty_gets += 1
+        self.consumer_stall_seconds += stall_seconds
+
+    def record_put(self, stall_seconds):
+        with self.lock:
+            self.producer_stall_seconds += stall_seconds
+
+    def to_dict(self):
+        return {
+            'records': self.records,
+            'mean_depth': float(self.depth_total) / self.records if self.records else None,
+            'max_depth': self.max_depth,
+            'empty_gets': self.empty_gets,
+            'consumer_stall_seconds': self.consumer_stall_seconds,
+            'producer_stall_seconds': self.producer_stall_seconds,
+        }
+
+
+class Prefetcher(object):
+    '''
+    Iterates over the records of several sources (zero-argument callables
+    returning an iterable, e.g. a WARC reader) while background threads
+    read and decompress the upcoming ones into a bounded queue.
+
+    Reading, gunzipping and socket I/O release the GIL, so they overlap
+    with extraction on the consumer thread. Once depth records are queued
+    the producers block until the consumer catches up.
+
+    Records of one source keep their order, with several threads the
+    sources are interleaved. An exception in a source is raised from the
+    iteration, after the records read before it.
+    '''
+    def __init__(self, sources, depth=DEFAULT_PREFETCH_DEPTH, threads=1):
+        self.sources = Queue.Queue()
+        for source in sources:
+            self.sources.put(source)
+        self.queue = Queue.Queue(maxsize=depth)
+        self.stats = PrefetchStats()
+        self.stopped = threading.Event()
+        self.threads = [threading.Thread(target=self.produce) for i in xrange(threads)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def put(self, item):
+        '''
+        Blocking put, returns False if the consumer has stopped
+        '''
+        try:
+            self.queue.put_nowait(item)
+            return True
+        except Queue.Full:
+            pass
+        start = time.time()
+        try:
+            while not self.stopped.is_set():
+                try:
+                    self.queue.put(item, timeout=POLL_INTERVAL)
+                    return True
+                except Queue.Full:
+                    continue
+            return False
+        finally:
+            self.stats.record_put(time.time() - start)
+
+    def produce(self):
+        while not self.stopped.is_set():
+            try:
+                source = self.sources.get_nowait()
+            except Queue.Empty:
+                break
+            try:
+                for record in source():
+                    if not self.put((RECORD, record)):
+                        return
+            except Exception:
+                self.put((SOURCE_ERROR, sys.exc_info()))
+                return
+        self.put((SOURCE_DONE, None))
+
+    def __iter__(self):
+        done = 0
+        try:
+            while done < len(self.threads):
+                depth = self.queue.qsize()
+                start = time.time()
+                kind, value = self.queue.get()
+                if kind == RECORD:
+                    self.stats.record_get(depth, time.time() - start)
+                    yield value
+                elif kind == SOURCE_DONE:
+                    done += 1
+                else:
+                    raise value[0], value[1], value[2]
+        finally:
+            self.close()
+
+    def close(self):
+        # Producers notice within POLL_INTERVAL unless they're in the middle
+        # of a read, they're daemon threads so they can't hold up exit
+        self.stopped.set()
@@ -0,0 +1,226 @@
+import atexit
+import os
+import socket
+import time
+import ujson as json
+
+from collections import defaultdict
+
+
+def side_output_path(directory, name, extension='json'):
+    '''
+    One file per task, so concurrent mappers on a box don't clobber each other
+    '''
+    return os.path.join(directory, '{}.{}.{}.{}'.format(name, socket.gethostname(), os.getpid(), extension))
+
+
+def write_side_output(directory, name, data):
+    path = side_output_path(directory, name)
+    with open(path, 'w') as f:
+        f.write(json.dumps(data))
+    return path
+
+
+class SideOutputLog(object):
+    '''
+    Per-task JSON lines side output, written as records come in so nothing
+    is lost if the task dies
+    '''
+    def __init__(self, directory, name):
+        self.path = side_output_path(directory, name, extension='jsonl')
+        self.f = None
+
+    def write(self, record):
+        if self.f is None:
+            self.f = open(self.path, 'a')
+        self.f.write(json.dumps(record) + '\n')
+        self.f.flush()
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+
+class PatternStats(object):
+    '''
+    Per-prefilter-pattern yield: how many records each pattern matched, how
+    many of those were parsed, how many yielded items and the parse+extract
+    time spent on them. A record matching several patterns counts for each.
+    '''
+    def __init__(self):
+        self.matched = defaultdict(int)
+        self.parsed = defaultdict(int)
+        self.yielded = defaultdict(int)
+        self.seconds = defaultdict(float)
+
+    def record_match(self, patterns):
+        for p in patterns:
+            self.matched[p] += 1
+
+    def record_parse(self, patterns, yielded, seconds):
+        for p in patterns:
+            self.parsed[p] += 1
+            self.seconds[p] += seconds
+            if yielded:
+                self.yielded[p] += 1
+
+    def to_dict(self):
+        ret = {}
+        for p, matched in self.matched.iteritems():
+            parsed = self.parsed[p]
+            ret[p] = {
+                'matched': matched,
+                'parsed': parsed,
+                'yielded': self.yielded[p],
+                'seconds': self.seconds[p],
+                'mean_seconds': self.seconds[p] / parsed if parsed else None,
+            }
+        return ret
+
+
+def log2_bucket(seconds):
+    '''
+    Histogram bucket for a duration, bucket k holds durations of less than
+    2^k microseconds
+    '''
+    return int(seconds * 1000000).bit_length()
+
+
+class ExtractorStats(object):
+    '''
+    Aggregates the (name, seconds, num_results) timings from extract_items
+    into per-extractor totals and log2 histograms of wall-clock time.
+
+    Totals since the last drain are kept in pending so they can be reported
+    as counter increments.
+    '''
+    def __init__(self):
+        self.calls = defaultdict(int)
+        self.results = defaultdict(int)
+        self.seconds = defaultdict(float)
+        self.histograms = defaultdict(lambda: defaultdict(int))
+        self.pending = defaultdict(int)
+
+    def add(self, timings):
+        for name, seconds, num_results in timings:
+            self.calls[name] += 1
+            self.results[name] += num_results
+            self.seconds[name] += seconds
+            self.histograms[name][log2_bucket(seconds)] += 1
+
+            self.pending['{} calls'.format(name)] += 1
+            self.pending['{} us'.format(name)] += int(seconds * 1000000)
+            if num_results:
+                self.pending['{} results'.format(name)] += num_results
+
+    def drain(self):
+        '''
+        (counter, amount) pairs accumulated since the last drain
+        '''
+        pending = self.pending
+        self.pending = defaultdict(int)
+        return pending.items()
+
+    def to_dict(self):
+        ret = {}
+        for name, calls in self.calls.iteritems():
+            ret[name] = {
+                'calls': calls,
+                'results': self.results[name],
+                'seconds': self.seconds[name],
+                'mean_seconds': self.seconds[name] / calls,
+                # Keyed by the bucket's upper bound in microseconds
+                'histogram': dict((str(1 << k), n) for k, n in self.histograms[name].iteritems()),
+            }
+        return ret
+
+
+class CounterBuffer(object):
+    '''
+    Merges counter increments in memory and passes the totals to
+    emit(group, counter, amount) in batches, once flush_records records
+    have been seen or flush_interval seconds have passed, whichever comes
+    first. The interval is also checked on every increment, so counters
+    keep going out when records stop ticking.
+
+    Call flush at the end of the task for the remainder. With
+    flush_at_exit it's also flushed when the process exits, in case the
+    end of the task never calls it.
+    '''
+    def __init__(self, emit, flush_records=1000, flush_interval=60, flush_at_exit=False):
+        self.emit = emit
+        self.flush_records = flush_records
+        self.flush_interval = flush_interval
+        self.counts = defaultdict(int)
+        self.records = 0
+        self.last_flush = time.time()
+        if flush_at_exit:
+            atexit.register(self.flush)
+
+    def increment(self, group, counter, amount=1):
+        self.counts[(group, counter)] += amount
+        if time.time() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def tick(self):
+        '''
+        Called once per record
+        '''
+        self.records += 1
+        if self.records >= self.flush_records or time.time() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        counts = self.counts
+        self.counts = defaultdict(int)
+        for (group, counter), amount in counts.iteritems():
+            if amount:
+                self.emit(group, counter, amount)
+        self.records = 0
+        self.last_flush = time.time()
+
+
+class StageStats(object):
+    '''
+    Records, bytes and seconds spent per pipeline stage, mergeable across
+    worker processes
+    '''
+    def __init__(self):
+        self.records = defaultdict(int)
+        self.bytes = defaultdict(int)
+        self.seconds = defaultdict(float)
+        self.stages = []
+
+    def add(self, stage, num_bytes, seconds, records=1):
+        if stage not in self.seconds:
+            self.stages.append(stage)
+        self.records[stage] += records
+        self.bytes[stage] += num_bytes
+        self.seconds[stage] += seconds
+
+    def update(self, other):
+        for stage in other.stages:
+            self.add(stage, other.bytes[stage], other.seconds[stage], records=other.records[stage])
+
+    def rates(self, stage):
+        '''
+        (records/s, bytes/s) for a stage
+        '''
+        seconds = self.seconds[stage]
+        if not seconds:
+            return None, None
+        return self.records[stage] / seconds, self.bytes[stage] / seconds
+
+    def to_dict(self):
+        ret = {}
+        for stage in self.stages:
+            records_per_second, bytes_per_second = self.rates(stage)
+            ret[stage] = {
+                'records': self.records[stage],
+                'bytes': self.bytes[stage],
+                'seconds': self.seconds[stage],
+                'records_per_second': records_per_second,
+                'bytes_per_second': bytes_per_second,
+            }
+        return ret
@@ -0,0 +1,425 @@
+import gzip
+import logging
+import urllib2
+import zlib
+
+from collections import namedtuple
+
+logger = logging.getLogger('warc')
+
+WARC_RESPONSE = 'response'
+
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+# Compressed bytes read at a time
+READ_SIZE = 64 * 1024
+# Decompressed bytes of a record looked at before deciding whether to keep
+# it, enough for the WARC and HTTP headers of nearly every record
+HEAD_BYTES = 16 * 1024
+
+WARC_INDEX_SUFFIX = '.idx'
+
+# One gzip member (= one record) of a .warc.gz. content_type is the HTTP
+# Content-Type for responses.
+WARCIndexEntry = namedtuple('WARCIndexEntry', 'offset, length, warc_type, content_type, url')
+
+
+def open_warc(path):
+    '''
+    A WARC file, compressed or not. GzipFile reads straight through the
+    concatenated members of a Common Crawl .warc.gz.
+    '''
+    if path.endswith('.gz'):
+        return gzip.GzipFile(path, 'rb')
+    return open(path, 'rb')
+
+
+def is_url(path):
+    return path.startswith(('http://', 'https://', 's3://'))
+
+
+def input_url(path, s3_endpoint=None):
+    '''
+    HTTP URL for an input, s3://bucket/key is looked up on an S3-compatible
+    endpoint, e.g. http://localhost:9000
+    '''
+    if path.startswith('s3://'):
+        if not s3_endpoint:
+            raise ValueError('An S3 endpoint is needed for {}'.format(path))
+        return '{}/{}'.format(s3_endpoint.rstrip('/'), path[len('s3://'):])
+    return path
+
+
+def open_input(path, s3_endpoint=None):
+    '''
+    Raw bytes of a local file or of an object behind an HTTP or
+    S3-compatible endpoint, as a file object read as it streams in
+    '''
+    if is_url(path):
+        return urllib2.urlopen(input_url(path, s3_endpoint))
+    return open(path, 'rb')
+
+
+def parse_headers(lines):
+    headers = {}
+    for line in lines:
+        if ':' not in line:
+            continue
+        key, value = line.split(':', 1)
+        headers[key.strip()] = value.strip()
+    return headers
+
+
+def read_warc_headers(f):
+    '''
+    (version, headers) for the next WARC record, or (None, None) at EOF
+    '''
+    line = f.readline()
+    while line and not line.strip():
+        line = f.readline()
+    if not line:
+        return None, None
+    version = line.strip()
+    lines = []
+    for line in iter(f.readline, ''):
+        if not line.strip():
+            break
+        lines.append(line)
+    return version, parse_headers(lines)
+
+
+def iter_warc_records(f):
+    '''
+    (WARC headers, content block) for every record in a WARC stream
+    '''
+    while True:
+        version, headers = read_warc_headers(f)
+        if version is None:
+            break
+        if not version.startswith('WARC/'):
+            raise ValueError('Not a WARC record: {!r}'.format(version[:100]))
+        block = f.read(int(headers.get('Content-Length', 0)))
+        yield headers, block
+
+
+def header_end(data, start=0):
+    '''
+    (end of a header block starting at start, start of what follows) or
+    (-1, -1) if the blank line isn't in data
+    '''
+    i = data.find('\r\n\r\n', start)
+    if i >= 0:
+        return i, i + 4
+    i = data.find('\n\n', start)
+    if i >= 0:
+        return i, i + 2
+    return -1, -1
+
+
+def parse_record_head(data):
+    '''
+    (WARC headers, offset of the content block) for the start of a
+    record, or (None, -1) if its headers aren't all in data
+    '''
+    data = data.lstrip('\r\n')
+    end, block_start = header_end(data)
+    if end < 0 or not data.startswith('WARC/'):
+        return None, -1
+    lines = data[:end].splitlines()
+    return parse_headers(lines[1:]), block_start
+
+
+def parse_http_response(block):
+    '''
+    (HTTP headers, body) for the content block of a response record
+    '''
+    end, body_start = header_end(block)
+    if end < 0:
+        return parse_headers(block.splitlines()[1:]), ''
+    return parse_headers(block[:end].splitlines()[1:]), block[body_start:]
+
+
+def content_type(headers):
+    for key, value in headers.iteritems():
+        if key.lower() == 'content-type':
+            return value
+    return None
+
+
+def is_html(headers):
+    value = content_type(headers)
+    return value is None or 'html' in value.lower()
+
+
+def record_head_info(head):
+    '''
+    (WARC-Type, HTTP Content-Type, url) from the first bytes of a record.
+    WARC-Type is None if the WARC headers aren't all within head, the HTTP
+    Content-Type is None if the HTTP headers aren't.
+    '''
+    warc_headers, block_start = parse_record_head(head)
+    if warc_headers is None:
+        return None, None, None
+    http_content_type = None
+    warc_type = warc_headers.get('WARC-Type')
+    if warc_type == WARC_RESPONSE:
+        end, body_start = header_end(head, block_start)
+        if end >= 0:
+            http_content_type = content_type(parse_headers(head[block_start:end].splitlines()[1:])) or ''
+    return warc_type, http_content_type, warc_headers.get('WARC-Target-URI')
+
+
+def head_incomplete(warc_type, http_content_type):
+    return warc_type is None or (warc_type == WARC_RESPONSE and http_content_type is None)
+
+
+def wanted_html_response(warc_type, http_content_type):
+    # Records whose headers didn't fit in the head are kept to be safe
+    if head_incomplete(warc_type, http_content_type):
+        return True
+    return warc_type == WARC_RESPONSE and (not http_content_type or 'html' in http_content_type.lower())
+
+
+def iter_gzip_members(f, want=None, offset=0):
+    '''
+    (offset, compressed length, head, data) for every gzip member in f,
+    which is positioned at offset. head is the first HEAD_BYTES
+    decompressed bytes of the member.
+
+    data is the whole decompressed member, unless want(head) is false. Then
+    data is None and the rest of the member is inflated in small pieces
+    and thrown away, only to find where it ends.
+    '''
+    buf = ''
+    # Position in f of the start of buf
+    position = offset
+    while True:
+        start = position
+        d = zlib.decompressobj(GZIP_WBITS)
+        parts = []
+        head_length = 0
+        keep = None
+        ended = False
+
+        while not ended:
+            if not buf:
+                buf = f.read(READ_SIZE)
+                if not buf:
+                    break
+            if keep is None:
+                limit = HEAD_BYTES - head_length
+            elif keep:
+                limit = 0
+            else:
+                limit = READ_SIZE
+            size = len(buf)
+            out = d.decompress(buf, limit)
+            if d.unused_data:
+                buf = d.unused_data
+                ended = True
+            else:
+                buf = d.unconsumed_tail
+            position += size - len(buf)
+
+            if keep is not False:
+                parts.append(out)
+                head_length += len(out)
+            if keep is None and (head_length >= HEAD_BYTES or ended):
+                keep = want is None or want(''.join(parts))
+
+        if position == start:
+            return
+        if not ended and keep is not False:
+            parts.append(d.flush())
+
+        data = ''.join(parts)
+        if keep is None:
+            keep = want is None or want(data)
+        head = data[:HEAD_BYTES]
+        yield start, position - start, head, data if keep else None
+
+        if not ended:
+            return
+
+
+def want_html_head(head):
+    warc_type, http_content_type, url = record_head_info(head)
+    return wanted_html_response(warc_type, http_content_type)
+
+
+def html_response(data):
+    '''
+    (url, HTTP headers, body) for a decompressed record, or None if it's
+    not an HTML response
+    '''
+    warc_headers, block_start = parse_record_head(data)
+    if warc_headers is None or warc_headers.get('WARC-Type') != WARC_RESPONSE:
+        return None
+    data = data.lstrip('\r\n')
+    block_end = block_start + int(warc_headers.get('Content-Length', len(data) - block_start))
+    end, body_start = header_end(data, block_start)
+    if end < 0 or body_start > block_end:
+        headers, body = parse_http_response(data[block_start:block_end])
+    else:
+        headers = parse_headers(data[block_start:end].splitlines()[1:])
+        body = data[body_start:block_end]
+    if not is_html(headers):
+        return None
+    return warc_headers.get('WARC-Target-URI'), headers, body
+
+
+def build_warc_index(path):
+    '''
+    WARCIndexEntry for every gzip member of a .warc.gz. Every member still
+    has to be inflated to find where it ends, but only the record heads
+    are kept.
+    '''
+    def want(head):
+        return head_incomplete(*record_head_info(head)[:2])
+
+    index = []
+    with open(path, 'rb') as f:
+        for offset, length, head, data in iter_gzip_members(f, want=want):
+            warc_type, http_content_type, url = record_head_info(data if data is not None else head)
+            index.append(WARCIndexEntry(offset, length, warc_type, http_content_type, url or None))
+    return index
+
+
+def warc_index_path(path):
+    return path + WARC_INDEX_SUFFIX
+
+
+def save_warc_index(index, path):
+    '''
+    One tab-separated line per member: offset, length, WARC-Type,
+    Content-Type (- if unknown), url
+    '''
+    with open(path, 'w') as f:
+        for entry in index:
+            f.write('{}\t{}\t{}\t{}\t{}\n'.format(entry.offset, entry.length, entry.warc_type or '-',
+                                                 '-' if entry.content_type is None else entry.content_type or '',
+                                                 entry.url or ''))
+
+
+def load_warc_index(path):
+    index = []
+    with open(path) as f:
+        for line in f:
+            offset, length, warc_type, http_content_type, url = line.rstrip('\n').split('\t', 4)
+            index.append(WARCIndexEntry(int(offset), int(length), None if warc_type == '-' else warc_type,
+                                        None if http_content_type == '-' else http_content_type, url or None))
+    return index
+
+
+def warc_index(path, save=True):
+    '''
+    The saved index for a .warc.gz, built (and saved next to it) if there
+    isn't one
+    '''
+    index_path = warc_index_path(path)
+    try:
+        return load_warc_index(index_path)
+    except IOError:
+        pass
+    index = build_warc_index(path)
+    if save:
+        save_warc_index(index, index_path)
+    return index
+
+
+def split_warc_index(index, parts):
+    '''
+    Split an index into at most parts contiguous ranges of about the same
+    compressed size, which can be read independently
+    '''
+    total = sum(entry.length for entry in index)
+    ranges = []
+    current = []
+    size = 0
+    for entry in index:
+        current.append(entry)
+        size += entry.length
+        if size * parts >= total * (len(ranges) + 1) and len(ranges) < parts - 1:
+            ranges.append(current)
+            current = []
+    if current:
+        ranges.append(current)
+    return ranges
+
+
+def read_member(f, entry):
+    f.seek(entry.offset)
+    return zlib.decompress(f.read(entry.length), GZIP_WBITS)
+
+
+def iter_indexed_html_responses(path, index):
+    '''
+    (url, HTTP headers, body) for the HTML responses among the index
+    entries, seeking straight to each one. Other records aren't read.
+    '''
+    with open(path, 'rb') as f:
+        for entry in index:
+            if not wanted_html_response(entry.warc_type, entry.content_type):
+                continue
+            response = html_response(read_member(f, entry))
+            if response is not None:
+                yield response
+
+
+def iter_gzip_html_responses(f):
+    '''
+    HTML responses in a .warc.gz stream, one gzip member at a time
+    '''
+    for offset, length, head, data in iter_gzip_members(f, want=want_html_head):
+        if data is None:
+            continue
+        response = html_response(data)
+        if response is not None:
+            yield response
+
+
+def iter_plain_html_responses(f):
+    for warc_headers, block in iter_warc_records(f):
+        if warc_headers.get('WARC-Type') != WARC_RESPONSE:
+            continue
+        headers, body = parse_http_response(block)
+        if not is_html(headers):
+            continue
+        yield warc_headers.get('WARC-Target-URI'), headers, body
+
+
+def iter_html_responses(path, index=None, s3_endpoint=None):
+    '''
+    (url, HTTP headers, body) for every HTML response in a WARC file, the
+    record shape MicrodataJob.filter and process_html take. path can also
+    be an http(s):// or s3:// URL (see open_input).
+
+    A .warc.gz is read one gzip member at a time, and the bodies of other
+    records are never kept. With an index (a list of WARCIndexEntry, e.g.
+    one range from split_warc_index) only the HTML responses it lists are
+    read and decompressed, which needs a local file.
+    '''
+    if index is not None:
+        for response in iter_indexed_html_responses(path, index):
+            yield response
+        return
+
+    f = open_input(path, s3_endpoint=s3_endpoint)
+    try:
+        if path.endswith('.gz'):
+            responses = iter_gzip_html_responses(f)
+        else:
+            responses = iter_plain_html_responses(f)
+        for response in responses:
+            yield response
+    finally:
+        f.close()
+
+
+if __name__ == '__main__':
+    import sys
+    logging.basicConfig(level=logging.INFO)
+    for path in sys.argv[1:]:
+        index = build_warc_index(path)
+        save_warc_index(index, warc_index_path(path))
+        logger.info('Indexed {} records of {}'.format(len(index), path))
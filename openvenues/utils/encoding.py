@@ -1,3 +1,5 @@
+import codecs
+import re
 import six
 
 text_type = six.text_type
@@ -32,3 +34,53 @@ def safe_encode(value, incoming=None, encoding='utf-8', errors='strict'):
             return value.encode(encoding, errors)
         else:
             return value
+
+
+# How far into a document to look for <meta charset>, same as BeautifulSoup
+META_CHARSET_BYTES = 2048
+
+meta_charset_regex = re.compile('<meta[^>]+charset\s*=\s*["\']?\s*([a-zA-Z0-9_:.\-]+)', re.I)
+content_type_charset_regex = re.compile('charset\s*=\s*["\']?\s*([a-zA-Z0-9_:.\-]+)', re.I)
+
+
+def normalize_charset(name):
+    '''
+    Canonical codec name for a charset label (latin-1 and iso-8859-1 are
+    both iso8859-1), or None if Python doesn't know it
+    '''
+    try:
+        return codecs.lookup(name).name
+    except LookupError:
+        return None
+
+
+def header_charset(headers):
+    if not headers:
+        return None
+    for key, value in headers.items():
+        if key.lower() == 'content-type' and value:
+            m = content_type_charset_regex.search(value)
+            if m:
+                return m.group(1)
+    return None
+
+
+def meta_charset(content):
+    m = meta_charset_regex.search(content, 0, META_CHARSET_BYTES)
+    if m:
+        return m.group(1)
+    return None
+
+
+def declared_charset(content, headers=None):
+    '''
+    (charset, source) from the Content-Type header, which wins, or the
+    <meta charset> / http-equiv tag. (None, None) if neither declares one.
+    '''
+    charset = header_charset(headers)
+    if charset:
+        return charset, 'header'
+    charset = meta_charset(content)
+    if charset:
+        return charset, 'meta'
+    return None, None
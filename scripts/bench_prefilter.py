@@ -0,0 +1,93 @@
+import argparse
+import os
+import random
+import sys
+import time
+
+from openvenues.extract.prefilter import *
+from openvenues.jobs.microdata import contains_microdata_regex, microdata_prefilter, pattern_needles, patterns
+from openvenues.jobs.warc import iter_html_responses
+
+this_dir = os.path.realpath(os.path.dirname(__file__))
+
+TEST_DATA_DIR = os.path.join(this_dir, os.pardir, 'tests', 'data')
+
+
+def read_dir(d):
+    return [open(os.path.join(d, filename)).read() for filename in sorted(os.listdir(d))]
+
+
+def read_warc_negatives(path, num_negatives):
+    '''
+    Real pages from a WARC file which the prefilter shouldn't match
+    '''
+    negatives = []
+    for url, headers, body in iter_html_responses(path):
+        if not contains_microdata_regex.search(body):
+            negatives.append(body)
+            if len(negatives) >= num_negatives:
+                break
+    return negatives
+
+
+def make_negative(html):
+    # Strip everything the prefilter is looking for, keeps realistic size/markup
+    while contains_microdata_regex.search(html):
+        html = contains_microdata_regex.sub('', html)
+    return html
+
+
+def bench(name, func, docs, rounds):
+    total_bytes = sum(len(d) for d in docs) * rounds
+    hits = 0
+    start = time.time()
+    for i in xrange(rounds):
+        for d in docs:
+            if func(d):
+                hits += 1
+    elapsed = time.time() - start
+    n = len(docs) * rounds
+    print('{:<24} {:>10.1f} us/doc {:>10.1f} MB/s   hits={}'.format(name, elapsed * 1e6 / n,
+                                                                   total_bytes / elapsed / (1024 * 1024), hits))
+
+
+def main(negative_dir=None, num_negatives=1000, rounds=5, warc=None):
+    positives = read_dir(TEST_DATA_DIR)
+
+    if warc:
+        negatives = read_warc_negatives(warc, num_negatives)
+    elif negative_dir:
+        negatives = read_dir(negative_dir)
+    else:
+        # Only as varied as the test pages, use --warc for real throughput
+        # numbers
+        templates = [make_negative(html) for html in positives]
+        negatives = [random.choice(templates) for i in xrange(num_negatives)]
+
+    regex_matcher = LiteralMatcher(pattern_needles(patterns), use_automaton=False)
+
+    for name, docs in (('positives', positives), ('negatives', negatives)):
+        for d in docs:
+            expected = bool(contains_microdata_regex.search(d))
+            assert bool(microdata_prefilter.search(d)) == expected
+            assert bool(regex_matcher.search(d)) == expected
+
+        print('{}: {} docs, {:.1f} MB'.format(name, len(docs), sum(len(d) for d in docs) / (1024.0 * 1024)))
+        bench('regex', contains_microdata_regex.search, docs, rounds)
+        bench('literal regex', regex_matcher.search, docs, rounds)
+        if microdata_prefilter.automaton is not None:
+            bench('aho-corasick', microdata_prefilter.search, docs, rounds)
+            bench('aho-corasick (all ids)', microdata_prefilter.matches, docs, rounds)
+        print('')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the microdata prefilter against the regex')
+    parser.add_argument('--negative-dir', help='Directory of pages which should not match')
+    parser.add_argument('--warc', help='WARC file to take pages which should not match from')
+    parser.add_argument('--num-negatives', type=int, default=1000,
+                        help='Number of negative pages from --warc, or synthetic ones if no --negative-dir')
+    parser.add_argument('--rounds', type=int, default=5)
+    args = parser.parse_args()
+
+    main(args.negative_dir, args.num_negatives, args.rounds, warc=args.warc)
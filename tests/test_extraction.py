@@ -6,7 +6,10 @@ from __future__ import unicode_literals
 import os
 import unittest
 
-from openvenues.jobs.microdata import contains_microdata_regex
+from openvenues.jobs.microdata import contains_microdata_regex, requires_tree_regex
+from openvenues.extract.head import extract_head_items, head_section, parse_head
+from openvenues.extract.index import DocumentIndex
+from openvenues.extract.jsonld import JSONLD_MAX_DEPTH, extract_jsonld_items, jsonld_stats, without_jsonld
 from openvenues.extract.soup import *
 from openvenues.extract.util import *
 
@@ -25,6 +28,167 @@ class TestExtraction(unittest.TestCase):
             self.assertTrue(contains_microdata_regex.search(html))
 
 
+    def test_document_index(self):
+        html = self._get_test_html('opentable.html')
+        soup = BeautifulSoup(html)
+        index = DocumentIndex(soup)
+
+        self.assertEqual(index.tags_named('meta'), soup.find_all('meta'))
+        self.assertEqual(index.tags_with_attr('property', name='meta'), soup.select('meta[property]'))
+        self.assertEqual(index.tags_with_attr_containing('href', 'maps.google', name='a'),
+                         soup.select('a[href*="maps.google"]'))
+        self.assertEqual(index.tags_with_attr('data-lat'), soup.find_all(attrs={'data-lat': True}))
+
+    def test_document_index_depth(self):
+        index = DocumentIndex(BeautifulSoup('<div><p><b>x</b></p><p>y</p></div><span></span>', 'html.parser'))
+        self.assertEqual(index.tag_count, 5)
+        self.assertEqual(index.max_depth, 3)
+
+    def test_head_items(self):
+        html = '''<html><head><title>Sample &amp; Co</title>
+        <meta property="og:title" content="Sample"><meta property="og:type" content="restaurant">
+        <meta property="og:latitude" content="40.7"><meta property="og:longitude" content="-73.9">
+        <meta name="geo.position" content="40.7;-73.9"><meta name="ICBM" content="40.7, -73.9">
+        <link rel="canonical" href="http://example.com/sample"></head>
+        <body><a href="http://twitter.com/sample">Twitter</a><a rel="tag" href="/food">Food</a></body></html>'''
+
+        self.assertFalse(requires_tree_regex.search(html))
+        ret = extract_head_items(parse_head(html))
+        self.assertEqual(ret, extract_items(BeautifulSoup(html)))
+        self.assertEqual(ret['title'], 'Sample')
+        self.assertEqual(ret['tags'], [{'value': 'Food', 'link': 'href', 'link_value': '/food'}])
+
+        # rel values with extra whitespace or several tokens come out the same
+        html = html.replace('<a rel="tag" href="/food">', '<a rel=" tag" href="/food">').replace(
+            '</body>', '<a rel="tag nofollow" href="/drink">Drink</a><a rel="TAG\tx" href="/x">X</a></body>')
+        ret = extract_head_items(parse_head(html))
+        self.assertEqual(ret, extract_items(BeautifulSoup(html)))
+        self.assertEqual(ret, extract_items(BeautifulSoup(html, 'html.parser')))
+        self.assertEqual(ret['tags'], [{'value': 'Food', 'link': 'href', 'link_value': '/food'}])
+
+        html = self._get_test_html('timeout_london.html')
+        ret = extract_items(BeautifulSoup(html))
+        head_ret = extract_head_items(parse_head(html))
+        self.assertEqual([i for i in ret['items'] if i['item_type'] in (OG_TAG_TYPE, GEOTAG_TYPE)],
+                         head_ret['items'])
+        self.assertEqual(ret['og'], head_ret['og'])
+
+    def test_head_section(self):
+        html = self._get_test_html('timeout_london.html')
+        head = head_section(html)
+        self.assertTrue(head.lower().rstrip().endswith('</head>'))
+        self.assertEqual(extract_head_items(parse_head(head))['items'], extract_head_items(parse_head(html))['items'])
+        self.assertEqual(head_section('<meta name="a" content="b"><BODY class="x">'), '<meta name="a" content="b">')
+        self.assertEqual(head_section('<p>no head</p>'), '')
+
+    def test_decode_html(self):
+        valid_charsets = set(['utf-8', 'iso8859-1'])
+        html = self._get_test_html('nymag.html')
+        decoded, decision = decode_html(html, valid_charsets=valid_charsets)
+        self.assertEqual(decision, 'meta iso8859-1')
+        self.assertEqual(extract_items(BeautifulSoup(decoded)), extract_items(BeautifulSoup(br2nl(html))))
+
+        self.assertEqual(decode_html(b'<meta charset="latin-1"><p>caf\xe9<BR />x</p>'),
+                         ('<meta charset="latin-1"><p>caf\xe9\nx</p>', 'meta iso8859-1'))
+        self.assertEqual(decode_html(b'\xef\xbb\xbf<p>caf\xc3\xa9</p>', headers={'Content-Type': 'text/html; charset=UTF-8'}),
+                         ('<p>caf\xe9</p>', 'header utf-8'))
+        self.assertEqual(decode_html(b'<p>caf\xe9</p>'), (b'<p>caf\xe9</p>', 'undecodable default utf-8'))
+        self.assertEqual(decode_html(b'<meta charset="shift_jis">', valid_charsets=valid_charsets),
+                         (b'<meta charset="shift_jis">', 'unsupported shift_jis'))
+
+    def test_extractor_triggers(self):
+        for filename in os.listdir(TEST_DATA_DIR):
+            html = self._get_test_html(filename)
+            soup = BeautifulSoup(html)
+            triggers = matched_triggers(html)
+            self.assertEqual(extract_items(soup, triggers=triggers), extract_items(soup))
+
+        triggers = matched_triggers(self._get_test_html('nymag.html'))
+        self.assertTrue('vcard' in triggers)
+        self.assertFalse('itemtype' in triggers)
+
+    def test_extractor_timings(self):
+        soup = BeautifulSoup(self._get_test_html('nymag.html'))
+        timings = []
+        self.assertEqual(extract_items(soup, timings=timings), extract_items(soup))
+        names = [name for name, seconds, num_results in timings]
+        self.assertEqual(names[0], 'index')
+        self.assertEqual(names[1:len(extractors) + 1], [name for name, func, triggers in extractors])
+        self.assertEqual(names[-3:], ['social', 'og', 'metadata'])
+        self.assertTrue(dict((name, n) for name, seconds, n in timings)[VCARD_TYPE] > 0)
+
+    def test_classify_links(self):
+        html = '''<a href="http://www.facebook.com/sharer?u=http://twitter.com/x">f</a>
+        <a href="http://www.google.co.uk/maps?q=2&ll=1,2">g</a><a href="http://goo.gl/maps/abc">s</a>
+        <iframe src="http://maps.google.com/maps?q=x"></iframe><img src="http://maps.google.com/staticmap">
+        <a href="http://www.hopstop.com/route?address2=x&zip2=1">r</a><a href="http://example.com/">x</a>'''
+        index = DocumentIndex(BeautifulSoup(html))
+        links = classify_links(index)
+        self.assertIs(classify_links(index), links)
+        self.assertEqual(len(links['facebook.com']), 1)
+        self.assertEqual(links['facebook.com'], links['twitter.com'])
+        self.assertEqual([t['href'] for t in links[GOOGLE_MAPS_HREF_LINK]], ['http://www.google.co.uk/maps?q=2&ll=1,2'])
+        self.assertEqual(links[GOOGLE_MAPS_LINK], [])
+        self.assertEqual(len(links[GOOGLE_MAPS_SHORTENED_LINK]), 1)
+        self.assertEqual(len(links[GOOGLE_MAPS_IFRAME]), 1)
+        self.assertEqual(len(links[GOOGLE_MAPS_IMG]), 1)
+        self.assertEqual(len(links[HOPSTOP_ROUTE_LINK]), 1)
+        self.assertEqual(links[HOPSTOP_MAP_LINK], [])
+
+    def test_lru_cache(self):
+        cache = LRUCache(maxsize=2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.put('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
+
+    def test_cached_url_items(self):
+        url = 'http://maps.google.com/maps?q=Brooklyn+Bowl&ll=40.72,-73.95'
+        item = item_from_google_maps_url(url)
+        self.assertEqual(item['latitude'], '40.72')
+        item['latitude'] = 'changed'
+        hits = url_item_cache.hits
+        self.assertEqual(item_from_google_maps_url(url)['latitude'], '40.72')
+        self.assertEqual(url_item_cache.hits, hits + 1)
+
+        self.assertIsNone(item_from_google_maps_url('http://maps.google.com/'))
+        self.assertIsNone(item_from_google_maps_url('http://maps.google.com/'))
+
+        url = 'http://www.hopstop.com/map?address=2+Main'
+        self.assertEqual(parse_hopstop_map_url(url), {'item_type': HOPSTOP_MAP_TYPE, 'address': '2 Main'})
+
+    def test_address_elements(self):
+        html = '<div><address>1 Main St<br/>New York, <b>NY</b> &amp; more<!-- x --></address></div>'
+        soup = BeautifulSoup(html)
+        items = extract_address_elements(soup)
+        self.assertEqual(items[0]['address'], u'1 Main St\nNew York, NY & more')
+        self.assertEqual(items[0]['original_html'], unicode(soup.address))
+        self.assertEqual(BeautifulSoup(br2nl(html)).address.text.strip(), items[0]['address'])
+
+        ret = extract_items(soup, original_html=False)
+        self.assertEqual(ret['items'], [{'item_type': ADDRESS_ELEMENT_TYPE, 'address': items[0]['address']}])
+
+    def test_want_item_types(self):
+        want = set([SCHEMA_DOT_ORG_TYPE, OG_BUSINESS_TAG_TYPE, VCARD_TYPE])
+        for filename in os.listdir(TEST_DATA_DIR):
+            soup = BeautifulSoup(br2nl(self._get_test_html(filename)))
+            ret = extract_items(soup)
+            wanted = [i for i in ret['items'] if i['item_type'] in want] if ret else []
+            want_ret = extract_items(soup, want=want)
+            if not wanted:
+                self.assertIsNone(want_ret)
+            else:
+                self.assertEqual(want_ret, dict(ret, items=wanted))
+
+        index = parse_head(self._get_test_html('timeout_london.html'))
+        self.assertEqual([i['item_type'] for i in extract_head_items(index, want=set([OG_TAG_TYPE]))['items']],
+                         [OG_TAG_TYPE])
+        self.assertIsNone(extract_head_items(index, want=set([VCARD_TYPE])))
+
     def test_schema_dot_org(self):
         html = self._get_test_html('opentable.html')
         soup = BeautifulSoup(br2nl(html))
@@ -56,6 +220,68 @@ class TestExtraction(unittest.TestCase):
         self.assertTrue(have_schema_dot_org)
         self.assertTrue(have_street)
 
+    def test_jsonld(self):
+        html = '''<html><head><title>Sample</title>
+        <script type="application/ld+json">
+        {"@context": "http://schema.org", "@graph": [
+            {"@type": ["Thing", "Restaurant"], "name": "Sample", "servesCuisine": ["Thai", "Lao"],
+             "address": {"@type": "PostalAddress", "streetAddress": "1 Main St", "addressLocality": "Brooklyn"},
+             "geo": {"@type": "GeoCoordinates", "latitude": 40.7, "longitude": -73.9}},
+            {"@type": "http://schema.org/LocalBusiness", "name": "No address"}
+        ]}
+        </script>
+        <script type="application/ld+json"><!-- {"@type": "Store", "address": "2 Main St"} --></script>
+        <script type="application/ld+json">{not json</script>
+        </head><body><p>Welcome</p></body></html>'''
+
+        items = extract_jsonld_items(html)
+        self.assertEqual([i['type'] for i in items], ['Restaurant', 'Store'])
+        props = items[0]['properties']
+        self.assertEqual([p['value'] for p in props if p['name'] == 'servesCuisine'], ['Thai', 'Lao'])
+        geo = [p for p in props if p['name'] == 'geo'][0]
+        self.assertEqual(geo['type'], 'GeoCoordinates')
+        self.assertEqual(sorted((p['name'], p['value']) for p in geo['properties']),
+                         [('latitude', '40.7'), ('longitude', '-73.9')])
+        self.assertTrue(all(i['item_type'] == SCHEMA_DOT_ORG_TYPE for i in items))
+
+        # Same items from the parsed tree and from the streaming head parser
+        self.assertEqual(extract_items(BeautifulSoup(html))['items'], items)
+        self.assertEqual(extract_items(BeautifulSoup(html, 'html.parser'))['items'], items)
+        self.assertFalse(requires_tree_regex.search(without_jsonld(html)))
+        self.assertEqual(extract_head_items(parse_head(html)), extract_items(BeautifulSoup(html)))
+        self.assertEqual(extract_head_items(parse_head(html), want=set([OG_TAG_TYPE])), None)
+
+    def test_duplicate_meta(self):
+        html = '''<html><head><meta name="description" content="desc"><meta name="keywords" content="a">
+        <meta name="description" content="desc"><meta content="desc" name="description">
+        <meta name="keywords" content="b"></head><body></body></html>'''
+        ret = extract_basic_metadata(BeautifulSoup(html, 'html.parser'))
+        self.assertEqual(ret['other_meta'], {'description': ['desc'], 'keywords': ['a', 'b']})
+        self.assertEqual(extract_basic_metadata(BeautifulSoup(html, 'lxml')), ret)
+        self.assertEqual(extract_basic_metadata(None, index=parse_head(html)), ret)
+
+    def test_jsonld_too_deep(self):
+        nested = '{"@type": "Thing", "about": ' * 1000 + '{}' + '}' * 1000
+        lists = '[' * 1000 + ']' * 1000
+        html = '''<html><head>
+        <script type="application/ld+json">%s</script>
+        <script type="application/ld+json">%s</script>
+        <script type="application/ld+json">{"@type": "Store", "address": "2 Main St"}</script>
+        </head><body><p>Welcome</p></body></html>''' % (nested, lists)
+
+        jsonld_stats.drain()
+        items = extract_jsonld_items(html)
+        self.assertEqual([i['type'] for i in items], ['Store'])
+        self.assertEqual(jsonld_stats.drain(), 2)
+        self.assertEqual(extract_head_items(parse_head(html))['items'], items)
+        self.assertEqual(extract_items(BeautifulSoup(html))['items'], items)
+        jsonld_stats.drain()
+
+        # Deep but within the limit is still read
+        nested = '{"@type": "Thing", "about": ' * (JSONLD_MAX_DEPTH - 1) + \
+            '{"@type": "Store", "address": "2 Main St"}' + '}' * (JSONLD_MAX_DEPTH - 1)
+        self.assertEqual([i['type'] for i in extract_jsonld_items(html.replace(lists, nested))], ['Store', 'Store'])
+
     def test_invalid_schema_dot_org(self):
         html = self._get_test_html('time.html')
         soup = BeautifulSoup(html)
@@ -114,6 +340,56 @@ class TestExtraction(unittest.TestCase):
         self.assertTrue(have_address)
 
 
+    def test_microdata_and_rdfa(self):
+        html = '''<html xmlns:v="http://rdf.data-vocabulary.org/#"><body>
+        <div itemscope itemtype="http://schema.org/Restaurant"><span itemprop="name">A</span>
+          <div typeof="v:Organization"><span property="v:name">B</span>
+            <span property="v:street-address">1 Main</span>
+            <div itemprop="address" itemscope itemtype="http://schema.org/PostalAddress">
+              <span itemprop="streetAddress">2 Elm</span>
+            </div>
+          </div>
+        </div>
+        </body></html>'''
+        soup = BeautifulSoup(html)
+        microdata_items, rdfa_items = extract_schema_dot_org_items(soup)
+        self.assertEqual(microdata_items, extract_schema_dot_org(soup))
+        self.assertEqual(rdfa_items, extract_schema_dot_org(soup, use_rdfa=True))
+        self.assertEqual([i['type'] for i in microdata_items], ['Restaurant'])
+        self.assertEqual([i['type'] for i in rdfa_items], ['Organization'])
+
+    def test_anchored_microdata(self):
+        html = '''<html><body>
+        <div itemscope itemtype="http://schema.org/WebPage">
+          <div itemscope itemtype="http://schema.org/Restaurant"><span itemprop="name">R</span>
+            <div itemprop="address" itemscope itemtype="http://schema.org/PostalAddress">
+              <span itemprop="streetAddress">9 Oak</span>
+            </div>
+            <div itemprop="events" itemscope itemtype="http://schema.org/Event">
+              <div itemprop="location" itemscope itemtype="http://schema.org/Place">
+                <span itemprop="streetAddress">1 Main</span>
+              </div>
+            </div>
+          </div>
+        </div>
+        <div itemscope itemtype="http://schema.org/City"><span itemprop="address">London</span></div>
+        </body></html>'''
+        soup = BeautifulSoup(html)
+        index = DocumentIndex(soup)
+        self.assertEqual([t['itemtype'] for t in schema_dot_org_anchors(index)], ['http://schema.org/Restaurant'])
+
+        items = extract_schema_dot_org(soup, anchored=True)
+        self.assertEqual(len(items), 1)
+        self.assertEqual(items[0]['type'], 'Restaurant')
+        self.assertEqual([p['name'] for p in items[0]['properties']], ['name', 'address'])
+
+        full_items = extract_schema_dot_org(soup)
+        self.assertEqual([i['type'] for i in full_items], ['City', 'Restaurant', 'Place'])
+
+        for filename in ('opentable.html', 'visit_london.html'):
+            soup = BeautifulSoup(br2nl(self._get_test_html(filename)))
+            self.assertEqual(extract_schema_dot_org(soup, anchored=True), extract_schema_dot_org(soup))
+
     def test_vcard(self):
         html = self._get_test_html('timeout_london.html')
         soup = BeautifulSoup(html)
@@ -179,6 +455,27 @@ class TestExtraction(unittest.TestCase):
         self.assertTrue(have_telephone)
         self.assertTrue(have_url)
 
+    def test_vcard_index(self):
+        html = '''<div class="url"><div class="vcard">
+        <span class="street-address"><span class="value-title" title="T">x</span><span class="value">1 Main</span></span>
+        <a href="/a">a</a><a class="url" href="/b">b</a>
+        <span class="fn"><span><i class="value">name</i></span></span>
+        </div></div>'''
+        soup = BeautifulSoup(html)
+        vcard = soup.select('.vcard')[0]
+        vcard_index = VcardIndex(vcard)
+        for class_name in ('street-address', 'fn', 'value', 'url'):
+            self.assertIs(vcard_index.first_with_class(class_name), vcard.select('.' + class_name)[0])
+        self.assertIs(vcard_index.first_link_inside_class('url'), vcard.select('.url a')[0])
+        self.assertIs(vcard_index.first_link_with_class('url'), vcard.select('a.url')[0])
+
+        for class_name in ('street-address', 'fn'):
+            tag = vcard.select('.' + class_name)[0]
+            self.assertIs(vcard_index.value_descendant(tag), tag.select('.value')[0])
+        street = vcard.select('.street-address')[0]
+        self.assertIs(vcard_index.value_attr_descendant(street), street.find_all(class_=value_attr_regex)[0])
+        self.assertIsNone(vcard_index.value_attr_descendant(vcard.select('.fn')[0]))
+
     def test_vcard_non_standard(self):
         html = self._get_test_html('nymag.html')
         soup = BeautifulSoup(html)
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import unittest
+
+from openvenues.extract.batch import extract_many
+from openvenues.extract.budget import *
+from openvenues.extract.index import DocumentIndex
+from openvenues.extract.parsers import *
+from openvenues.extract.soup import *
+
+this_dir = os.path.realpath(os.path.dirname(__file__))
+
+TEST_DATA_DIR = os.path.join(this_dir, 'data')
+
+
+class TestParsers(unittest.TestCase):
+    def _get_test_html(self, filename):
+        return open(os.path.join(TEST_DATA_DIR, filename)).read()
+
+    def test_isolated_parser(self):
+        html = self._get_test_html('nymag.html')
+        expected = extract_items(BeautifulSoup(html, HTML_PARSER))
+
+        parser = IsolatedParser(features=HTML_PARSER)
+        try:
+            doc = parser.parse(html)
+            self.assertIsNone(parser.last_failure)
+            self.assertTrue(isinstance(doc, ExtractedDocument))
+            self.assertEqual(parser.extract(doc), expected)
+
+            pid = parser.process.pid
+            parser.parse(html)
+            self.assertEqual(parser.process.pid, pid)
+
+            # Timings come back from the worker
+            timings = []
+            parser.extract(parser.parse(html, timings=timings), timings=timings)
+            self.assertEqual(timings[0][0], 'index')
+            self.assertTrue(VCARD_TYPE in [name for name, seconds, num_results in timings])
+        finally:
+            parser.close()
+
+    def test_isolated_parser_fallback(self):
+        html = self._get_test_html('nymag.html')
+        expected = extract_items(BeautifulSoup(html, HTML_PARSER))
+
+        # Worker can't allocate room for the document, dies and gets respawned
+        parser = IsolatedParser(features=HTML_PARSER, memory_limit=1024 * 1024)
+        padded = html + '<!-- {} -->'.format('x' * 16 * 1024 * 1024)
+        try:
+            doc = parser.parse(padded)
+            self.assertEqual(parser.last_failure, FAILURE_CRASH)
+            self.assertEqual(parser.extract(doc), expected)
+
+            doc = parser.parse(html)
+            self.assertEqual(parser.extract(doc), expected)
+        finally:
+            parser.close()
+
+        parser = IsolatedParser(features=HTML_PARSER, timeout=0)
+        try:
+            doc = parser.parse(html)
+            self.assertEqual(parser.last_failure, FAILURE_TIMEOUT)
+            self.assertEqual(parser.extract(doc), expected)
+            self.assertIsNone(parser.process)
+        finally:
+            parser.close()
+
+
+    def test_budgets(self):
+        html = self._get_test_html('nymag.html')
+        soup = BeautifulSoup(html, HTML_PARSER)
+        index = DocumentIndex(soup)
+        self.assertTrue(index.max_depth > 5)
+
+        self.assertEqual(extract_items(soup, max_tags=index.tag_count, max_depth=index.max_depth),
+                         extract_items(soup))
+        for kw, reason in ((dict(max_tags=index.tag_count - 1), BUDGET_TAGS),
+                           (dict(max_depth=index.max_depth - 1), BUDGET_DEPTH)):
+            with self.assertRaises(BudgetExceeded) as cm:
+                extract_items(soup, **kw)
+            self.assertEqual(cm.exception.reason, reason)
+
+        # Enforced while the tree is built, not after
+        for features in (HTML_PARSER, LXML_PARSER):
+            tree = parse_soup(html, features)
+            tree_index = DocumentIndex(tree)
+            self.assertEqual(len(list(parse_soup(html, features, max_tags=tree_index.tag_count,
+                                                 max_depth=tree_index.max_depth).descendants)),
+                             len(list(tree.descendants)))
+            for kw, reason in ((dict(max_tags=tree_index.tag_count - 1), BUDGET_TAGS),
+                               (dict(max_depth=tree_index.max_depth - 1), BUDGET_DEPTH)):
+                with self.assertRaises(BudgetExceeded) as cm:
+                    parse_soup(html, features, **kw)
+                self.assertEqual(cm.exception.reason, reason)
+        with self.assertRaises(BudgetExceeded):
+            SoupParser().parse(html, max_tags=10)
+
+        # Budgets aren't retried on the fallback parser
+        parser = IsolatedParser(features=HTML_PARSER)
+        try:
+            with self.assertRaises(BudgetExceeded):
+                parser.parse(html, max_tags=10)
+            self.assertTrue(isinstance(parser.parse(html), ExtractedDocument))
+        finally:
+            parser.close()
+
+        with self.assertRaises(BudgetExceeded):
+            with time_limit(0.01):
+                while True:
+                    pass
+        # Not caught by the broad handlers in the extractors
+        with self.assertRaises(BudgetExceeded):
+            with time_limit(0.01):
+                try:
+                    deadline = time.time() + 1
+                    while time.time() < deadline:
+                        pass
+                except Exception:
+                    pass
+        with time_limit(None):
+            pass
+
+    def test_extract_many(self):
+        docs = [(filename, self._get_test_html(filename)) for filename in ('nymag.html', 'opentable.html', 'time.html')]
+        docs.append(('plain', '<p>Nothing to see</p>'))
+        expected = [(url, extract_items(BeautifulSoup(br2nl(html), HTML_PARSER))) for url, html in docs]
+
+        self.assertEqual(list(extract_many(docs, workers=2, chunksize=1)), expected)
+        self.assertEqual(sorted(extract_many(docs, workers=2, chunksize=2, ordered=False)), sorted(expected))
+
+        # Only the document that kills its worker is lost
+        padded = docs[0][1] + '<!-- {} -->'.format('x' * 16 * 1024 * 1024)
+        ret = list(extract_many(docs[:2] + [('padded', padded)] + docs[2:], workers=1, chunksize=4,
+                                memory_limit=128 * 1024 * 1024, max_documents=2))
+        self.assertEqual(ret, expected[:2] + [('padded', None)] + expected[2:])
+
+if __name__ == '__main__':
+    unittest.main()
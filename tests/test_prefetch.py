@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import time
+import unittest
+
+from openvenues.jobs.prefetch import *
+
+
+def slow_source(n, delay=0.0):
+    def source():
+        for i in xrange(n):
+            if delay:
+                time.sleep(delay)
+            yield i
+    return source
+
+
+class TestPrefetch(unittest.TestCase):
+    def test_order(self):
+        prefetcher = Prefetcher([slow_source(100)], depth=8)
+        self.assertEqual(list(prefetcher), range(100))
+        self.assertEqual(prefetcher.stats.records, 100)
+        self.assertTrue(prefetcher.stats.max_depth <= 8)
+
+        prefetcher = Prefetcher([slow_source(10), slow_source(20), slow_source(30)], depth=4, threads=2)
+        self.assertEqual(sorted(prefetcher), sorted(range(10) + range(20) + range(30)))
+
+    def test_backpressure(self):
+        # Consumer slower than the producer: the queue fills up and the
+        # producer waits
+        prefetcher = Prefetcher([slow_source(20)], depth=2)
+        for i in prefetcher:
+            time.sleep(0.01)
+        self.assertTrue(prefetcher.stats.producer_stall_seconds > 0.05)
+        self.assertTrue(prefetcher.stats.max_depth <= 2)
+
+        # Producer slower than the consumer: the consumer waits
+        prefetcher = Prefetcher([slow_source(5, delay=0.02)], depth=2)
+        self.assertEqual(list(prefetcher), range(5))
+        self.assertTrue(prefetcher.stats.consumer_stall_seconds > 0.05)
+        self.assertTrue(prefetcher.stats.empty_gets > 0)
+
+    def test_error(self):
+        def broken():
+            yield 1
+            raise IOError('connection reset')
+
+        records = []
+        with self.assertRaises(IOError):
+            for record in Prefetcher([broken], depth=4):
+                records.append(record)
+        self.assertEqual(records, [1])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import re
+import unittest
+
+from openvenues.extract.prefilter import *
+from openvenues.jobs.microdata import contains_microdata_regex, microdata_prefilter, pattern_needles, patterns
+from openvenues.jobs.stats import PatternStats
+
+this_dir = os.path.realpath(os.path.dirname(__file__))
+
+TEST_DATA_DIR = os.path.join(this_dir, 'data')
+
+
+class TestPrefilter(unittest.TestCase):
+    def _get_test_html(self, filename):
+        return open(os.path.join(TEST_DATA_DIR, filename)).read()
+
+    def test_literal_matcher(self):
+        for use_automaton in (True, False):
+            matcher = LiteralMatcher([('lat', 'data-lat', None),
+                                      ('lon', 'data-lon', None),
+                                      ('long', 'data-long', None),
+                                      ('gmap', '/maps', re.compile('google\.[^/]+\/maps', re.I))],
+                                     use_automaton=use_automaton)
+            self.assertEqual(matcher.matches('<div DATA-LONG="1" data-lat="2">'), set(['lat', 'lon', 'long']))
+            self.assertEqual(matcher.search('<a href="http://example.com/maps">'), None)
+            self.assertEqual(matcher.search('<a href="http://www.google.co.uk/maps?q=x">'), 'gmap')
+            self.assertEqual(matcher.search(u'<div data-lat="1">é</div>'), 'lat')
+
+    def test_chunked_hits(self):
+        # Literals across chunk boundaries are found once, at the same positions
+        chunked = LiteralMatcher(pattern_needles(patterns), chunk_size=7)
+        whole = LiteralMatcher(pattern_needles(patterns), chunk_size=1 << 30)
+        if whole.automaton is None:
+            return
+        for filename in os.listdir(TEST_DATA_DIR):
+            html = self._get_test_html(filename)
+            for content in (html, html.decode('utf-8', 'replace'), u'é' * 5 + u'<div ITEMTYPE="x">'):
+                self.assertEqual(list(chunked.iter_hits(content)), list(whole.iter_hits(content)))
+
+    def test_structural_prefilter(self):
+        self.assertTrue(in_start_tag('<address>', 0))
+        self.assertTrue(in_start_tag('<div class="a vcard">', 15))
+        self.assertFalse(in_start_tag('<p>vcard</p>', 3))
+        self.assertFalse(in_start_tag('<!-- vcard -->', 5))
+        # > is allowed in quoted attribute values
+        self.assertTrue(in_start_tag('<div title="a > b" class="vcard">', 26))
+        self.assertTrue(in_start_tag("<div title = 'a>b' class=vcard>", 25))
+        self.assertFalse(in_start_tag('<div title="a > b">vcard</div>', 19))
+        self.assertFalse(in_start_tag('<p class=x>it\'s a vcard</p>', 18))
+
+        for use_automaton in (True, False):
+            matcher = LiteralMatcher(pattern_needles(patterns), use_automaton=use_automaton)
+            self.assertEqual(matcher.search_structural('<p>Our address is 1 Main St</p>'), ('address', None))
+            self.assertEqual(matcher.search_structural('<style>.vcard {}</style><script>var address;</script>'),
+                             ('vcard', None))
+            self.assertEqual(matcher.search_structural('<p>address</p><span itemprop="address">x</span>'),
+                             ('address', 'address'))
+            self.assertEqual(matcher.search_structural('<p>vcard</p><meta property="og:latitude" content="1">'),
+                             ('vcard', 'og:latitude'))
+            self.assertEqual(matcher.search_structural(
+                '<div title="a > b" itemtype="http://schema.org/Restaurant" itemscope>'), ('itemtype', 'itemtype'))
+            stage1, stage2 = matcher.search_structural('<a data-x="1>0" href="http://maps.google.com/maps?ll=1,2">')
+            self.assertTrue(stage1 is not None)
+            self.assertEqual(stage2, stage1)
+
+        for filename in os.listdir(TEST_DATA_DIR):
+            html = self._get_test_html(filename)
+            stage1, stage2 = microdata_prefilter.search_structural(html)
+            self.assertTrue(stage2 is not None)
+
+    def test_microdata_prefilter(self):
+        fallback = LiteralMatcher(pattern_needles(patterns), use_automaton=False)
+        for filename in os.listdir(TEST_DATA_DIR):
+            html = self._get_test_html(filename)
+            self.assertTrue(microdata_prefilter.search(html) in patterns)
+            self.assertEqual(microdata_prefilter.matches(html), fallback.matches(html))
+
+            negative = html
+            while contains_microdata_regex.search(negative):
+                negative = contains_microdata_regex.sub('', negative)
+            self.assertEqual(microdata_prefilter.search(negative), None)
+            self.assertEqual(fallback.search(negative), None)
+
+    def test_hit_windows(self):
+        matcher = LiteralMatcher([('vcard', 'vcard', None)])
+        padding = '<p>' + 'x' * 1000 + '</p>'
+        html = padding * 3 + '<div class="vcard">a</div>' + padding * 3 + '<span class="vcard">b</span>' + padding * 20
+        windows = matcher.hit_windows(html, window=1500)
+        self.assertEqual(len(windows), 1)
+        start, end = windows[0]
+        self.assertEqual(html[start], '<')
+        self.assertEqual(html[end - 1], '>')
+        self.assertTrue('<div class="vcard">a</div>' in html[start:end])
+        self.assertTrue('<span class="vcard">b</span>' in html[start:end])
+        self.assertTrue(end - start < len(html) / 2)
+
+        windows = matcher.hit_windows(html, window=100)
+        self.assertEqual(len(windows), 2)
+        self.assertEqual(matcher.hit_windows(padding, window=100), [])
+
+    def test_pattern_stats(self):
+        stats = PatternStats()
+        stats.record_match(['vcard', 'address'])
+        stats.record_match(['vcard'])
+        stats.record_parse(['vcard', 'address'], True, 0.5)
+        stats.record_parse(['vcard'], False, 1.5)
+
+        d = stats.to_dict()
+        self.assertEqual(d['vcard'], {'matched': 2, 'parsed': 2, 'yielded': 1,
+                                      'seconds': 2.0, 'mean_seconds': 1.0})
+        self.assertEqual(d['address']['yielded'], 1)
+        self.assertEqual(d['address']['mean_seconds'], 0.5)
+
+
+if __name__ == '__main__':
+    unittest.main()
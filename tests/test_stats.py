@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import subprocess
+import sys
+import unittest
+
+from openvenues.jobs.stats import *
+
+
+class TestStats(unittest.TestCase):
+    def test_log2_bucket(self):
+        self.assertEqual(log2_bucket(0.0), 0)
+        self.assertEqual(log2_bucket(0.000001), 1)
+        self.assertEqual(log2_bucket(0.001), 10)
+
+    def test_extractor_stats(self):
+        stats = ExtractorStats()
+        stats.add([('index', 0.001, 0), ('vcard', 0.003, 2)])
+        stats.add([('index', 0.001, 0)])
+
+        self.assertEqual(dict(stats.drain()), {'index calls': 2, 'index us': 2000,
+                                               'vcard calls': 1, 'vcard us': 3000,
+                                               'vcard results': 2})
+        self.assertEqual(stats.drain(), [])
+
+        d = stats.to_dict()
+        self.assertEqual(d['index']['calls'], 2)
+        self.assertEqual(d['index']['histogram'], {'1024': 2})
+        self.assertEqual(d['vcard']['results'], 2)
+
+    def test_counter_buffer(self):
+        emitted = []
+        buf = CounterBuffer(lambda *args: emitted.append(args), flush_records=2, flush_interval=3600)
+        buf.increment('commoncrawl', 'records')
+        buf.increment('commoncrawl', 'records', 2)
+        buf.tick()
+        self.assertEqual(emitted, [])
+
+        buf.increment('commoncrawl', 'items', 5)
+        buf.tick()
+        self.assertEqual(sorted(emitted), [('commoncrawl', 'items', 5), ('commoncrawl', 'records', 3)])
+
+        del emitted[:]
+        buf.increment('commoncrawl', 'records')
+        buf.flush()
+        self.assertEqual(emitted, [('commoncrawl', 'records', 1)])
+
+        # Time-based flush
+        del emitted[:]
+        buf = CounterBuffer(lambda *args: emitted.append(args), flush_records=1000, flush_interval=0)
+        buf.increment('commoncrawl', 'records')
+        buf.tick()
+        self.assertEqual(emitted, [('commoncrawl', 'records', 1)])
+
+        # Counters incremented outside of records still go out on time
+        del emitted[:]
+        buf = CounterBuffer(lambda *args: emitted.append(args), flush_records=1000, flush_interval=3600)
+        buf.increment('commoncrawl', 'records')
+        buf.last_flush -= 3600
+        buf.increment('commoncrawl', 'records')
+        self.assertEqual(emitted, [('commoncrawl', 'records', 2)])
+
+    def test_counter_buffer_flush_at_exit(self):
+        # The tail batch is emitted even if nothing calls flush
+        script = '''
+import sys
+from openvenues.jobs.stats import CounterBuffer
+buf = CounterBuffer(lambda *args: sys.stdout.write('%s\\t%s\\t%d\\n' % args), flush_records=1000,
+                    flush_interval=3600, flush_at_exit=True)
+buf.increment('commoncrawl', 'records', 3)
+buf.tick()
+'''
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+        output = subprocess.check_output([sys.executable, '-c', script], env=env)
+        self.assertEqual(output, 'commoncrawl\trecords\t3\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
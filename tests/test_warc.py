@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import gzip
+import os
+import re
+import shutil
+import tempfile
+import threading
+import unittest
+import ujson as json
+
+from collections import defaultdict
+from StringIO import StringIO
+
+from BaseHTTPServer import HTTPServer
+from SimpleHTTPServer import SimpleHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+from openvenues.jobs.cdx import *
+from openvenues.jobs.local import *
+from openvenues.jobs.prefetch import Prefetcher
+from openvenues.jobs.warc import *
+
+this_dir = os.path.realpath(os.path.dirname(__file__))
+
+TEST_DATA_DIR = os.path.join(this_dir, 'data')
+
+
+def warc_record(warc_type, url, block, content_type='application/http; msgtype=response'):
+    headers = [
+        'WARC/1.0',
+        'WARC-Type: {}'.format(warc_type),
+        'WARC-Target-URI: {}'.format(url),
+        'Content-Type: {}'.format(content_type),
+        'Content-Length: {}'.format(len(block)),
+    ]
+    return '\r\n'.join(headers) + '\r\n\r\n' + block + '\r\n\r\n'
+
+
+def http_response(body, content_type='text/html; charset=utf-8'):
+    return 'HTTP/1.1 200 OK\r\nContent-Type: {}\r\nContent-Length: {}\r\n\r\n{}'.format(content_type, len(body), body)
+
+
+def write_warc_gz(path, records):
+    # One gzip member per record, like Common Crawl
+    with open(path, 'wb') as f:
+        for record in records:
+            member = gzip.GzipFile(fileobj=f, mode='wb')
+            member.write(record)
+            member.close()
+
+
+def serve_directory(directory, ranges=True):
+    '''
+    Stand-in for an S3-compatible endpoint, serving directory/bucket/key
+    on a local port in a background thread, with keep-alive and (unless
+    ranges is False) single byte-range requests. server.connections counts
+    connections made.
+    '''
+    class Handler(SimpleHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def setup(self):
+            SimpleHTTPRequestHandler.setup(self)
+            self.server.connections += 1
+
+        def translate_path(self, path):
+            return os.path.join(directory, path.split('?', 1)[0].lstrip('/'))
+
+        def do_GET(self):
+            match = re.match(r'bytes=(\d+)-(\d+)$', self.headers.get('Range', ''))
+            if not match or not ranges:
+                return SimpleHTTPRequestHandler.do_GET(self)
+            start, end = int(match.group(1)), int(match.group(2))
+            with open(self.translate_path(self.path), 'rb') as f:
+                size = os.fstat(f.fileno()).st_size
+                f.seek(start)
+                data = f.read(end - start + 1)
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, start + len(data) - 1, size))
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    class Server(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+    server = Server(('127.0.0.1', 0), Handler)
+    server.connections = 0
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+class TestWARC(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.pages = [('http://example.com/{}'.format(filename), open(os.path.join(TEST_DATA_DIR, filename)).read())
+                      for filename in sorted(os.listdir(TEST_DATA_DIR))]
+        records = [warc_record('warcinfo', '', 'software: test\r\n', content_type='application/warc-fields')]
+        for url, html in self.pages:
+            records.append(warc_record('request', url, 'GET / HTTP/1.1\r\n\r\n'))
+            records.append(warc_record('response', url, http_response(html)))
+        records.append(warc_record('response', 'http://example.com/logo.png', http_response('\x89PNG', 'image/png')))
+        self.path = os.path.join(self.temp_dir, 'test.warc.gz')
+        write_warc_gz(self.path, records)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_html_responses(self):
+        responses = list(iter_html_responses(self.path))
+        self.assertEqual([(url, body) for url, headers, body in responses], self.pages)
+        self.assertEqual(responses[0][1]['Content-Type'], 'text/html; charset=utf-8')
+
+    def test_warc_index(self):
+        index = build_warc_index(self.path)
+        self.assertEqual(len(index), 2 * len(self.pages) + 2)
+        self.assertEqual(sum(entry.length for entry in index), os.path.getsize(self.path))
+        self.assertEqual(index[2], WARCIndexEntry(index[1].offset + index[1].length, index[2].length, WARC_RESPONSE,
+                                                  'text/html; charset=utf-8', self.pages[0][0]))
+        self.assertEqual(index[-1].content_type, 'image/png')
+
+        index_path = warc_index_path(self.path)
+        save_warc_index(index, index_path)
+        self.assertEqual(load_warc_index(index_path), index)
+        self.assertEqual(warc_index(self.path), index)
+
+        ranges = split_warc_index(index, 3)
+        self.assertEqual(len(ranges), 3)
+        self.assertEqual(sum(ranges, []), index)
+        responses = [(url, body) for r in ranges for url, headers, body in iter_html_responses(self.path, index=r)]
+        self.assertEqual(responses, self.pages)
+
+        # Records the index says aren't HTML are never read
+        with open(self.path, 'r+b') as f:
+            f.seek(index[-1].offset)
+            f.write('\0' * index[-1].length)
+        self.assertEqual(len(list(iter_html_responses(self.path, index=index))), len(self.pages))
+
+    def test_remote_input(self):
+        os.mkdir(os.path.join(self.temp_dir, 'bucket'))
+        shutil.copy(self.path, os.path.join(self.temp_dir, 'bucket', 'test.warc.gz'))
+        server = serve_directory(self.temp_dir)
+        try:
+            endpoint = 'http://127.0.0.1:{}'.format(server.server_address[1])
+            expected = list(iter_html_responses(self.path))
+            self.assertEqual(list(iter_html_responses('s3://bucket/test.warc.gz', s3_endpoint=endpoint)), expected)
+
+            prefetcher = Prefetcher([lambda: iter_html_responses(endpoint + '/bucket/test.warc.gz')], depth=2)
+            self.assertEqual(list(prefetcher), expected)
+            self.assertEqual(prefetcher.stats.records, len(expected))
+
+            stats, counters, failed = run_local(['s3://bucket/test.warc.gz'], self.temp_dir, workers=1,
+                                                prefetch=4, s3_endpoint=endpoint)
+            self.assertEqual(failed, [])
+            self.assertEqual(stats.records[STAGE_READ], len(expected))
+            self.assertEqual(counters[('prefetch', 'records')], len(expected))
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def write_cdx(self, filename):
+        # CDXJ lines like Common Crawl's for every record but the warcinfo
+        cdx_path = os.path.join(self.temp_dir, 'test.cdxj.gz')
+        with gzip.GzipFile(cdx_path, 'wb') as f:
+            for entry in build_warc_index(self.path)[1:]:
+                values = {'url': entry.url, 'mime': (entry.content_type or 'warc/request').split(';')[0],
+                          'status': '200', 'offset': str(entry.offset), 'length': str(entry.length),
+                          'filename': filename}
+                f.write('com,example)/ 20170101000000 {}\n'.format(json.dumps(values)))
+        return cdx_path
+
+    def test_cdx(self):
+        cdx_filter = CDXFilter(domains=['example.com'], patterns=[r'/yellow'])
+        self.assertTrue(cdx_filter.domain_match('http://www.example.com/'))
+        self.assertFalse(cdx_filter.domain_match('http://notexample.com/'))
+        self.assertTrue(cdx_filter(CDXRecord('http://a.com/yellowpages.html', 'f', 0, 1, 'text/html', '200')))
+        self.assertFalse(cdx_filter(CDXRecord('http://example.com/', 'f', 0, 1, 'image/png', '200')))
+        self.assertFalse(cdx_filter(CDXRecord('http://example.com/', 'f', 0, 1, 'text/html', '404')))
+        self.assertEqual(parse_cdx_line('com,example)/ 20170101000000 http://example.com/ text/html 200 '
+                                        'ABC - - 1043 333 crawl/a.warc.gz'),
+                         CDXRecord('http://example.com/', 'crawl/a.warc.gz', 333, 1043, 'text/html', '200'))
+
+        cdx_path = self.write_cdx('bucket/test.warc.gz')
+        records = matching_cdx_records([cdx_path], CDXFilter(patterns=['nymag', 'yellowpages']))
+        self.assertEqual([record.url for record in records],
+                         ['http://example.com/nymag.html', 'http://example.com/yellowpages.html'])
+        expected = [(url, body) for url, body in self.pages if url in set(record.url for record in records)]
+
+        reader = range_reader(self.temp_dir)
+        os.mkdir(os.path.join(self.temp_dir, 'bucket'))
+        shutil.copy(self.path, os.path.join(self.temp_dir, 'bucket', 'test.warc.gz'))
+        self.assertEqual([(url, body) for url, headers, body in iter_cdx_html_responses(records, reader)], expected)
+
+        # Bad CDX entries are skipped, not fatal
+        bad_records = [records[0]._replace(offset=records[0].offset + 1),
+                       records[0]._replace(filename='bucket/missing.warc.gz')]
+        errors = defaultdict(int)
+        responses = iter_cdx_html_responses(bad_records + records, reader, errors=errors)
+        self.assertEqual([(url, body) for url, headers, body in responses], expected)
+        self.assertEqual(errors, {'read': 1, 'decompress': 1})
+        reader.close()
+
+        server = serve_directory(self.temp_dir)
+        try:
+            endpoint = 'http://127.0.0.1:{}'.format(server.server_address[1])
+            all_records = matching_cdx_records([cdx_path], CDXFilter(domains=['example.com']))
+            self.assertEqual(len(all_records), len(self.pages))
+            reader = range_reader('s3://', s3_endpoint=endpoint)
+            responses = list(iter_cdx_html_responses(all_records, reader))
+            reader.close()
+            self.assertEqual([(url, body) for url, headers, body in responses], self.pages)
+            # Every range read went over the same connection
+            self.assertEqual(server.connections, 1)
+
+            stats, counters, failed = run_local([], self.temp_dir, workers=2, cdx_records=bad_records + all_records,
+                                                warc_base='s3://', s3_endpoint=endpoint, cdx_task_records=5)
+            self.assertEqual(failed, [])
+            self.assertEqual(stats.records[STAGE_READ], len(self.pages))
+            self.assertEqual(counters[('cdx', 'fetch errors: read')], 1)
+            self.assertEqual(counters[('cdx', 'fetch errors: decompress')], 1)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        # A server that ignores Range would send the whole file every time
+        server = serve_directory(self.temp_dir, ranges=False)
+        try:
+            reader = range_reader('http://127.0.0.1:{}'.format(server.server_address[1]))
+            record = all_records[0]
+            self.assertRaises(IOError, reader.read, record.filename, record.offset, record.length)
+            errors = defaultdict(int)
+            self.assertEqual(list(iter_cdx_html_responses(all_records, reader, errors=errors)), [])
+            self.assertEqual(errors, {'read': len(all_records)})
+            reader.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_run_local(self):
+        job = LocalMicrodataJob(args=[])
+        expected = []
+        for url, html in self.pages:
+            if job.filter(url, {}, html):
+                expected.extend(job.process_html(url, {}, html, job.parse_content(html)))
+
+        stats, counters, failed = run_local([self.path, self.path], self.temp_dir, workers=2)
+        self.assertEqual(failed, [])
+        for filename in ('part-00000', 'part-00001'):
+            lines = open(os.path.join(self.temp_dir, filename)).read().splitlines()
+            self.assertEqual([[json.loads(part) for part in line.split('\t')] for line in lines],
+                             json.loads(json.dumps(expected)))
+
+        self.assertEqual(stats.records[STAGE_READ], 2 * len(self.pages))
+        self.assertEqual(stats.records[STAGE_WRITE], 2 * len(expected))
+        self.assertEqual(counters[('commoncrawl', 'filtered records')], 2 * len(expected))
+
+        stats, counters, failed = run_local([self.path], self.temp_dir, workers=2, split=3)
+        lines = sum((open(os.path.join(self.temp_dir, 'part-{:05d}'.format(i))).read().splitlines()
+                     for i in xrange(3)), [])
+        self.assertEqual(len(lines), len(expected))
+        self.assertEqual(stats.records[STAGE_READ], len(self.pages))
+
+    def test_run_records_errors(self):
+        class FailingJob(LocalMicrodataJob):
+            def process_html(self, url, headers, content, soup):
+                if url.endswith('nymag.html'):
+                    raise ValueError('bad record')
+                return super(FailingJob, self).process_html(url, headers, content, soup)
+
+        job = LocalMicrodataJob(args=[])
+        expected = []
+        for url, html in self.pages:
+            if job.filter(url, {}, html) and not url.endswith('nymag.html'):
+                expected.extend(job.process_html(url, {}, html, job.parse_content(html)))
+
+        # One failing record doesn't end the run or lose the others' output
+        out = StringIO()
+        stats = StageStats()
+        run_records(FailingJob(args=[]), iter_html_responses(self.path), out, stats)
+        self.assertEqual(stats.records[STAGE_ERRORS], 1)
+        self.assertEqual(stats.records[STAGE_READ], len(self.pages))
+        self.assertEqual([[json.loads(part) for part in line.split('\t')] for line in out.getvalue().splitlines()],
+                         json.loads(json.dumps(expected)))
+
+if __name__ == '__main__':
+    unittest.main()